@@ -0,0 +1,78 @@
+""" Eager vs. torch.compile'd DDIM sampling (DDIMSampler(compile=True)) with untrained UNets at the real config sizes.
+
+    python -m benchmarks.bench_compiled_sampler --device cpu --steps 10
+    python -m benchmarks.bench_compiled_sampler --device cuda --steps 50 --compile_mode max-autotune
+
+    scenarios:
+        uncond      configs/sdfusion_snet.yaml, no conditioning
+        txt2shape   configs/sdfusion-txt2shape.yaml, cross-attention + classifier-free guidance
+        online      configs/sdfusion_snet.yaml, 25 steps repeated with a fresh sampler per call, like optimize_parameters
+"""
+
+import argparse
+import time
+
+import torch
+
+from models.networks.diffusion_networks.samplers.ddim import DDIMSampler
+
+from benchmarks.bench_util import RandomDiffusionModel, seeded_noise, sync
+
+
+def run(model, compile, compile_mode, steps, batch_size, x_T, c=None, uc=None, scale=1.):
+    sampler = DDIMSampler(model, compile=compile, compile_mode=compile_mode)
+    sync(model.device)
+    t0 = time.perf_counter()
+    samples, _ = sampler.sample(S=steps, batch_size=batch_size, shape=model.z_shape, conditioning=c,
+                                verbose=False, x_T=x_T, eta=0.,
+                                unconditional_guidance_scale=scale, unconditional_conditioning=uc)
+    sync(model.device)
+    return samples, time.perf_counter() - t0
+
+
+def bench(name, model, args, steps, n_calls, c=None, uc=None, scale=1.):
+    x_T = seeded_noise((args.batch_size, *model.z_shape), args.seed, model.device)
+    res = {}
+    for compile in [False, True]:
+        # the first call pays for compilation when compile=True
+        out, first = run(model, compile, args.compile_mode, steps, args.batch_size, x_T, c, uc, scale)
+        times = [run(model, compile, args.compile_mode, steps, args.batch_size, x_T, c, uc, scale)[1]
+                 for _ in range(n_calls)]
+        res[compile] = (out, first, sum(times) / len(times))
+
+    (out_e, first_e, t_e), (out_c, first_c, t_c) = res[False], res[True]
+    max_diff = (out_e - out_c).abs().max().item()
+    print(f'{name:10s} B={args.batch_size} steps={steps:4d} | '
+          f'eager: {steps / t_e:7.2f} steps/s | '
+          f'compiled: {steps / t_c:7.2f} steps/s ({t_e / t_c:.2f}x), first call {first_c:.1f}s vs {first_e:.1f}s | '
+          f'max |diff| {max_diff:.2e}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--steps', type=int, default=50, help='ddim steps for uncond / txt2shape')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--n_calls', type=int, default=3, help='timed calls after the warm-up call')
+    parser.add_argument('--compile_mode', type=str, default=None, help='torch.compile mode, e.g. reduce-overhead')
+    parser.add_argument('--scenarios', type=str, nargs='+', default=['uncond', 'txt2shape', 'online'])
+    parser.add_argument('--seed', type=int, default=111)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    print(f'[*] torch {torch.__version__}, device={args.device}, compile_mode={args.compile_mode}')
+
+    with torch.no_grad():
+        if 'uncond' in args.scenarios or 'online' in args.scenarios:
+            model = RandomDiffusionModel('configs/sdfusion_snet.yaml', device=args.device)
+            if 'uncond' in args.scenarios:
+                bench('uncond', model, args, args.steps, args.n_calls)
+            if 'online' in args.scenarios:
+                bench('online', model, args, 25, max(args.n_calls, 5))
+
+        if 'txt2shape' in args.scenarios:
+            model = RandomDiffusionModel('configs/sdfusion-txt2shape.yaml', device=args.device,
+                                         conditioning_key='crossattn')
+            c = torch.randn(args.batch_size, 77, model.context_dim, device=args.device)
+            uc = torch.randn(args.batch_size, 77, model.context_dim, device=args.device)
+            bench('txt2shape', model, args, args.steps, args.n_calls, c=c, uc=uc, scale=5.)
@@ -0,0 +1,95 @@
+""" The static cost model (models/cost_model.py) against the per-block profiler (models/profiler.py).
+
+    python -m benchmarks.bench_cost_model --device cuda
+    python -m benchmarks.bench_cost_model --df_cfg configs/sdfusion-txt2shape.yaml --cfg cfg --batch 2
+
+    runs --repeats UNet calls on the guided batch (batch x 2 with --cfg cfg) and one decode with ModuleProfiler
+    attached, and prints per block:
+        GFLOPs      predicted, one call
+        params      predicted / counted parameters of the module
+        out         predicted / measured bytes of the activation the block returns
+        ms          measured wall time per call
+        GFLOP/s     predicted FLOPs / measured time
+    then the predicted and measured (torch.cuda.max_memory_allocated above the weights) peak activation memory.
+    the UNet and VQ-VAE are untrained, the costs do not depend on the weights.
+"""
+
+import argparse
+import tempfile
+
+import torch
+
+from models.cost_model import CFG_MODES, CONTEXT_LEN, estimate
+from models.profiler import ModuleProfiler, profile_targets
+
+from benchmarks.bench_util import RandomDiffusionModel, seeded_noise, sync
+
+MB = 2 ** 20
+
+
+def report(rows, measured, modules, prefix):
+    print(f'{"block":28s} {"GFLOPs":>8s} {"params":>7s} {"out":>7s} {"ms":>8s} {"GFLOP/s":>9s}')
+    for r in rows:
+        name = f'{prefix}.{r["name"]}'
+        if name not in measured:
+            print(f'{r["name"]:28s} not profiled')
+            continue
+        m = measured[name]
+        n_params = sum(p.numel() for p in modules[name].parameters())
+        params = r['params'] / n_params if n_params else float('nan')
+        out = r['out'] / m['act_bytes_max'] if m['act_bytes_max'] else float('nan')
+        ms = m['cuda_ms_per_call'] if m['cuda_ms'] else m['wall_ms_per_call']
+        gflops = 2 * r['macs'] / 1e9
+        print(f'{r["name"]:28s} {gflops:8.2f} {params:7.3f} {out:7.3f} {ms:8.2f} {gflops / max(ms, 1e-6) * 1e3:9.1f}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--df_cfg', type=str, default='configs/sdfusion_snet.yaml')
+    parser.add_argument('--vq_cfg', type=str, default='configs/vqvae_snet.yaml')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--cfg', type=str, default='none', choices=list(CFG_MODES))
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    cost = estimate(args.df_cfg, args.vq_cfg, batch=args.batch, steps=args.repeats, cfg=args.cfg)
+    context = any(r['kind'] == 'SpatialTransformer3D' for r in cost['unet'])
+    model = RandomDiffusionModel(args.df_cfg, vq_cfg=args.vq_cfg, device=args.device,
+                                 conditioning_key='crossattn' if context else None)
+    x = seeded_noise((cost['unet_batch'], *model.z_shape), 0, args.device)
+    t = torch.full((cost['unet_batch'],), 500, device=args.device, dtype=torch.long)
+    cond = None
+    if context:
+        cond = seeded_noise((cost['unet_batch'], CONTEXT_LEN, model.context_dim), 1, args.device)
+
+    profiler = ModuleProfiler(tempfile.mkdtemp(), device=args.device)
+    profiler.attach(model.df, 'df').attach(model.vqvae, 'vqvae')
+    modules = dict(profile_targets(model.df, 'df') + profile_targets(model.vqvae, 'vqvae'))
+    weights = torch.cuda.memory_allocated() if args.device.startswith('cuda') else 0
+
+    # every run starts from fresh stats: keep the rows of the networks it ran
+    peaks, measured = {}, {}
+    with torch.no_grad():
+        for key, prefix, fn in [('unet', 'df.', lambda: model.apply_model(x, t, cond)),
+                                ('decode', 'vqvae.', lambda: model.decode(x[:args.batch]))]:
+            if args.device.startswith('cuda'):
+                torch.cuda.reset_peak_memory_stats()
+            with profiler.run(key):
+                for _ in range(args.repeats if key == 'unet' else 1):
+                    fn()
+                sync(args.device)
+            if args.device.startswith('cuda'):
+                peaks[key] = torch.cuda.max_memory_allocated() - weights
+            measured.update({r['name']: r for r in profiler.summary() if r['name'].startswith(prefix)})
+
+    print(f'[*] UNet on {cost["unet_batch"]} x {cost["z_shape"]}, device={args.device}; predicted / measured ratios')
+    report(cost['unet'], measured, modules, 'df.diffusion_net')
+    print(f'\n[*] decode of {args.batch} latents')
+    # quantize and post_quant_conv are not hooked by the profiler
+    report([r for r in cost['decoder'] if r['name'].startswith('decoder.')], measured, modules, 'vqvae')
+    print(f'\n[*] predicted GFLOPs: UNet {cost["unet_flops"] / 1e9:.1f} / call, decode {cost["decode_flops"] / 1e9:.1f}')
+    for key in ['unet', 'decode']:
+        predicted = cost[f'{key}_peak_bytes'] / MB
+        measured_mb = f'{peaks[key] / MB:.1f} MB' if key in peaks else 'n/a (cpu)'
+        print(f'    peak {key:7s} predicted {predicted:.1f} MB, measured {measured_mb}')
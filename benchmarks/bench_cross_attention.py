@@ -0,0 +1,102 @@
+""" Latency / memory of CrossAttention (SpatialTransformer3D) with the full similarity matrix vs. query chunks under a budget.
+
+    python -m benchmarks.bench_cross_attention --device cuda
+    python -m benchmarks.bench_cross_attention --device cpu --grids 8 16 --budgets 0 64 --repeats 3
+
+    CrossAttention.attend, i.e. after the to_q / to_k / to_v projections. per (grid, attention, budget), for one
+    call on batch * heads * grid^3 query tokens:
+        self / cross  attn1 (queries attend to themselves) / attn2 (--context tokens, 77 for BERT)
+        budget        --attn_mem_budget in MB, 0 is the full (b*heads, n, m) matrix
+        fwd ms        forward latency (no grad, as in sampling)
+        fwd+bwd ms    forward + backward latency
+        fwd MB        peak memory of the forward above the inputs (cuda only)
+        bwd MB        peak memory of forward + backward above the inputs (cuda only)
+        max err       max abs difference of output and query gradient against budget 0
+"""
+
+import argparse
+import time
+
+import torch
+
+from models.networks.diffusion_networks.attention import CrossAttention
+
+from benchmarks.bench_util import sync
+
+
+def measure(attn, q, k, v, backward, repeats, device):
+    """ mean ms and peak MB (None on cpu) of `repeats` calls, after one warm-up call """
+    def call():
+        if backward:
+            out = attn.attend(q, k, v)
+            out.float().pow(2).mean().backward()
+        else:
+            with torch.no_grad():
+                attn.attend(q, k, v)
+
+    call()
+    cuda = str(device).startswith('cuda')
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated() if cuda else 0
+    sync(device)
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        call()
+    sync(device)
+    ms = (time.perf_counter() - t0) / repeats * 1e3
+    mb = (torch.cuda.max_memory_allocated() - base) / 2 ** 20 if cuda else None
+    return ms, mb
+
+
+def output_and_grad(attn, q, k, v):
+    q.grad = None
+    out = attn.attend(q, k, v)
+    out.float().pow(2).mean().backward()
+    return out.detach(), q.grad.detach().clone()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--grids', type=int, nargs='+', default=[16, 24])
+    parser.add_argument('--budgets', type=float, nargs='+', default=[0, 256, 64])
+    parser.add_argument('--batch', type=int, default=2, help='2 = one guided sample')
+    parser.add_argument('--dim', type=int, default=192, help='inner dim of the transformer (heads * dim_head)')
+    parser.add_argument('--heads', type=int, default=8)
+    parser.add_argument('--context', type=int, default=77)
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    g = torch.Generator().manual_seed(0)
+    d_head = args.dim // args.heads
+    attn = CrossAttention(args.dim, heads=args.heads, dim_head=d_head).to(args.device)
+    bh = args.batch * args.heads
+
+    def tokens(n):
+        return torch.randn(bh, n, d_head, generator=g).to(args.device).requires_grad_(True)
+
+    print(f'[*] device={args.device} batch={args.batch} dim={args.dim} heads={args.heads} context={args.context}')
+    print(f'{"grid":>5s} {"attn":6s} {"budget":>7s} {"fwd ms":>9s} {"fwd+bwd ms":>11s} '
+          f'{"fwd MB":>9s} {"bwd MB":>9s} {"max err":>9s}')
+    for grid in args.grids:
+        q = tokens(grid ** 3)
+        for name, m in [('self', grid ** 3), ('cross', args.context)]:
+            k, v = (q, q) if name == 'self' else (tokens(m), tokens(m))
+            ref = None
+            for budget in args.budgets:
+                attn.mem_budget = budget * 2 ** 20 if budget > 0 else None
+                try:
+                    out, q_grad = output_and_grad(attn, q, k, v)
+                    fwd_ms, fwd_mb = measure(attn, q, k, v, False, args.repeats, args.device)
+                    bwd_ms, bwd_mb = measure(attn, q, k, v, True, args.repeats, args.device)
+                except torch.cuda.OutOfMemoryError:
+                    torch.cuda.empty_cache()
+                    print(f'{grid:4d}^3 {name:6s} {budget:7.0f} {"OOM":>9s}')
+                    continue
+                ref = (out, q_grad) if ref is None else ref
+                err = max((out - ref[0]).abs().max().item(), (q_grad - ref[1]).abs().max().item())
+                fmt_mb = lambda mb: f'{mb:9.1f}' if mb is not None else f'{"-":>9s}'
+                print(f'{grid:4d}^3 {name:6s} {budget:7.0f} {fwd_ms:9.2f} {bwd_ms:11.2f} '
+                      f'{fmt_mb(fwd_mb)} {fmt_mb(bwd_mb)} {err:9.2e}')
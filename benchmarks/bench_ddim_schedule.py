@@ -0,0 +1,58 @@
+""" Per-call overhead of DDIMSampler / PLMSSampler schedule setup, cached vs. rebuilt.
+
+    python -m benchmarks.bench_ddim_schedule --steps 25 --device cpu
+"""
+
+import argparse
+import time
+from functools import partial
+
+import numpy as np
+import torch
+
+from models.networks.diffusion_networks.ldm_diffusion_util import make_beta_schedule, _DDIM_SCHEDULE_CACHE
+from models.networks.diffusion_networks.samplers.ddim import DDIMSampler
+from models.networks.diffusion_networks.samplers.plms import PLMSSampler
+
+
+class ScheduleOnlyModel(object):
+    """ the attributes a sampler reads from SDFusionModel for make_schedule, nothing else """
+    def __init__(self, device, timesteps=1000, linear_start=1e-4, linear_end=2e-2):
+        betas = make_beta_schedule('linear', timesteps, linear_start=linear_start, linear_end=linear_end)
+        alphas_cumprod = np.cumprod(1. - betas, axis=0)
+        to_torch = partial(torch.tensor, dtype=torch.float32, device=device)
+
+        self.device = device
+        self.num_timesteps = timesteps
+        self.betas = to_torch(betas)
+        self.alphas_cumprod = to_torch(alphas_cumprod)
+        self.alphas_cumprod_prev = to_torch(np.append(1., alphas_cumprod[:-1]))
+
+
+def time_make_schedule(sampler_cls, model, steps, n_calls, cached):
+    _DDIM_SCHEDULE_CACHE.pop(model, None)
+    t0 = time.perf_counter()
+    for _ in range(n_calls):
+        if not cached:
+            _DDIM_SCHEDULE_CACHE.pop(model, None)
+        # the online loop builds a fresh sampler every optimize_parameters call
+        sampler_cls(model).make_schedule(ddim_num_steps=steps, ddim_eta=0., verbose=False)
+    if str(model.device).startswith('cuda'):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - t0) / n_calls
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, default=25, help='ddim steps, 25 is what the online loop uses')
+    parser.add_argument('--n_calls', type=int, default=200)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    model = ScheduleOnlyModel(args.device)
+    print(f'[*] make_schedule, steps={args.steps}, device={args.device}, {args.n_calls} calls')
+    for sampler_cls in [DDIMSampler, PLMSSampler]:
+        rebuilt = time_make_schedule(sampler_cls, model, args.steps, args.n_calls, cached=False)
+        cached = time_make_schedule(sampler_cls, model, args.steps, args.n_calls, cached=True)
+        print(f'{sampler_cls.__name__:12s} rebuilt: {rebuilt * 1e3:8.3f} ms/call  '
+              f'cached: {cached * 1e3:8.3f} ms/call  ({rebuilt / max(cached, 1e-12):.1f}x)')
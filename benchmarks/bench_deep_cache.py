@@ -0,0 +1,84 @@
+""" Speed / quality of cross-step UNet feature caching (DeepCache) during DDIM sampling.
+
+    python -m benchmarks.bench_deep_cache --device cuda --ckpt saved_ckpt/sdfusion-snet-all.pth --configs uncond
+    python -m benchmarks.bench_deep_cache --device cpu --steps 10 --seeds 0
+
+    per (config, branch, interval), averaged over seeds, against interval=1 (no cache) from the same x_T:
+        sec / speedup   wall time of the sampling call
+        latent          mean squared error of the final latent
+        iou             utils.util.iou of the decoded sdf (meaningful with --ckpt)
+"""
+
+import argparse
+import time
+
+import torch
+
+from models.networks.diffusion_networks.samplers.ddim import DDIMSampler
+from utils.util import iou
+
+from benchmarks.bench_util import RandomDiffusionModel, seeded_noise, sync
+
+
+CONFIGS = {
+    'uncond': ('configs/sdfusion_snet.yaml', None),
+    'txt2shape': ('configs/sdfusion-txt2shape.yaml', 'crossattn'),
+}
+
+
+def run(model, steps, x_T, c, uc, scale, branch, interval):
+    sampler = DDIMSampler(model, deep_cache_interval=interval, deep_cache_branch=branch)
+    sync(model.device)
+    t0 = time.perf_counter()
+    z, _ = sampler.sample(S=steps, batch_size=x_T.shape[0], shape=model.z_shape, conditioning=c, verbose=False,
+                          x_T=x_T, eta=0., log_every_t=None,
+                          unconditional_guidance_scale=scale, unconditional_conditioning=uc)
+    sync(model.device)
+    return z, time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--configs', type=str, nargs='+', default=list(CONFIGS.keys()), choices=list(CONFIGS.keys()))
+    parser.add_argument('--ckpt', type=str, default=None, help='checkpoint for the (single) config given in --configs')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--scale', type=float, default=3., help='cfg scale for txt2shape')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0, 1, 2, 3])
+    parser.add_argument('--intervals', type=int, nargs='+', default=[2, 3, 5])
+    parser.add_argument('--branches', type=int, nargs='+', default=[1, 2])
+    args = parser.parse_args()
+
+    with torch.no_grad():
+        for name in args.configs:
+            df_cfg, conditioning_key = CONFIGS[name]
+            model = RandomDiffusionModel(df_cfg, device=args.device, conditioning_key=conditioning_key)
+            if args.ckpt is not None:
+                model.load_ckpt(args.ckpt)
+
+            cases = []
+            for seed in args.seeds:
+                x_T = seeded_noise((1, *model.z_shape), seed, args.device)
+                c = uc = None
+                if conditioning_key is not None:
+                    c = seeded_noise((1, 77, model.context_dim), seed + 10000, args.device)
+                    uc = torch.zeros_like(c)
+                z_ref, sec_ref = run(model, args.steps, x_T, c, uc, args.scale, 1, 1)
+                cases.append((x_T, c, uc, z_ref, model.vqvae.decode_no_quant(z_ref), sec_ref))
+
+            n = len(cases)
+            ref_sec = sum(case[-1] for case in cases) / n
+            print(f'[*] {name}: ddim steps={args.steps} seeds={args.seeds} device={args.device} '
+                  f'no cache: {ref_sec:.2f}s')
+            print(f'{"branch":>6s} {"interval":>8s} {"sec":>7s} {"speedup":>7s} {"latent":>9s} {"iou":>7s}')
+            for branch in args.branches:
+                for interval in args.intervals:
+                    mse, ious, secs = [], [], []
+                    for x_T, c, uc, z_ref, sdf_ref, _ in cases:
+                        z, sec = run(model, args.steps, x_T, c, uc, args.scale, branch, interval)
+                        mse.append((z - z_ref).pow(2).mean().item())
+                        ious.append(iou(sdf_ref, model.vqvae.decode_no_quant(z), 0.).mean().item())
+                        secs.append(sec)
+                    sec = sum(secs) / n
+                    print(f'{branch:6d} {interval:8d} {sec:7.2f} {ref_sec / sec:6.2f}x '
+                          f'{sum(mse) / n:9.2e} {sum(ious) / n:7.4f}')
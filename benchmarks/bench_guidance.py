@@ -0,0 +1,112 @@
+""" UNet cost and quality of guidance windows / unconditional-branch reuse (GuidanceSchedule) vs. full CFG.
+
+    python -m benchmarks.bench_guidance --device cuda --ckpt <txt2shape ckpt> --configs txt2shape
+    python -m benchmarks.bench_guidance --device cpu --steps 10 --seeds 0 1
+
+    per (config, sampler, window, uncond_every), averaged over seeds, against full CFG from the same x_T:
+        rows    UNet batch rows evaluated per sample (full CFG with DDIM: 2 * steps)
+        saved   fraction of UNet rows, and so of UNet FLOPs, saved
+        gflops  UNet GFLOPs per sample, if torch.utils.flop_counter is available
+        latent  mean squared error of the final latent
+        iou     utils.util.iou of the decoded sdf (meaningful with --ckpt)
+"""
+
+import argparse
+import time
+
+import torch
+
+from models.networks.diffusion_networks.samplers.ddim import DDIMSampler
+from models.networks.diffusion_networks.samplers.plms import PLMSSampler
+from utils.util import iou
+
+from benchmarks.bench_util import RandomDiffusionModel, seeded_noise, sync
+
+
+CONFIGS = {
+    'txt2shape': 'configs/sdfusion-txt2shape.yaml',
+    'img2shape': 'configs/sdfusion-img2shape.yaml',
+}
+SAMPLERS = {'ddim': DDIMSampler, 'plms': PLMSSampler}
+
+
+def gflops_per_row(model, c):
+    """ UNet forward GFLOPs for one batch row, None if the flop counter is unavailable """
+    try:
+        from torch.utils.flop_counter import FlopCounterMode
+    except ImportError:
+        return None
+    x = torch.zeros(1, *model.z_shape, device=model.device)
+    t = torch.zeros(1, dtype=torch.long, device=model.device)
+    counter = FlopCounterMode(display=False)
+    with counter:
+        model.apply_model(x, t, c[:1])
+    return counter.get_total_flops() / 1e9
+
+
+def run(model, sampler_cls, steps, x_T, c, uc, scale, window, uncond_every):
+    sampler = sampler_cls(model, guidance_window=window, uncond_every=uncond_every)
+    sync(model.device)
+    t0 = time.perf_counter()
+    z, _ = sampler.sample(S=steps, batch_size=x_T.shape[0], shape=model.z_shape, conditioning=c, verbose=False,
+                          x_T=x_T, eta=0., log_every_t=steps + 1,
+                          unconditional_guidance_scale=scale, unconditional_conditioning=uc)
+    sync(model.device)
+    return z, sampler.guidance.unet_rows / x_T.shape[0], time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--configs', type=str, nargs='+', default=list(CONFIGS.keys()), choices=list(CONFIGS.keys()))
+    parser.add_argument('--ckpt', type=str, default=None, help='checkpoint for the (single) config given in --configs')
+    parser.add_argument('--samplers', type=str, nargs='+', default=['ddim', 'plms'], choices=list(SAMPLERS.keys()))
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--scale', type=float, default=3.)
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0, 1, 2, 3])
+    parser.add_argument('--windows', type=str, nargs='+', default=['all', '0,999', '0,600', '200,999'],
+                        help='"all" or t_min,t_max in ddpm timesteps')
+    parser.add_argument('--uncond_every', type=int, nargs='+', default=[1, 2, 3])
+    args = parser.parse_args()
+
+    windows = [None if w == 'all' else tuple(int(v) for v in w.split(',')) for w in args.windows]
+
+    with torch.no_grad():
+        for name in args.configs:
+            model = RandomDiffusionModel(CONFIGS[name], device=args.device, conditioning_key='crossattn')
+            if args.ckpt is not None:
+                model.load_ckpt(args.ckpt)
+
+            cases = []
+            for seed in args.seeds:
+                x_T = seeded_noise((1, *model.z_shape), seed, args.device)
+                c = seeded_noise((1, 77, model.context_dim), seed + 10000, args.device)
+                cases.append((x_T, c, torch.zeros_like(c)))
+            row_gflops = gflops_per_row(model, cases[0][1])
+
+            print(f'[*] {name}: steps={args.steps} scale={args.scale} seeds={args.seeds} device={args.device}'
+                  f' unet GFLOPs/row={row_gflops}')
+            print(f'{"sampler":8s} {"window":>10s} {"every":>5s} {"rows":>6s} {"saved":>6s} {"gflops":>9s} '
+                  f'{"latent":>9s} {"iou":>7s} {"sec":>7s}')
+            for sampler_name in args.samplers:
+                sampler_cls = SAMPLERS[sampler_name]
+                refs = [run(model, sampler_cls, args.steps, x_T, c, uc, args.scale, None, 1) for x_T, c, uc in cases]
+                ref_rows = refs[0][1]
+                ref_sdf = [model.vqvae.decode_no_quant(z) for z, _, _ in refs]
+
+                for window in windows:
+                    for every in args.uncond_every:
+                        mse, ious, rows, secs = [], [], [], []
+                        for (x_T, c, uc), (z_ref, _, _), sdf_ref in zip(cases, refs, ref_sdf):
+                            z, n_rows, sec = run(model, sampler_cls, args.steps, x_T, c, uc, args.scale, window, every)
+                            mse.append((z - z_ref).pow(2).mean().item())
+                            ious.append(iou(sdf_ref, model.vqvae.decode_no_quant(z), 0.).mean().item())
+                            rows.append(n_rows)
+                            secs.append(sec)
+                        n = len(cases)
+                        mean_rows = sum(rows) / n
+                        gflops = f'{mean_rows * row_gflops:9.1f}' if row_gflops is not None else f'{"-":>9s}'
+                        w = 'all' if window is None else f'{window[0]},{window[1]}'
+                        print(f'{sampler_name:8s} {w:>10s} {every:5d} {mean_rows:6.0f} '
+                              f'{1. - mean_rows / ref_rows:6.1%} {gflops} '
+                              f'{sum(mse) / n:9.2e} {sum(ious) / n:7.4f} {sum(secs) / n:7.2f}')
@@ -0,0 +1,103 @@
+""" Conv throughput of the contiguous (NCDHW) and channels_last_3d layouts (models.model_utils.set_memory_format).
+
+    python -m benchmarks.bench_memory_format --device cpu
+    python -m benchmarks.bench_memory_format --device cpu --threads 8 --repeats 5
+    python -m benchmarks.bench_memory_format --device cuda --precision bf16
+
+    on cpu the channels-last Conv3d kernels come from oneDNN (torch.backends.mkldnn). reported per layout:
+        conv      the 3x3x3 Conv3d shapes of the UNet torso (configs/sdfusion_snet.yaml), ms and GFLOP/s each
+        unet      one DiffusionUNet forward on a (batch, *z_shape) latent, ms
+        decode    one VQVAE.decode_no_quant, ms
+        encode    one VQVAE.encode_no_quant, ms
+        max err   max abs difference of the output against the contiguous layout
+    if channels_last_3d is not faster on a backend, keep the default --memory_format contiguous.
+"""
+
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from models.model_utils import MEMORY_FORMATS, set_memory_format, channels_last_3d_supported, autocast
+
+from benchmarks.bench_util import RandomDiffusionModel, seeded_noise, sync
+
+
+# (in_channels, out_channels, grid) of the UNet torso at model_channels=192, channel_mult=[1, 2, 4]
+CONV_SHAPES = [(192, 192, 16), (384, 384, 8), (768, 768, 4), (576, 384, 16)]
+
+
+def measure(fn, device, repeats):
+    """ mean ms of `repeats` calls after one warm-up call, and the output of the last one """
+    out = fn()
+    sync(device)
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        out = fn()
+    sync(device)
+    return (time.perf_counter() - t0) / repeats * 1e3, out
+
+
+def max_err(out, ref):
+    return (out.float() - ref.float()).abs().max().item()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--df_cfg', type=str, default='configs/sdfusion_snet.yaml')
+    parser.add_argument('--vq_cfg', type=str, default='configs/vqvae_snet.yaml')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--batch', type=int, default=2, help='2 = one guided sample')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads on cpu')
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    formats = ['contiguous', 'channels_last_3d']
+    if not channels_last_3d_supported(args.device):
+        print(f'[!] no channels-last conv3d kernels on {args.device}, only the contiguous layout runs')
+        formats = ['contiguous']
+    print(f'[*] device={args.device} precision={args.precision} batch={args.batch} '
+          f'threads={torch.get_num_threads()} mkldnn={torch.backends.mkldnn.is_available()}')
+
+    model = RandomDiffusionModel(args.df_cfg, vq_cfg=args.vq_cfg, device=args.device, precision=args.precision)
+    x = seeded_noise((args.batch, *model.z_shape), 0, args.device)
+    t = torch.full((args.batch,), 500, device=args.device, dtype=torch.long)
+
+    with torch.no_grad():
+        sdf = model.decode(x[:1])
+
+    print(f'{"layer":24s} {"layout":17s} {"ms":>9s} {"GFLOP/s":>9s} {"max err":>9s}')
+    with torch.no_grad():
+        for c_in, c_out, grid in CONV_SHAPES:
+            conv = nn.Conv3d(c_in, c_out, 3, padding=1).to(args.device)
+            inp = seeded_noise((args.batch, c_in, grid, grid, grid), 1, args.device)
+            flops = 2 * args.batch * c_out * grid ** 3 * c_in * 27
+            ref = None
+            for fmt in formats:
+                set_memory_format(conv, fmt)
+                inp_fmt = inp.contiguous(memory_format=MEMORY_FORMATS[fmt])
+                def call():
+                    with autocast(args.device, args.precision):
+                        return conv(inp_fmt)
+                ms, out = measure(call, args.device, args.repeats)
+                ref = out if ref is None else ref
+                name = f'conv {c_in}->{c_out} {grid}^3'
+                print(f'{name:24s} {fmt:17s} {ms:9.2f} {flops / ms / 1e6:9.1f} {max_err(out, ref):9.2e}')
+
+        stacks = {
+            'unet': lambda: model.apply_model(x, t, None),
+            'decode': lambda: model.decode(x),
+            'encode': lambda: model.vqvae.encode_no_quant(sdf),
+        }
+        for name, fn in stacks.items():
+            ref = None
+            for fmt in formats:
+                set_memory_format(model.df, fmt)
+                set_memory_format(model.vqvae, fmt)
+                ms, out = measure(fn, args.device, args.repeats)
+                ref = out if ref is None else ref
+                print(f'{name:24s} {fmt:17s} {ms:9.2f} {"-":>9s} {max_err(out, ref):9.2e}')
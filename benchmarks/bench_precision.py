@@ -0,0 +1,84 @@
+""" Speed and shape agreement of the --precision modes (models.model_utils.autocast) against fp32.
+
+    python -m benchmarks.bench_precision --ckpt saved_ckpt/sdfusion-snet-all.pth --device cuda
+    python -m benchmarks.bench_precision --device cpu --precisions fp32 bf16 --steps 10 --seeds 0 1
+
+    every precision starts from the same x_T per seed and samples with DDIM (eta=0). reported per precision,
+    averaged over seeds:
+        sample sec  wall time of the sampling call
+        decode sec  wall time of the vqvae decode
+        latent      mean squared error to the fp32 latent
+        iou         utils.util.iou of the decoded sdf vs. the fp32 sdf (needs --ckpt for a trained vqvae)
+    fp16 is skipped on cpu. without --ckpt the UNet and VQ-VAE are untrained, which only checks that the modes run.
+"""
+
+import argparse
+import time
+
+import torch
+
+from models.networks.diffusion_networks.samplers.ddim import DDIMSampler
+from utils.util import iou
+
+from benchmarks.bench_util import RandomDiffusionModel, seeded_noise, sync
+
+
+def timed(device, fn, *args):
+    sync(device)
+    t0 = time.perf_counter()
+    out = fn(*args)
+    sync(device)
+    return out, time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--df_cfg', type=str, default='configs/sdfusion_snet.yaml')
+    parser.add_argument('--vq_cfg', type=str, default='configs/vqvae_snet.yaml')
+    parser.add_argument('--ckpt', type=str, default=None, help='SDFusionModel checkpoint with df and vqvae weights')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--precisions', type=str, nargs='+', default=['fp32', 'bf16', 'fp16'],
+                        choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0, 1, 2, 3])
+    parser.add_argument('--steps', type=int, default=50)
+    args = parser.parse_args()
+
+    model = RandomDiffusionModel(args.df_cfg, vq_cfg=args.vq_cfg, device=args.device)
+    if args.ckpt is not None:
+        model.load_ckpt(args.ckpt)
+
+    def sample(x_T):
+        z, _ = DDIMSampler(model).sample(S=args.steps, batch_size=x_T.shape[0], shape=model.z_shape,
+                                         conditioning=None, verbose=False, x_T=x_T, eta=0.,
+                                         log_every_t=args.steps + 1)
+        return z
+
+    print(f'[*] DDIM {args.steps} steps, {len(args.seeds)} seeds, device={args.device}')
+    print(f'{"precision":9s} {"sample sec":>10s} {"decode sec":>10s} {"latent":>10s} {"iou":>7s}')
+    refs = {}
+    with torch.no_grad():
+        for precision in ['fp32'] + [p for p in args.precisions if p != 'fp32']:
+            if precision == 'fp16' and not str(args.device).startswith('cuda'):
+                print(f'{precision:9s} skipped (cuda only)')
+                continue
+            model.precision = precision
+            # one warm-up run, so autocast / cudnn setup is not timed
+            sample(seeded_noise((1, *model.z_shape), args.seeds[0], args.device))
+
+            s_secs, d_secs, mse, ious = [], [], [], []
+            for seed in args.seeds:
+                x_T = seeded_noise((1, *model.z_shape), seed, args.device)
+                z, s_sec = timed(args.device, sample, x_T)
+                sdf, d_sec = timed(args.device, model.decode, z)
+                if precision == 'fp32':
+                    refs[seed] = (z, sdf)
+                z_ref, sdf_ref = refs[seed]
+                s_secs.append(s_sec)
+                d_secs.append(d_sec)
+                mse.append((z - z_ref).pow(2).mean().item())
+                ious.append(iou(sdf_ref, sdf, 0.).mean().item())
+
+            if precision in args.precisions:
+                n = len(args.seeds)
+                print(f'{precision:9s} {sum(s_secs) / n:10.2f} {sum(d_secs) / n:10.2f} '
+                      f'{sum(mse) / n:10.2e} {sum(ious) / n:7.4f}')
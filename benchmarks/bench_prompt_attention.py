@@ -0,0 +1,101 @@
+""" Latency / memory of the einsum and the fused (scaled_dot_product_attention) paths of QKVPromptAttention.
+
+    python -m benchmarks.bench_prompt_attention --device cuda
+    python -m benchmarks.bench_prompt_attention --device cpu --grids 8 --repeats 5
+
+    per (grid, path), for one attention call on grid^3 main tokens + prompt_len prompt tokens:
+        fwd ms      forward latency (no grad, as in sampling)
+        fwd+bwd ms  forward + backward latency (as in prompt training)
+        fwd MB      peak memory of the forward above the inputs (cuda only)
+        bwd MB      peak memory of forward + backward above the inputs (cuda only)
+        max err     max abs difference of output and gate gradient against the einsum path
+"""
+
+import argparse
+import time
+
+import torch
+
+from models.networks.diffusion_networks.openai_model_3d import QKVPromptAttention
+
+from benchmarks.bench_util import sync
+
+
+def make_inputs(batch, channels, n_tokens, prompt_len, device, dtype, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    qkv = torch.randn(3, batch, channels, n_tokens + prompt_len, generator=g).to(device, dtype)
+    return [t.clone().requires_grad_(True) for t in qkv]
+
+
+def measure(attn, q, k, v, backward, repeats, device):
+    """ mean ms and peak MB (None on cpu) of `repeats` calls, after one warm-up call """
+    def call():
+        if backward:
+            out = attn(q, k, v)
+            out.float().pow(2).mean().backward()
+        else:
+            with torch.no_grad():
+                out = attn(q, k, v)
+        return out
+
+    call()
+    cuda = str(device).startswith('cuda')
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated() if cuda else 0
+    sync(device)
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        call()
+    sync(device)
+    ms = (time.perf_counter() - t0) / repeats * 1e3
+    mb = (torch.cuda.max_memory_allocated() - base) / 2 ** 20 if cuda else None
+    return ms, mb
+
+
+def output_and_grad(attn, q, k, v):
+    for t in [q, k, v, attn.gate_logit]:
+        t.grad = None
+    out = attn(q, k, v)
+    out.float().pow(2).mean().backward()
+    return out.detach(), attn.gate_logit.grad.detach().clone()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16', 'bfloat16'])
+    parser.add_argument('--grids', type=int, nargs='+', default=[8, 16])
+    parser.add_argument('--batch', type=int, default=2, help='2 = one guided sample')
+    parser.add_argument('--channels', type=int, default=768, help='configs/sdfusion_snet.yaml: 192 * 4 at 4x downsampling')
+    parser.add_argument('--heads', type=int, default=6)
+    parser.add_argument('--prompt_len', type=int, default=8)
+    parser.add_argument('--gate_logit', type=float, default=0., help='-20 is the init (prompts off), 0 is g = 0.5')
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    dtype = getattr(torch, args.dtype)
+    paths = {}
+    for name, use_sdpa in [('einsum', False), ('sdpa', True)]:
+        attn = QKVPromptAttention(args.heads, args.prompt_len, init_gate_logit=args.gate_logit, use_sdpa=use_sdpa)
+        paths[name] = attn.to(args.device, dtype)
+
+    print(f'[*] device={args.device} dtype={args.dtype} batch={args.batch} channels={args.channels} '
+          f'heads={args.heads} prompt_len={args.prompt_len} gate_logit={args.gate_logit}')
+    print(f'{"grid":>5s} {"path":8s} {"fwd ms":>9s} {"fwd+bwd ms":>11s} {"fwd MB":>9s} {"bwd MB":>9s} {"max err":>9s}')
+    for grid in args.grids:
+        n_tokens = grid ** 3
+        q, k, v = make_inputs(args.batch, args.channels, n_tokens, args.prompt_len, args.device, dtype)
+        ref = None
+        for name, attn in paths.items():
+            attn.T_main = n_tokens
+            out, g_grad = output_and_grad(attn, q, k, v)
+            if ref is None:
+                ref = (out, g_grad)
+            err = max((out - ref[0]).abs().max().item(), (g_grad - ref[1]).abs().item())
+
+            fwd_ms, fwd_mb = measure(attn, q, k, v, False, args.repeats, args.device)
+            bwd_ms, bwd_mb = measure(attn, q, k, v, True, args.repeats, args.device)
+            fmt_mb = lambda mb: f'{mb:9.1f}' if mb is not None else f'{"-":>9s}'
+            print(f'{grid:4d}^3 {name:8s} {fwd_ms:9.2f} {bwd_ms:11.2f} {fmt_mb(fwd_mb)} {fmt_mb(bwd_mb)} {err:9.2e}')
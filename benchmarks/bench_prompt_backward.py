@@ -0,0 +1,102 @@
+""" Peak memory and latency of one soft-prompt training step (eps loss + backward) per backward mode and batch size.
+
+    python -m benchmarks.bench_prompt_backward --device cuda --batches 4 8 16 32
+    python -m benchmarks.bench_prompt_backward --device cpu --batches 1 2 --repeats 2
+
+    the UNet is frozen and only the SoftPrompt3D banks train, as in SDFusionModel. modes:
+        config      use_checkpoint as in --df_cfg, no lean backward (the default training setup)
+        lean-none   set_lean_backward(checkpoint='none')
+        lean-attn   set_lean_backward(checkpoint='attn'), the --lean_checkpoint default
+        lean-all    set_lean_backward(checkpoint='all')
+    reported per (mode, batch):
+        ms          forward + backward latency
+        peak MB     peak memory of the step above the model weights (cuda only), OOM if it does not fit
+        max err     max abs difference of the prompt gradients against the config mode
+"""
+
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from models.networks.diffusion_networks.openai_model_3d import ResBlock, set_lean_backward
+from models.networks.diffusion_networks.prompt import SoftPrompt3D
+
+from benchmarks.bench_util import RandomDiffusionModel, seeded_noise, sync
+
+
+MODES = ['config', 'lean-none', 'lean-attn', 'lean-all']
+
+
+def configure(model, mode, config_flags):
+    if mode == 'config':
+        set_lean_backward(model.df, enabled=False, checkpoint='none')
+        for block, flag in config_flags.items():
+            block.use_checkpoint = flag
+    else:
+        set_lean_backward(model.df, checkpoint=mode.split('-')[1])
+
+
+def step(model, prompts, z0, t, noise):
+    """ p_losses without the bookkeeping: simple eps loss, backward into the prompt banks """
+    for p in prompts:
+        p.grad = None
+    z_noisy = model.q_sample(z0, t, noise=noise)
+    loss = F.mse_loss(model.apply_model(z_noisy, t, None), noise)
+    loss.backward()
+    return torch.cat([p.grad.flatten() for p in prompts])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--df_cfg', type=str, default='configs/sdfusion_snet.yaml')
+    parser.add_argument('--vq_cfg', type=str, default='configs/vqvae_snet.yaml')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--modes', type=str, nargs='+', default=MODES, choices=MODES)
+    parser.add_argument('--batches', type=int, nargs='+', default=[4, 8, 16, 32])
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    model = RandomDiffusionModel(args.df_cfg, vq_cfg=args.vq_cfg, device=args.device)
+    model.df.requires_grad_(False)
+    prompts = []
+    for module in model.df.modules():
+        if isinstance(module, SoftPrompt3D):
+            module.requires_grad_(True)
+            prompts += list(module.parameters())
+    config_flags = {m: m.use_checkpoint for m in model.df.modules() if isinstance(m, ResBlock)}
+    cuda = str(args.device).startswith('cuda')
+
+    print(f'[*] device={args.device} {len(prompts)} prompt tensors, '
+          f'{sum(p.numel() for p in prompts)} trainable parameters')
+    print(f'{"mode":10s} {"batch":>5s} {"ms":>9s} {"peak MB":>9s} {"max err":>9s}')
+    for batch in args.batches:
+        z0 = seeded_noise((batch, *model.z_shape), 0, args.device)
+        noise = seeded_noise((batch, *model.z_shape), 1, args.device)
+        t = torch.randint(0, model.num_timesteps, (batch,), generator=torch.Generator().manual_seed(2))
+        t = t.to(args.device)
+
+        ref = None
+        for mode in args.modes:
+            configure(model, mode, config_flags)
+            try:
+                grad = step(model, prompts, z0, t, noise)
+                if cuda:
+                    torch.cuda.synchronize()
+                    torch.cuda.reset_peak_memory_stats()
+                base = torch.cuda.memory_allocated() if cuda else 0
+                sync(args.device)
+                t0 = time.perf_counter()
+                for _ in range(args.repeats):
+                    step(model, prompts, z0, t, noise)
+                sync(args.device)
+                ms = (time.perf_counter() - t0) / args.repeats * 1e3
+            except torch.cuda.OutOfMemoryError:
+                torch.cuda.empty_cache()
+                print(f'{mode:10s} {batch:5d} {"OOM":>9s}')
+                continue
+
+            mb = f'{(torch.cuda.max_memory_allocated() - base) / 2 ** 20:9.1f}' if cuda else f'{"-":>9s}'
+            ref = grad if ref is None else ref
+            print(f'{mode:10s} {batch:5d} {ms:9.1f} {mb} {(grad - ref).abs().max().item():9.2e}')
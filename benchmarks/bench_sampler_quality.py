@@ -0,0 +1,90 @@
+""" Quality vs. steps of the few-step samplers against a 200-step DDIM reference, on a fixed seed set.
+
+    python -m benchmarks.bench_sampler_quality --ckpt saved_ckpt/sdfusion-snet-all.pth --device cuda
+    python -m benchmarks.bench_sampler_quality --df_cfg configs/sdfusion-txt2shape.yaml --ckpt <txt2shape ckpt> --uc_scale 3
+
+    every sampler starts from the same x_T per seed. reported per (sampler, steps), averaged over seeds:
+        latent  mean squared error to the reference latent
+        iou     utils.util.iou of the decoded sdf vs. the decoded reference (needs --ckpt for a trained vqvae)
+        chamfer symmetric chamfer distance in voxels between occupied voxels
+        sec     wall time of the sampling call
+    without --ckpt the UNet and VQ-VAE are untrained, which only checks that the samplers run.
+"""
+
+import argparse
+import time
+
+import torch
+
+from models.networks.diffusion_networks.samplers.ddim import DDIMSampler
+from models.networks.diffusion_networks.samplers.plms import PLMSSampler
+from models.networks.diffusion_networks.samplers.dpm_solver import DPMSolverSampler
+from utils.util import iou
+
+from benchmarks.bench_util import RandomDiffusionModel, seeded_noise, sdf_chamfer, sync
+
+
+SAMPLERS = {
+    'ddim': lambda model: DDIMSampler(model),
+    'plms': lambda model: PLMSSampler(model),
+    'dpm++2m': lambda model: DPMSolverSampler(model, order=2),
+    'dpm++3m': lambda model: DPMSolverSampler(model, order=3),
+}
+
+
+def sample(model, sampler, steps, x_T, c, uc, scale):
+    sync(model.device)
+    t0 = time.perf_counter()
+    z, _ = sampler.sample(S=steps, batch_size=x_T.shape[0], shape=model.z_shape, conditioning=c,
+                          verbose=False, x_T=x_T, eta=0., log_every_t=steps + 1,
+                          unconditional_guidance_scale=scale, unconditional_conditioning=uc)
+    sync(model.device)
+    return z, time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--df_cfg', type=str, default='configs/sdfusion_snet.yaml')
+    parser.add_argument('--vq_cfg', type=str, default='configs/vqvae_snet.yaml')
+    parser.add_argument('--ckpt', type=str, default=None, help='SDFusionModel checkpoint with df and vqvae weights')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0, 1, 2, 3, 4, 5, 6, 7])
+    parser.add_argument('--steps', type=int, nargs='+', default=[10, 15, 20, 25, 50])
+    parser.add_argument('--ref_steps', type=int, default=200)
+    parser.add_argument('--samplers', type=str, nargs='+', default=list(SAMPLERS.keys()), choices=list(SAMPLERS.keys()))
+    parser.add_argument('--uc_scale', type=float, default=1., help='cfg scale, only used with a cross-attention config')
+    args = parser.parse_args()
+
+    crossattn = 'txt2shape' in args.df_cfg or 'img2shape' in args.df_cfg
+    model = RandomDiffusionModel(args.df_cfg, vq_cfg=args.vq_cfg, device=args.device,
+                                 conditioning_key='crossattn' if crossattn else None)
+    if args.ckpt is not None:
+        model.load_ckpt(args.ckpt)
+
+    with torch.no_grad():
+        # fixed per-seed noise and (for cross-attention configs) a fixed random context
+        cases = []
+        for seed in args.seeds:
+            x_T = seeded_noise((1, *model.z_shape), seed, args.device)
+            c = uc = None
+            if crossattn:
+                c = seeded_noise((1, 77, model.context_dim), seed + 10000, args.device)
+                uc = torch.zeros_like(c)
+            z_ref, _ = sample(model, DDIMSampler(model), args.ref_steps, x_T, c, uc, args.uc_scale)
+            cases.append((x_T, c, uc, z_ref, model.vqvae.decode_no_quant(z_ref)))
+
+        print(f'[*] reference: DDIM {args.ref_steps} steps, {len(cases)} seeds, device={args.device}')
+        print(f'{"sampler":10s} {"steps":>5s} {"latent":>10s} {"iou":>7s} {"chamfer":>8s} {"sec":>7s}')
+        for name in args.samplers:
+            for steps in args.steps:
+                mse, ious, cds, secs = [], [], [], []
+                for x_T, c, uc, z_ref, sdf_ref in cases:
+                    z, sec = sample(model, SAMPLERS[name](model), steps, x_T, c, uc, args.uc_scale)
+                    sdf = model.vqvae.decode_no_quant(z)
+                    mse.append((z - z_ref).pow(2).mean().item())
+                    ious.append(iou(sdf_ref, sdf, 0.).mean().item())
+                    cds.append(sdf_chamfer(sdf_ref[0], sdf[0]))
+                    secs.append(sec)
+                n = len(cases)
+                print(f'{name:10s} {steps:5d} {sum(mse) / n:10.2e} {sum(ious) / n:7.4f} '
+                      f'{sum(cds) / n:8.3f} {sum(secs) / n:7.2f}')
@@ -0,0 +1,91 @@
+""" Speed and shape agreement of ToMe token merging in the UNet self-attention (set_token_merging) against no merging.
+
+    python -m benchmarks.bench_token_merging --ckpt saved_ckpt/sdfusion-snet-all.pth --device cuda
+    python -m benchmarks.bench_token_merging --device cpu --ratios 0.25 0.5 --steps 10 --seeds 0 1
+
+    every ratio starts from the same x_T per seed and samples with DDIM (eta=0). the ratio applies to every
+    attention block, unless --per_block gives one ratio per block. reported per ratio, averaged over seeds:
+        unet ms     one UNet forward on a guided batch (2 latents)
+        sample sec  wall time of the sampling call
+        latent      mean squared error to the latent without merging
+        iou         utils.util.iou of the decoded sdf vs. the one without merging (needs --ckpt)
+    without --ckpt the UNet and VQ-VAE are untrained, which only checks that merging runs.
+"""
+
+import argparse
+import time
+
+import torch
+
+from models.networks.diffusion_networks.openai_model_3d import set_token_merging
+from models.networks.diffusion_networks.samplers.ddim import DDIMSampler
+from utils.util import iou
+
+from benchmarks.bench_util import RandomDiffusionModel, seeded_noise, sync
+
+
+def timed(device, fn, *args):
+    sync(device)
+    t0 = time.perf_counter()
+    out = fn(*args)
+    sync(device)
+    return out, time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--df_cfg', type=str, default='configs/sdfusion_snet.yaml')
+    parser.add_argument('--vq_cfg', type=str, default='configs/vqvae_snet.yaml')
+    parser.add_argument('--ckpt', type=str, default=None, help='SDFusionModel checkpoint with df and vqvae weights')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--ratios', type=float, nargs='+', default=[0.1, 0.25, 0.4, 0.5])
+    parser.add_argument('--per_block', type=float, nargs='+', default=None, help='one ratio per attention block, run as an extra row')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0, 1, 2, 3])
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    model = RandomDiffusionModel(args.df_cfg, vq_cfg=args.vq_cfg, device=args.device)
+    if args.ckpt is not None:
+        model.load_ckpt(args.ckpt)
+
+    def sample(x_T):
+        z, _ = DDIMSampler(model).sample(S=args.steps, batch_size=x_T.shape[0], shape=model.z_shape,
+                                         conditioning=None, verbose=False, x_T=x_T, eta=0.,
+                                         log_every_t=args.steps + 1)
+        return z
+
+    def unet_ms(x, t):
+        model.apply_model(x, t, None)
+        sync(args.device)
+        t0 = time.perf_counter()
+        for _ in range(args.repeats):
+            model.apply_model(x, t, None)
+        sync(args.device)
+        return (time.perf_counter() - t0) / args.repeats * 1e3
+
+    settings = [('0', 0.)] + [(f'{r:g}', r) for r in args.ratios if r > 0]
+    if args.per_block is not None:
+        settings.append(('per-block', args.per_block))
+
+    x = seeded_noise((2, *model.z_shape), 0, args.device)
+    t = torch.full((2,), 500, device=args.device, dtype=torch.long)
+    print(f'[*] DDIM {args.steps} steps, {len(args.seeds)} seeds, device={args.device}')
+    print(f'{"ratio":10s} {"unet ms":>9s} {"sample sec":>10s} {"latent":>10s} {"iou":>7s}')
+    refs = {}
+    with torch.no_grad():
+        for name, ratio in settings:
+            set_token_merging(model.df, ratio)
+            ms = unet_ms(x, t)
+            secs, mse, ious = [], [], []
+            for seed in args.seeds:
+                z, sec = timed(args.device, sample, seeded_noise((1, *model.z_shape), seed, args.device))
+                sdf = model.decode(z)
+                if name == '0':
+                    refs[seed] = (z, sdf)
+                z_ref, sdf_ref = refs[seed]
+                secs.append(sec)
+                mse.append((z - z_ref).pow(2).mean().item())
+                ious.append(iou(sdf_ref, sdf, 0.).mean().item())
+            n = len(args.seeds)
+            print(f'{name:10s} {ms:9.2f} {sum(secs) / n:10.2f} {sum(mse) / n:10.2e} {sum(ious) / n:7.4f}')
@@ -0,0 +1,97 @@
+""" Randomly initialised stand-ins for the diffusion models, so sampler benchmarks run without checkpoints or SOFA. """
+
+import torch
+from omegaconf import OmegaConf
+
+from models.networks.diffusion_networks.network import DiffusionUNet
+from models.networks.vqvae_networks.network import VQVAE
+from models.networks.diffusion_networks.ldm_diffusion_util import extract_into_tensor
+from models.model_utils import autocast
+
+from benchmarks.bench_ddim_schedule import ScheduleOnlyModel
+
+
+class RandomDiffusionModel(ScheduleOnlyModel):
+    """ the sampling surface of SDFusionModel (schedule, df, apply_model, q_sample) around an untrained DiffusionUNet """
+    def __init__(self, df_cfg, vq_cfg='configs/vqvae_snet.yaml', device='cpu', conditioning_key=None, precision='fp32'):
+        df_conf = OmegaConf.load(df_cfg)
+        vq_conf = OmegaConf.load(vq_cfg)
+        model_params = df_conf.model.params
+        super().__init__(device, timesteps=model_params.timesteps,
+                         linear_start=model_params.linear_start, linear_end=model_params.linear_end)
+
+        ddconfig = vq_conf.model.params.ddconfig
+        z_sp_dim = ddconfig.resolution // (2 ** (len(ddconfig.ch_mult) - 1))
+        self.z_shape = (ddconfig.z_channels, z_sp_dim, z_sp_dim, z_sp_dim)
+        self.context_dim = df_conf.unet.params.get('context_dim', None)
+        self.precision = precision
+
+        self.parameterization = 'eps'
+        self.sqrt_alphas_cumprod = self.alphas_cumprod.sqrt()
+        self.sqrt_one_minus_alphas_cumprod = (1. - self.alphas_cumprod).sqrt()
+
+        self.df = DiffusionUNet(df_conf.unet.params, vq_conf=vq_conf, conditioning_key=conditioning_key)
+        self.df.to(device).eval()
+        self.df_module = self.df
+
+        vq_params = vq_conf.model.params
+        self.vqvae = VQVAE(ddconfig, vq_params.n_embed, vq_params.embed_dim)
+        self.vqvae.to(device).eval()
+
+    def load_ckpt(self, ckpt):
+        """ same keys as SDFusionModel.save / load_ckpt, so trained weights can replace the random ones """
+        state_dict = torch.load(ckpt, map_location=lambda storage, loc: storage)
+        self.df.load_state_dict(state_dict['df'], strict=False)
+        if 'vqvae' in state_dict:
+            self.vqvae.load_state_dict(state_dict['vqvae'])
+        print(f'[*] weight successfully load from: {ckpt}')
+
+    def apply_model(self, x_noisy, t, cond, return_ids=False):
+        # same dispatch as SDFusionModel.apply_model
+        if not isinstance(cond, dict):
+            if not isinstance(cond, list):
+                cond = [cond]
+            key = 'c_concat' if self.df_module.conditioning_key == 'concat' else 'c_crossattn'
+            cond = {key: cond}
+
+        with autocast(self.device, self.precision):
+            out = self.df(x_noisy, t, **cond)
+        if isinstance(out, tuple):
+            out = tuple(o.float() for o in out)
+            return out if return_ids else out[0]
+        return out.float()
+
+    def decode(self, z):
+        """ SDFusionModel.decode """
+        with autocast(self.device, self.precision):
+            return self.vqvae.decode_no_quant(z).float()
+
+    def q_sample(self, x_start, t, noise=None):
+        if noise is None:
+            noise = torch.randn_like(x_start)
+        return (extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start +
+                extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * noise)
+
+
+def sync(device):
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def seeded_noise(shape, seed, device):
+    g = torch.Generator().manual_seed(seed)
+    return torch.randn(shape, generator=g).to(device)
+
+
+def sdf_chamfer(sdf_a, sdf_b, thres=0., max_points=4096):
+    """ symmetric chamfer distance (in voxels) between the occupied voxels (sdf <= thres) of two (1, D, H, W) grids """
+    pts = []
+    for sdf in [sdf_a, sdf_b]:
+        p = torch.nonzero(sdf[0] <= thres).float()
+        if p.shape[0] > max_points:
+            p = p[torch.randperm(p.shape[0], generator=torch.Generator().manual_seed(0))[:max_points].to(p.device)]
+        pts.append(p)
+    if pts[0].shape[0] == 0 or pts[1].shape[0] == 0:
+        return float('nan')
+    d = torch.cdist(pts[0], pts[1])
+    return (d.min(dim=1)[0].mean() + d.min(dim=0)[0].mean()).item()
@@ -0,0 +1,103 @@
+""" Progressive distillation of the unconditional SDFusion UNet into a few-step student (models/distillation.py).
+
+    python distill.py --ckpt saved_ckpt/sdfusion-snet-all.pth --start_steps 64 --final_steps 4 --out_dir saved_ckpt/distill
+    python distill.py --toy --device cpu --start_steps 16 --final_steps 4 --iters 200 --pool 64
+
+    the training latents are samples of the teacher itself (data-free): --pool latents are drawn once with
+    2 * start_steps DDIM steps. each round saves student_<n>steps.pth (df + vqvae + distill_steps), which
+    SDFusionModel loads with --student_ckpt, or models.distillation.load_student on any SDFusion model.
+
+    --toy swaps in a small random UNet on 8^3 latents, so the whole pipeline runs on a CPU in minutes. after each
+    round it prints, over fixed seeds, the latent mse to the start_steps teacher of
+        student   the distilled student with n steps
+        ddim      the original teacher with n steps, i.e. what the student has to beat
+"""
+
+import os
+import argparse
+
+from omegaconf import OmegaConf
+from termcolor import cprint
+
+import torch
+
+from models.networks.diffusion_networks.network import DiffusionUNet
+from models.networks.diffusion_networks.ldm_diffusion_util import sdfusion_alphas_cumprod
+from models.distillation import ProgressiveDistiller, save_student
+
+
+# small enough for a CPU, same block types as configs/sdfusion_snet.yaml
+TOY_UNET = dict(image_size=8, model_channels=32, num_res_blocks=1, attention_resolutions=[2],
+                channel_mult=[1, 2], num_heads=2)
+TOY_Z_RES = 8
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--df_cfg', type=str, default='configs/sdfusion_snet.yaml')
+    parser.add_argument('--vq_cfg', type=str, default='configs/vqvae_snet.yaml')
+    parser.add_argument('--ckpt', type=str, default=None, help='teacher SDFusionModel checkpoint')
+    parser.add_argument('--toy', action='store_true', help='small random teacher on 8^3 latents')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--start_steps', type=int, default=64, help='ddim steps of the teacher')
+    parser.add_argument('--final_steps', type=int, default=4, help='ddim steps of the last student')
+    parser.add_argument('--iters', type=int, default=5000, help='optimizer steps per round')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--pool', type=int, default=512, help='# of teacher samples to train on')
+    parser.add_argument('--lr', type=float, default=1e-4)
+    parser.add_argument('--train_prompts', action='store_true', help='also train the SoftPrompt3D banks')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0, 1, 2, 3])
+    parser.add_argument('--out_dir', type=str, default='saved_ckpt/distill')
+    args = parser.parse_args()
+
+    df_conf = OmegaConf.load(args.df_cfg)
+    vq_conf = OmegaConf.load(args.vq_cfg)
+    ddconfig = vq_conf.model.params.ddconfig
+    unet_params = df_conf.unet.params
+    z_res = ddconfig.resolution // (2 ** (len(ddconfig.ch_mult) - 1))
+    if args.toy:
+        unet_params = OmegaConf.merge(unet_params, TOY_UNET)
+        z_res = TOY_Z_RES
+    z_shape = (ddconfig.z_channels, z_res, z_res, z_res)
+
+    # the schedule SDFusionModel samples on, not the df yaml's
+    alphas_cumprod = sdfusion_alphas_cumprod()
+
+    teacher = DiffusionUNet(unet_params, vq_conf=vq_conf)
+    vqvae_state_dict = None
+    if args.ckpt is not None:
+        state_dict = torch.load(args.ckpt, map_location=lambda storage, loc: storage)
+        teacher.load_state_dict(state_dict['df'], strict=False)
+        vqvae_state_dict = state_dict.get('vqvae', None)
+        cprint(f'[*] teacher successfully load from: {args.ckpt}', 'blue')
+    teacher.to(args.device).eval().requires_grad_(False)
+
+    distiller = ProgressiveDistiller(teacher, alphas_cumprod, lr=args.lr, train_prompts=args.train_prompts)
+
+    # data-free: train on the teacher's own samples
+    pool = []
+    for i in range(0, args.pool, args.batch_size):
+        x_T = torch.randn(min(args.batch_size, args.pool - i), *z_shape, device=args.device)
+        pool.append(distiller.sample(teacher, 2 * args.start_steps, x_T))
+    pool = torch.cat(pool)
+    cprint(f'[*] {pool.shape[0]} teacher samples with {2 * args.start_steps} steps', 'blue')
+
+    def data_fn():
+        idx = torch.randint(0, pool.shape[0], (args.batch_size,), device=pool.device)
+        return pool[idx], None
+
+    x_T = torch.stack([torch.randn(z_shape, generator=torch.Generator().manual_seed(s)) for s in args.seeds])
+    x_T = x_T.to(args.device)
+    z_ref = distiller.sample(teacher, args.start_steps, x_T)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    def callback(student, n_steps):
+        path = os.path.join(args.out_dir, f'student_{n_steps}steps.pth')
+        save_student(path, student, n_steps, vqvae_state_dict=vqvae_state_dict)
+        mse_student = (distiller.sample(student, n_steps, x_T) - z_ref).pow(2).mean().item()
+        mse_ddim = (distiller.sample(teacher, n_steps, x_T) - z_ref).pow(2).mean().item()
+        cprint(f'[*] {n_steps} steps: student {mse_student:.4e}  ddim {mse_ddim:.4e}  -> {path}', 'blue')
+
+    distiller.run(data_fn, start_steps=args.start_steps, final_steps=args.final_steps, iters=args.iters,
+                  callback=callback)
@@ -0,0 +1,70 @@
+""" Static FLOP / memory estimate of a sampling run from the configs alone (models/cost_model.py).
+
+    python estimate_cost.py --df_cfg configs/sdfusion_snet.yaml --batch 4 --steps 100
+    python estimate_cost.py --df_cfg configs/sdfusion-txt2shape.yaml --cfg cfg --precision fp16 --json cost.json
+
+    per block of the UNet (one call) and of the VQ-VAE decoding path:
+        GFLOPs      2 * multiply-accumulates
+        params MB   fp32 weights
+        out MB      the activation the block returns
+        live MB     activations alive at the block's high-water mark (skips included), '-' for attention rows
+                    nested in a block (counted in the block)
+    then the totals of the run: `steps` UNet calls on the guided batch and one decode.
+"""
+
+import argparse
+import json
+
+from models.cost_model import ACT_BYTES, CFG_MODES, CONTEXT_LEN, PROMPT_LEN, estimate
+
+MB = 2 ** 20
+
+
+def print_rows(rows):
+    print(f'{"block":28s} {"kind":24s} {"shape":>22s} {"GFLOPs":>9s} {"params MB":>10s} {"out MB":>9s} {"live MB":>9s}')
+    for r in rows:
+        name = ('  ' + r['name']) if r['nested'] else r['name']
+        live = '-' if r['live'] is None else f'{r["live"] / MB:9.1f}'
+        print(f'{name:28s} {r["kind"]:24s} {str(r["shape"]):>22s} {2 * r["macs"] / 1e9:9.2f} '
+              f'{4 * r["params"] / MB:10.2f} {r["out"] / MB:9.1f} {live:>9s}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--df_cfg', type=str, default='configs/sdfusion_snet.yaml')
+    parser.add_argument('--vq_cfg', type=str, default='configs/vqvae_snet.yaml')
+    parser.add_argument('--batch', type=int, default=1, help='# of shapes per sampling run')
+    parser.add_argument('--steps', type=int, default=100, help='ddim steps (UNet calls)')
+    parser.add_argument('--cfg', type=str, default='none', choices=list(CFG_MODES),
+                        help='cfg: classifier-free guidance, conditional and unconditional rows in one UNet call')
+    parser.add_argument('--precision', type=str, default='fp32', choices=list(ACT_BYTES))
+    parser.add_argument('--prompt_len', type=int, default=PROMPT_LEN, help='soft prompt tokens per attention block')
+    parser.add_argument('--context_len', type=int, default=CONTEXT_LEN, help='conditioning tokens (cross-attention)')
+    parser.add_argument('--attn_mem_budget', type=int, default=None,
+                        help='MB, query chunking budget of the cross-attention (0: no chunking)')
+    parser.add_argument('--tome_ratio', type=float, default=0., help='token merging ratio of the self-attention')
+    parser.add_argument('--json', type=str, default=None, help='also dump the rows and totals here')
+    args = parser.parse_args()
+
+    kwargs = {}
+    if args.attn_mem_budget is not None:
+        kwargs['attn_mem_budget'] = args.attn_mem_budget * MB if args.attn_mem_budget > 0 else None
+    cost = estimate(args.df_cfg, args.vq_cfg, batch=args.batch, steps=args.steps, cfg=args.cfg,
+                    precision=args.precision, prompt_len=args.prompt_len, context_len=args.context_len,
+                    merge_ratio=args.tome_ratio, **kwargs)
+
+    print(f'[*] UNet, one call on {cost["unet_batch"]} x {cost["z_shape"]} ({args.precision})')
+    print_rows(cost['unet'])
+    print(f'\n[*] VQ-VAE decode of {args.batch} latents')
+    print_rows(cost['decoder'])
+    print(f'\n[*] {args.steps} steps, cfg={args.cfg}, batch {args.batch}')
+    print(f'    UNet        {cost["unet_flops"] / 1e9:10.1f} GFLOPs / call   x {args.steps}')
+    print(f'    decode      {cost["decode_flops"] / 1e9:10.1f} GFLOPs')
+    print(f'    run         {cost["run_flops"] / 1e12:10.2f} TFLOPs')
+    print(f'    params      {cost["unet_param_bytes"] / MB:10.1f} MB UNet, {cost["decoder_param_bytes"] / MB:.1f} MB VQ-VAE')
+    print(f'    peak act.   {cost["unet_peak_bytes"] / MB:10.1f} MB sampling, {cost["decode_peak_bytes"] / MB:.1f} MB decode')
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(cost, f, indent=1)
+        print(f'[*] saved to: {args.json}')
@@ -0,0 +1,73 @@
+""" Export the unconditional SDFusion sampler (DDIM step + VQ-VAE decoder) as standalone graphs (models/export.py).
+
+    python export.py --ckpt saved_ckpt/sdfusion-snet-all.pth --out_dir saved_ckpt/export --ddim_steps 100
+    python export.py --ckpt saved_ckpt/student_4steps.pth --vq_ckpt saved_ckpt/vqvae-snet-all.pth \
+        --ddim_steps 4 --discretize trailing --format onnx
+
+    the SoftPrompt3D banks of --ckpt are baked into the graphs. the export is run once through sdf_runtime.py and
+    compared against the same DDIM loop on the original modules (same x_T):
+        latent      max abs difference of the samples
+        sdf         max abs difference of the decoded sdfs
+"""
+
+import argparse
+from types import SimpleNamespace
+
+from omegaconf import OmegaConf
+from termcolor import cprint
+
+import torch
+
+from models.model_utils import load_vqvae
+from models.networks.diffusion_networks.network import DiffusionUNet
+from models.networks.diffusion_networks.ldm_diffusion_util import sdfusion_alphas_cumprod
+from models.export import FORMATS, DDIMStep, export_sampler
+from sdf_runtime import SDFGenerator
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--df_cfg', type=str, default='configs/sdfusion_snet.yaml')
+    parser.add_argument('--vq_cfg', type=str, default='configs/vqvae_snet.yaml')
+    parser.add_argument('--ckpt', type=str, required=True, help='SDFusionModel checkpoint (df, and vqvae unless --vq_ckpt)')
+    parser.add_argument('--vq_ckpt', type=str, default=None)
+    parser.add_argument('--ddim_steps', type=int, default=100)
+    parser.add_argument('--discretize', type=str, default='uniform', choices=['uniform', 'quad', 'trailing'])
+    parser.add_argument('--format', type=str, default='torchscript', choices=FORMATS)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out_dir', type=str, default='saved_ckpt/export')
+    args = parser.parse_args()
+
+    df_conf = OmegaConf.load(args.df_cfg)
+    vq_conf = OmegaConf.load(args.vq_cfg)
+    ddconfig = vq_conf.model.params.ddconfig
+    z_res = ddconfig.resolution // (2 ** (len(ddconfig.ch_mult) - 1))
+    z_shape = (ddconfig.z_channels, z_res, z_res, z_res)
+
+    df = DiffusionUNet(df_conf.unet.params, vq_conf=vq_conf)
+    state_dict = torch.load(args.ckpt, map_location=lambda storage, loc: storage)
+    df.load_state_dict(state_dict['df'], strict=False)
+    df.to(args.device).eval()
+    vqvae = load_vqvae(vq_conf, vq_ckpt=args.vq_ckpt or args.ckpt, opt=SimpleNamespace(device=args.device))
+
+    # the schedule SDFusionModel samples on, not the df yaml's
+    alphas_cumprod = sdfusion_alphas_cumprod()
+
+    meta = export_sampler(args.out_dir, df, vqvae, alphas_cumprod, z_shape, ddim_steps=args.ddim_steps,
+                          discretize=args.discretize, fmt=args.format, device=args.device)
+
+    gen = SDFGenerator(args.out_dir, device=args.device)
+    x_T = gen.noise(1, args.seed)
+    z = gen.sample(x_T=x_T)
+    sdf = gen.decode(z)
+    with torch.no_grad():
+        step = DDIMStep(df, alphas_cumprod).to(args.device)
+        x = torch.from_numpy(x_T).to(args.device)
+        for k in reversed(range(args.ddim_steps)):
+            t = torch.full((1,), meta['timesteps'][k], dtype=torch.long, device=args.device)
+            t_prev = torch.full((1,), meta['timesteps_prev'][k], dtype=torch.long, device=args.device)
+            x = step(x, t, t_prev)
+        ref = vqvae.decode_no_quant(x).float().cpu().numpy()
+    x = x.cpu().numpy()
+    cprint(f'[*] exported vs. eager: latent {abs(z - x).max():.2e}, sdf {abs(sdf - ref).max():.2e}', 'blue')
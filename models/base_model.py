@@ -1,7 +1,10 @@
 import os
+from contextlib import nullcontext
 from termcolor import colored, cprint
 import torch
 import utils.util as util
+from models.model_utils import autocast
+from models.profiler import ModuleProfiler
 
 def create_model(opt):
     model = None
@@ -117,6 +120,38 @@ class BaseModel():
                 print('[Network %s] Total number of parameters : %.3f M' % (name, num_params / 1e6))
         print('-----------------------------------------------')
 
+    def autocast(self):
+        """ autocast context of the opt.precision policy (see models/model_utils.py) """
+        return autocast(self.opt.device, self.opt.precision)
+
+    def decode(self, z):
+        """
+            vqvae_module.decode_no_quant under the precision policy, always returns an fp32 sdf.
+            tiled (decode_no_quant_tiled) with --decode_tile or --decode_mem_budget
+        """
+        opt = self.opt
+        with self.autocast():
+            if opt.decode_tile or opt.decode_mem_budget:
+                mem_budget = opt.decode_mem_budget * 2 ** 20 if opt.decode_mem_budget else None
+                return self.vqvae_module.decode_no_quant_tiled(z, tile=opt.decode_tile or None, overlap=opt.decode_overlap,
+                                                               mem_budget=mem_budget, store=opt.decode_store).float()
+            return self.vqvae_module.decode_no_quant(z).float()
+
+    def init_profiler(self, **nets):
+        """ --profile_dir: hook the blocks of `nets` (prefix -> network) for the @profiled sampling methods """
+        self.profiler = None
+        if self.opt.profile_dir is None:
+            return
+        self.profiler = ModuleProfiler(self.opt.profile_dir, device=self.opt.device, backward=self.opt.profile_backward)
+        for prefix, net in nets.items():
+            self.profiler.attach(net, prefix)
+        cprint(f'[*] profiling {len(self.profiler.names)} blocks per sampling run to: {self.opt.profile_dir}', 'blue')
+
+    def profile_run(self, tag):
+        """ one profiled run (see models/profiler.py), a no-op without --profile_dir """
+        profiler = getattr(self, 'profiler', None)
+        return profiler.run(tag) if profiler is not None else nullcontext()
+
     def tocuda(self, var_names):
         for name in var_names:
             if isinstance(name, str):
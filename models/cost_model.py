@@ -0,0 +1,251 @@
+""" Static cost model of a diffusion + VQ-VAE config: FLOPs, parameter bytes and peak activation memory per block.
+
+    Nothing is built or run: the blocks of UNet3DModel and of the VQ-VAE decoding path (quantize, post_quant_conv,
+    Decoder3D) are walked from the config as their __init__ lays them out, and costed with the shape-only helpers
+    next to count_flops_attn in openai_model_3d.py. Rows are named like the modules, so they line up with the
+    profiler (models/profiler.py, see benchmarks/bench_cost_model.py).
+
+    Activation memory is for sampling (no grad): per block, the bytes alive at its high-water mark, i.e. the
+    UNet skip connections still on the stack, the block input and what the block allocates on top of it.
+    Weights (params, fp32) come on top. A sampling run is `steps` UNet calls on the guided batch (2x batch
+    with cfg, SDFusionModel runs the conditional and unconditional rows in one call) and one decode of the batch.
+"""
+
+import math
+
+from omegaconf import OmegaConf
+
+from models.networks.diffusion_networks.attention import ATTN_MEM_BUDGET
+from models.networks.diffusion_networks.openai_model_3d import (
+    attention_block_cost, attention_macs, block_cost, conv_cost, norm_act_cost, resblock_cost, sequential_cost,
+    spatial_transformer_cost,
+)
+
+ACT_BYTES = {'fp32': 4, 'bf16': 2, 'fp16': 2}
+CFG_MODES = {'none': 1, 'cfg': 2}
+# soft prompt tokens of a PromptedAttentionBlock (its default) and BERT context length
+PROMPT_LEN = 8
+CONTEXT_LEN = 77
+
+
+def _heads(ch, p, upsample=False):
+    """ (heads, head channels) of an attention block at ch channels, as UNet3DModel.__init__ picks them """
+    num_heads = p.get('num_heads', -1)
+    num_head_channels = p.get('num_head_channels', -1)
+    if upsample and p.get('num_heads_upsample', -1) != -1:
+        num_heads = p.num_heads_upsample
+    if num_head_channels == -1:
+        return num_heads, ch // num_heads
+    return ch // num_head_channels, num_head_channels
+
+
+def _attention(p, batch, ch, voxels, upsample, prompt_len, context_len, mem_budget, merge_ratio, act_bytes):
+    heads, d_head = _heads(ch, p, upsample)
+    if p.get('use_spatial_transformer', False):
+        if not p.get('legacy', True) or p.get('num_head_channels', -1) == -1:
+            d_head = ch // heads
+        return 'SpatialTransformer3D', spatial_transformer_cost(
+            batch, ch, heads, d_head, voxels, depth=p.get('transformer_depth', 1), context_dim=p.get('context_dim'),
+            context_len=context_len, mem_budget=mem_budget, act_bytes=act_bytes)
+    return 'PromptedAttentionBlock', attention_block_cost(batch, ch, heads, voxels, prompt_len=prompt_len,
+                                                          merge_ratio=merge_ratio, act_bytes=act_bytes)
+
+
+def unet_costs(unet_params, z_shape, batch, prompt_len=PROMPT_LEN, context_len=CONTEXT_LEN, mem_budget=ATTN_MEM_BUDGET,
+               merge_ratio=0., act_bytes=4):
+    """
+        rows of one UNet3DModel forward on a (batch, *z_shape) latent: dicts with name, kind, shape (per sample),
+        macs, params, out, peak (see block_cost) and live, the bytes alive at the block's high-water mark.
+        attention rows inside a block are marked nested and are already counted in the block around them.
+    """
+    p = unet_params
+    if p.get('resblock_updown', False):
+        raise ValueError('the cost model covers conv up / down sampling only (resblock_updown=False)')
+    if p.get('dims', 2) != 3:
+        raise ValueError(f'the cost model covers 3d UNets only, got dims={p.get("dims", 2)}')
+    mc, emb = p.model_channels, 4 * p.model_channels
+    attention_resolutions = list(p.attention_resolutions)
+    channel_mult = list(p.get('channel_mult', (1, 2, 4, 8)))
+    scale_shift = p.get('use_scale_shift_norm', False)
+    spatial = list(z_shape[1:])
+    latent = batch * z_shape[0] * math.prod(spatial) * act_bytes
+    rows, skips = [], []
+
+    def add(name, kind, cost, ch, live, nested=False, shape=None):
+        shape = shape or (ch, *spatial)
+        rows.append(dict(name=name, kind=kind, shape=tuple(shape), nested=nested, live=live, **cost))
+
+    def block(ch_in, ch_out, upsample):
+        """ ResBlock (+ attention): (cost, attention (kind, cost, shape) or None) """
+        vox = math.prod(spatial)
+        cost = resblock_cost(batch, ch_in, ch_out, emb, vox, scale_shift, act_bytes)
+        if ds not in attention_resolutions:
+            return cost, None
+        kind, attn = _attention(p, batch, ch_out, vox, upsample, prompt_len, context_len, mem_budget,
+                                merge_ratio, act_bytes)
+        return sequential_cost(cost, attn), (kind, attn, (ch_out, *spatial))
+
+    def add_block(name, cost, nested, ch, live):
+        add(name, 'TimestepEmbedSequential', cost, ch, live)
+        if nested is not None:
+            kind, attn, shape = nested
+            add(f'{name}.1', kind, attn, ch, None, nested=True, shape=shape)
+
+    add('time_embed', 'Linear', block_cost(macs=batch * (mc * emb + emb * emb), params=mc * emb + emb * emb + 2 * emb,
+                                           out=batch * emb * act_bytes), emb, latent + batch * emb * act_bytes)
+    vox = math.prod(spatial)
+    cost = conv_cost(batch, p.in_channels, mc, vox, 27, act_bytes)
+    add('input_blocks.0', 'Conv3d', cost, mc, latent + cost['peak'])
+    skips.append(cost['out'])
+
+    ch, ds, chans, idx = mc, 1, [mc], 1
+    for level, mult in enumerate(channel_mult):
+        for _ in range(p.num_res_blocks):
+            cost, nested = block(ch, mult * mc, False)
+            ch = mult * mc
+            add_block(f'input_blocks.{idx}', cost, nested, ch, sum(skips) + cost['peak'])
+            skips.append(cost['out'])
+            chans.append(ch)
+            idx += 1
+        if level != len(channel_mult) - 1:
+            # 3d Downsample: stride (1, 2, 2)
+            spatial = [spatial[0]] + [(s + 1) // 2 for s in spatial[1:]]
+            cost = conv_cost(batch, ch, ch, math.prod(spatial), 27, act_bytes)
+            add(f'input_blocks.{idx}', 'Downsample', cost, ch, sum(skips) + cost['peak'])
+            skips.append(cost['out'])
+            chans.append(ch)
+            idx += 1
+            ds *= 2
+
+    vox = math.prod(spatial)
+    kind, attn = _attention(p, batch, ch, vox, False, prompt_len, context_len, mem_budget, merge_ratio, act_bytes)
+    res = resblock_cost(batch, ch, ch, emb, vox, scale_shift, act_bytes)
+    cost = sequential_cost(res, attn, res)
+    add_block('middle_block', cost, (kind, attn, (ch, *spatial)), ch, sum(skips) + cost['peak'])
+    h = cost['out']
+
+    idx = 0
+    for level, mult in list(enumerate(channel_mult))[::-1]:
+        for i in range(p.num_res_blocks + 1):
+            ich = chans.pop()
+            skip = skips.pop()
+            cat = h + skip
+            cost, nested = block(ch + ich, mc * mult, True)
+            ch = mc * mult
+            if level and i == p.num_res_blocks:
+                # 3d Upsample: nearest x2 on the inner two dims, then a conv
+                spatial = [spatial[0]] + [2 * s for s in spatial[1:]]
+                vox = math.prod(spatial)
+                up = block_cost(out=batch * ch * vox * act_bytes)
+                cost = sequential_cost(cost, up, conv_cost(batch, ch, ch, vox, 27, act_bytes))
+                ds //= 2
+            # the concatenation holds h and the skip until it is done
+            live = sum(skips) + max(h + skip + cat, cat + cost['peak'])
+            add_block(f'output_blocks.{idx}', cost, nested, ch, live)
+            h = cost['out']
+            idx += 1
+
+    vox = math.prod(spatial)
+    cost = sequential_cost(norm_act_cost(batch, ch, vox, act_bytes),
+                           conv_cost(batch, mc, p.out_channels, vox, 27, act_bytes))
+    add('out', 'Sequential', cost, p.out_channels, h + cost['peak'])
+    return rows
+
+
+def decoder_costs(vq_params, batch, act_bytes=4):
+    """ rows of VQVAE.decode_no_quant on a batch of latents: quantize, post_quant_conv and the Decoder3D blocks """
+    dd = vq_params.ddconfig
+    ch_mult = list(dd.ch_mult)
+    n_res = len(ch_mult)
+    res = dd.resolution // 2 ** (n_res - 1)
+    vox = res ** 3
+    rows = []
+
+    def add(name, kind, cost, ch, live):
+        rows.append(dict(name=name, kind=kind, shape=(ch, res, res, res), nested=False, live=live, **cost))
+
+    # nearest-code search: (B * T, n_embed) distances, and the matmul term of the same size
+    dist = batch * vox * vq_params.n_embed * 4
+    z = batch * vq_params.embed_dim * vox * act_bytes
+    add('quantize', 'VectorQuantizer', block_cost(macs=batch * vox * vq_params.n_embed * vq_params.embed_dim,
+                                                  params=vq_params.n_embed * vq_params.embed_dim,
+                                                  out=z, peak=2 * dist + z), vq_params.embed_dim, z + 2 * dist + z)
+    cost = conv_cost(batch, vq_params.embed_dim, dd.z_channels, vox, 1, act_bytes)
+    add('post_quant_conv', 'Conv3d', cost, dd.z_channels, z + cost['peak'])
+    h = cost['out']
+
+    def resnet(c_in, c_out):
+        # Decoder3D's ResnetBlock has no timestep embedding (temb_ch = 0)
+        return resblock_cost(batch, c_in, c_out, 0, vox, act_bytes=act_bytes)
+
+    def attn(c):
+        # AttnBlock, one head over all channels: norm, q, k, v, the (T, T) weights and their softmax
+        size = batch * c * vox * act_bytes
+        weights = batch * vox * vox * 4
+        return block_cost(macs=4 * batch * vox * c * c + attention_macs(batch, c, vox), params=4 * c * c + 6 * c,
+                          out=size, peak=4 * size + 2 * weights)
+
+    block_in = dd.ch * ch_mult[-1]
+    for name, kind, cost, c in [('decoder.conv_in', 'Conv3d', conv_cost(batch, dd.z_channels, block_in, vox, 27, act_bytes), block_in),
+                                ('decoder.mid.block_1', 'ResnetBlock', resnet(block_in, block_in), block_in),
+                                ('decoder.mid.attn_1', 'AttnBlock', attn(block_in), block_in),
+                                ('decoder.mid.block_2', 'ResnetBlock', resnet(block_in, block_in), block_in)]:
+        add(name, kind, cost, c, h + cost['peak'])
+        h = cost['out']
+
+    for i_level in reversed(range(n_res)):
+        block_out = dd.ch * ch_mult[i_level]
+        for i_block in range(dd.num_res_blocks):
+            cost = resnet(block_in, block_out)
+            block_in = block_out
+            add(f'decoder.up.{i_level}.block.{i_block}', 'ResnetBlock', cost, block_in, h + cost['peak'])
+            h = cost['out']
+            if res in dd.attn_resolutions:
+                cost = attn(block_in)
+                add(f'decoder.up.{i_level}.attn.{i_block}', 'AttnBlock', cost, block_in, h + cost['peak'])
+                h = cost['out']
+        if i_level != 0:
+            res, vox = 2 * res, 8 * vox
+            cost = sequential_cost(block_cost(out=batch * block_in * vox * act_bytes),
+                                   conv_cost(batch, block_in, block_in, vox, 27, act_bytes))
+            add(f'decoder.up.{i_level}.upsample', 'Upsample', cost, block_in, h + cost['peak'])
+            h = cost['out']
+
+    for name, kind, cost, c in [('decoder.norm_out', 'GroupNorm', norm_act_cost(batch, block_in, vox, act_bytes), block_in),
+                                ('decoder.conv_out', 'Conv3d', conv_cost(batch, block_in, dd.out_ch, vox, 27, act_bytes), dd.out_ch)]:
+        add(name, kind, cost, c, h + cost['peak'])
+        h = cost['out']
+    return rows
+
+
+def estimate(df_cfg, vq_cfg, batch=1, steps=100, cfg='none', precision='fp32', prompt_len=PROMPT_LEN,
+             context_len=CONTEXT_LEN, attn_mem_budget=ATTN_MEM_BUDGET, merge_ratio=0.):
+    """
+        cost of one sampling run of `batch` shapes: `steps` UNet calls on batch * CFG_MODES[cfg] latents and one
+        decode. returns a dict with the unet / decoder rows and the totals (flops = 2 * macs, bytes).
+    """
+    df_conf, vq_conf = OmegaConf.load(df_cfg), OmegaConf.load(vq_cfg)
+    vq_params = vq_conf.model.params
+    dd = vq_params.ddconfig
+    z_res = dd.resolution // 2 ** (len(dd.ch_mult) - 1)
+    z_shape = (dd.z_channels, z_res, z_res, z_res)
+    act_bytes = ACT_BYTES[precision]
+    unet_batch = batch * CFG_MODES[cfg]
+
+    unet = unet_costs(df_conf.unet.params, z_shape, unet_batch, prompt_len, context_len, attn_mem_budget,
+                      merge_ratio, act_bytes)
+    decoder = decoder_costs(vq_params, batch, act_bytes)
+    top = lambda rows: [r for r in rows if not r['nested']]
+    unet_macs = sum(r['macs'] for r in top(unet))
+    decode_macs = sum(r['macs'] for r in decoder)
+    # the sampler keeps x, the guided input, eps and pred_x0 around the unet call
+    sampler = 4 * unet_batch * math.prod(z_shape) * 4
+    return dict(
+        z_shape=z_shape, batch=batch, unet_batch=unet_batch, steps=steps, cfg=cfg, precision=precision,
+        unet=unet, decoder=decoder,
+        unet_flops=2 * unet_macs, decode_flops=2 * decode_macs, run_flops=2 * (steps * unet_macs + decode_macs),
+        unet_param_bytes=4 * sum(r['params'] for r in top(unet)),
+        decoder_param_bytes=4 * sum(r['params'] for r in decoder),
+        unet_peak_bytes=sampler + max(r['live'] for r in top(unet)),
+        decode_peak_bytes=max(r['live'] for r in decoder),
+    )
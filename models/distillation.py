@@ -0,0 +1,207 @@
+""" Reference: Progressive Distillation for Fast Sampling of Diffusion Models (Salimans & Ho, 2022), https://arxiv.org/abs/2202.00512
+
+    Each round trains a student DiffusionUNet so that one deterministic DDIM step of the student matches two
+    DDIM steps of the teacher, then the student becomes the teacher of the next round: 64 -> 32 -> ... -> 4 steps.
+    The students stay eps-parameterised DiffusionUNets sampled by the stock DDIMSampler, on the "trailing" grid
+    (make_ddim_timesteps), where the grid for n steps is every other step of the grid for 2n.
+
+    SoftPrompt3D banks are copied into the student and kept frozen by default, so prompt-tuned teachers give
+    students that condition on the same prompts and can be prompt-tuned further like any other DiffusionUNet.
+"""
+
+import copy
+
+import numpy as np
+from termcolor import cprint
+
+import torch
+import torch.nn.functional as F
+from torch import optim
+
+from models.networks.diffusion_networks.prompt import SoftPrompt3D
+from models.networks.diffusion_networks.ldm_diffusion_util import make_ddim_timesteps
+from models.networks.diffusion_networks.samplers.ddim import guided_eps
+
+
+def apply_net(net, x, t, cond=None):
+    """ SDFusionModel.apply_model for a bare DiffusionUNet """
+    if cond is None:
+        out = net(x, t)
+    else:
+        key = 'c_concat' if net.conditioning_key == 'concat' else 'c_crossattn'
+        out = net(x, t, **{key: [cond]})
+    if isinstance(out, tuple):
+        return out[0]
+    return out
+
+
+class ProgressiveDistiller(object):
+    """
+        alphas_cumprod: the ddpm schedule of the teacher (SDFusionModel.alphas_cumprod).
+        uc_scale / uc: classifier-free guidance of the first teacher. the first student learns the guided
+        prediction, so later rounds (and sampling the student) run without guidance.
+        train_prompts: also train the SoftPrompt3D banks. off by default, the student keeps the teacher's prompts.
+    """
+    def __init__(self, teacher, alphas_cumprod, lr=1e-4, uc_scale=1., uc=None, train_prompts=False):
+        self.teacher = teacher
+        self.alphas_cumprod = alphas_cumprod.detach().float()
+        self.num_timesteps = alphas_cumprod.shape[0]
+        self.lr = lr
+        self.uc_scale = uc_scale
+        self.uc = uc
+        self.train_prompts = train_prompts
+
+    def grid(self, n_steps):
+        """ the ddim timesteps for n_steps (ascending) and the timestep each step lands on (0 after the last) """
+        t = make_ddim_timesteps('trailing', n_steps, self.num_timesteps, verbose=False)
+        t_prev = np.concatenate([[0], t[:-1]])
+        return torch.from_numpy(t).long(), torch.from_numpy(t_prev).long()
+
+    def coef(self, t, ndim):
+        """ (alpha_t, sigma_t), shaped to broadcast over a batch of ndim-dimensional latents """
+        a = self.alphas_cumprod.to(t.device)[t].view(-1, *([1] * (ndim - 1)))
+        return a.sqrt(), (1. - a).sqrt()
+
+    def eps(self, net, x, t, cond=None, uc_scale=1.):
+        uc = None if self.uc is None else self.uc.expand(x.shape[0], *self.uc.shape[1:])
+        return guided_eps(lambda x_, t_, c_: apply_net(net, x_, t_, c_), x, cond, t, uc_scale, uc)
+
+    @staticmethod
+    def ddim_step(x, eps, alpha, sigma, alpha_next, sigma_next):
+        x0 = (x - sigma * eps) / alpha
+        return alpha_next * x0 + sigma_next * eps
+
+    @torch.no_grad()
+    def sample(self, net, n_steps, x_T, cond=None, uc_scale=1.):
+        """ deterministic DDIM on the trailing grid, i.e. DDIMSampler(ddim_discretize='trailing') with eta=0 """
+        t, t_prev = self.grid(n_steps)
+        x = x_T
+        for k in reversed(range(n_steps)):
+            ts = t[k].to(x.device).expand(x.shape[0])
+            a, s = self.coef(ts, x.dim())
+            a_prev, s_prev = self.coef(t_prev[k].to(x.device).expand(x.shape[0]), x.dim())
+            x = self.ddim_step(x, self.eps(net, x, ts, cond, uc_scale), a, s, a_prev, s_prev)
+        return x
+
+    def make_student(self, teacher):
+        student = copy.deepcopy(teacher)
+        student.train()
+        student.requires_grad_(True)
+        if not self.train_prompts:
+            for module in student.modules():
+                if isinstance(module, SoftPrompt3D):
+                    module.requires_grad_(False)
+        return student
+
+    @torch.no_grad()
+    def target(self, teacher, z_t, k, n_steps, cond=None, uc_scale=1.):
+        """
+            eps that takes the student from its k-th grid step to the (k-1)-th in one DDIM step, given the
+            teacher's two DDIM steps on the grid with 2 * n_steps.
+        """
+        t2, t2_prev = self.grid(2 * n_steps)
+        t, t_mid, t_end = t2[2 * k + 1], t2[2 * k], t2_prev[2 * k]
+        t, t_mid, t_end = t.to(z_t.device), t_mid.to(z_t.device), t_end.to(z_t.device)
+        ndim = z_t.dim()
+        a_t, s_t = self.coef(t, ndim)
+        a_mid, s_mid = self.coef(t_mid, ndim)
+        a_end, s_end = self.coef(t_end, ndim)
+
+        eps = self.eps(teacher, z_t, t, cond, uc_scale)
+        z_mid = self.ddim_step(z_t, eps, a_t, s_t, a_mid, s_mid)
+        eps = self.eps(teacher, z_mid, t_mid, cond, uc_scale)
+        z_end = self.ddim_step(z_mid, eps, a_mid, s_mid, a_end, s_end)
+
+        # x0 that one DDIM step from z_t has to predict to land on z_end, as eps (the student's parameterization)
+        ratio = s_end / s_t
+        x0 = (z_end - ratio * z_t) / (a_end - ratio * a_t)
+        return t, (z_t - a_t * x0) / s_t
+
+    def distill_round(self, teacher, n_steps, data_fn, iters, uc_scale=1., log_every=100):
+        """
+            train a student for n_steps from a teacher sampled with 2 * n_steps.
+            data_fn() -> (z0, cond): clean latents (vqvae codes or teacher samples) and their conditioning.
+        """
+        student = self.make_student(teacher)
+        teacher.eval()
+        params = [p for p in student.parameters() if p.requires_grad]
+        optimizer = optim.Adam(params, lr=self.lr)
+        # linear decay to 0 over each round, as in the paper
+        scheduler = optim.lr_scheduler.LambdaLR(optimizer, lambda it: 1. - it / iters)
+
+        for it in range(iters):
+            z0, cond = data_fn()
+            k = torch.randint(0, n_steps, (z0.shape[0],))
+            z_t = self.q_sample(z0, k, n_steps)
+            t, eps_target = self.target(teacher, z_t, k, n_steps, cond, uc_scale)
+
+            loss = F.mse_loss(apply_net(student, z_t, t, cond), eps_target)
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+
+            if log_every and (it % log_every == 0 or it == iters - 1):
+                cprint(f'[distill {2 * n_steps}->{n_steps}] iter {it}: loss {loss.item():.5f}', 'blue')
+
+        student.eval()
+        student.requires_grad_(False)
+        return student
+
+    def q_sample(self, z0, k, n_steps, noise=None):
+        t, _ = self.grid(n_steps)
+        a, s = self.coef(t[k].to(z0.device), z0.dim())
+        if noise is None:
+            noise = torch.randn_like(z0)
+        return a * z0 + s * noise
+
+    def run(self, data_fn, start_steps=64, final_steps=4, iters=5000, callback=None, log_every=100):
+        """
+            halve start_steps until final_steps (the ratio has to be a power of two). callback(student, n_steps)
+            is called after each round, e.g. to save it. returns the final student.
+        """
+        ratio = start_steps // final_steps
+        if final_steps < 1 or ratio * final_steps != start_steps or ratio & (ratio - 1) != 0:
+            raise ValueError(f'start_steps / final_steps must be a power of two, got {start_steps} / {final_steps}')
+
+        teacher, n_steps, uc_scale = self.teacher, start_steps, self.uc_scale
+        while n_steps > final_steps:
+            n_steps //= 2
+            teacher = self.distill_round(teacher, n_steps, data_fn, iters, uc_scale=uc_scale, log_every=log_every)
+            # the student already learned the guided prediction
+            uc_scale = 1.
+            if callback is not None:
+                callback(teacher, n_steps)
+        return teacher
+
+
+def save_student(path, student, n_steps, vqvae_state_dict=None):
+    """ same layout as SDFusionModel.save, plus the step count the student was distilled for """
+    state_dict = {'df': student.state_dict(), 'distill_steps': n_steps, 'global_step': 0}
+    if vqvae_state_dict is not None:
+        state_dict['vqvae'] = vqvae_state_dict
+    torch.save(state_dict, path)
+
+
+def load_student(model, ckpt):
+    """
+        load a distilled student into an SDFusion model (df weights, ddim_steps, trailing grid for its samplers).
+        returns the number of steps the student was distilled for.
+    """
+    map_fn = lambda storage, loc: storage
+    state_dict = torch.load(ckpt, map_location=map_fn) if type(ckpt) == str else ckpt
+    if 'distill_steps' not in state_dict:
+        raise ValueError(f'{ckpt} is not a distilled student (no distill_steps)')
+
+    # save_student writes the whole df: every key has to match (call it on the bare df, before DDP wraps it)
+    model.df.load_state_dict(state_dict['df'])
+    if 'vqvae' in state_dict:
+        model.vqvae.load_state_dict(state_dict['vqvae'])
+
+    n_steps = state_dict['distill_steps']
+    model.ddim_steps = n_steps
+    model.opt.ddim_discretize = 'trailing'
+    if hasattr(model, 'ddim_sampler'):
+        model.ddim_sampler.ddim_discretize = 'trailing'
+    cprint(f'[*] distilled student ({n_steps} steps) successfully load from: {ckpt}', 'blue')
+    return n_steps
@@ -0,0 +1,106 @@
+""" Standalone sample -> decode graphs for inference workers (loaded by sdf_runtime.py).
+
+    Two traced graphs with every weight, the SoftPrompt3D banks included, frozen into them:
+        ddim_step   (x, t, t_prev) -> x_prev: one unconditional eps prediction of the DiffusionUNet and the
+                    deterministic DDIM update (eta=0), with alphas_cumprod baked in as a buffer
+        decode      z -> sdf: VQVAE.decode_no_quant (quantize, post_quant_conv, decoder), as in BaseModel.decode
+    plus meta.json with the latent shape and the ddim timestep grid. TorchScript (torch.jit.trace) or ONNX, the
+    batch dimension stays dynamic in both. TorchScript graphs keep the device they were traced on (meta['device']).
+"""
+
+import os
+import json
+
+import numpy as np
+from termcolor import cprint
+
+import torch
+import torch.nn as nn
+
+from models.networks.diffusion_networks.ldm_diffusion_util import make_ddim_timesteps
+from models.distillation import apply_net
+
+FORMATS = ['torchscript', 'onnx']
+ONNX_OPSET = 17
+
+
+class DDIMStep(nn.Module):
+    """ one deterministic DDIM step of `df`: the same update as DDIMSampler.p_sample_ddim with eta=0 """
+    def __init__(self, df, alphas_cumprod):
+        super().__init__()
+        self.df = df
+        self.register_buffer('alphas_cumprod', alphas_cumprod.detach().float().clone())
+
+    def forward(self, x, t, t_prev):
+        shape = (-1,) + (1,) * (x.dim() - 1)
+        a, a_prev = self.alphas_cumprod[t].view(shape), self.alphas_cumprod[t_prev].view(shape)
+        eps = apply_net(self.df, x, t)
+        x0 = (x - (1. - a).sqrt() * eps) / a.sqrt()
+        return a_prev.sqrt() * x0 + (1. - a_prev).sqrt() * eps
+
+
+class Decode(nn.Module):
+    def __init__(self, vqvae):
+        super().__init__()
+        self.vqvae = vqvae
+
+    def forward(self, z):
+        return self.vqvae.decode_no_quant(z).float()
+
+
+def ddim_grid(ddim_steps, num_timesteps, discretize='uniform'):
+    """ ascending ddim timesteps and the ones each step lands on (alphas_cumprod[0] after the last, as DDIMSampler) """
+    t = make_ddim_timesteps(discretize, ddim_steps, num_timesteps, verbose=False)
+    t_prev = np.concatenate([[0], t[:-1]])
+    return t.tolist(), t_prev.tolist()
+
+
+def _save(module, inputs, path, fmt, names, output):
+    if fmt == 'torchscript':
+        traced = torch.jit.trace(module, inputs, check_trace=False)
+        torch.jit.save(torch.jit.freeze(traced), path)
+    else:
+        torch.onnx.export(module, inputs, path, input_names=names, output_names=[output], opset_version=ONNX_OPSET,
+                          dynamic_axes={name: {0: 'batch'} for name in names + [output]})
+
+
+@torch.no_grad()
+def export_sampler(out_dir, df, vqvae, alphas_cumprod, z_shape, ddim_steps=100, discretize='uniform',
+                   fmt='torchscript', device='cpu'):
+    """
+        trace `df` (a DiffusionUNet without conditioning, i.e. what SDFusionModel.uncond samples) and `vqvae` into
+        out_dir/ddim_step.{pt,onnx}, out_dir/decode.{pt,onnx} and out_dir/meta.json. the prompts are whatever
+        SoftPrompt3D banks df carries at export time. returns the meta dict.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'fmt must be one of {FORMATS}, got {fmt}')
+    if getattr(df, 'conditioning_key', None) is not None:
+        raise ValueError(f'only unconditional UNets can be exported, got conditioning_key={df.conditioning_key}')
+    os.makedirs(out_dir, exist_ok=True)
+    ext = 'pt' if fmt == 'torchscript' else 'onnx'
+
+    step = DDIMStep(df, alphas_cumprod).to(device).eval().requires_grad_(False)
+    decode = Decode(vqvae).to(device).eval().requires_grad_(False)
+    # sampling-only state that would otherwise be traced into the graph
+    unet = getattr(df, 'diffusion_net', None)
+    deep_cache = getattr(unet, 'deep_cache', None)
+    if unet is not None:
+        unet.deep_cache = None
+
+    t, t_prev = ddim_grid(ddim_steps, alphas_cumprod.shape[0], discretize)
+    x = torch.randn(2, *z_shape, device=device)
+    ts = torch.full((2,), t[-1], dtype=torch.long, device=device)
+    ts_prev = torch.full((2,), t_prev[-1], dtype=torch.long, device=device)
+    try:
+        _save(step, (x, ts, ts_prev), os.path.join(out_dir, f'ddim_step.{ext}'), fmt, ['x', 't', 't_prev'], 'x_prev')
+        _save(decode, (x,), os.path.join(out_dir, f'decode.{ext}'), fmt, ['z'], 'sdf')
+    finally:
+        if unet is not None:
+            unet.deep_cache = deep_cache
+
+    meta = {'format': fmt, 'z_shape': list(z_shape), 'ddim_steps': ddim_steps, 'discretize': discretize,
+            'timesteps': t, 'timesteps_prev': t_prev, 'dtype': 'float32', 'device': str(device)}
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    cprint(f'[*] {fmt} sampler ({ddim_steps} ddim steps, z {tuple(z_shape)}) exported to: {out_dir}', 'blue')
+    return meta
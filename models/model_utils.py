@@ -1,3 +1,6 @@
+import warnings
+from contextlib import nullcontext
+
 from termcolor import colored
 import torch
 
@@ -29,4 +32,61 @@ def load_vqvae(vq_conf, vq_ckpt, opt=None):
 
     vqvae.to(opt.device)
     vqvae.eval()
-    return vqvae
\ No newline at end of file
+    return vqvae
+
+# opt.precision -> autocast dtype. weights stay fp32 in every mode.
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def autocast(device, precision='fp32'):
+    """
+    torch.autocast for `precision` on `device`, a no-op context for fp32.
+    autocast keeps its fp32 ops (norms, softmax, losses) in fp32; callers cast the outputs they
+    integrate (eps for the DDIM update, decoded sdf) back with .float().
+    """
+    dtype = PRECISIONS[precision]
+    if dtype is None:
+        return nullcontext()
+    device_type = 'cuda' if str(device).startswith('cuda') else 'cpu'
+    if device_type == 'cpu' and dtype == torch.float16:
+        raise ValueError('fp16 autocast is cuda only, use bf16 on cpu')
+    return torch.autocast(device_type, dtype=dtype)
+
+
+def grad_scaler(device, precision='fp32'):
+    """ loss scaling for fp16 training on cuda. bf16 has the range of fp32, so it gets a disabled (pass-through) scaler """
+    enabled = precision == 'fp16' and str(device).startswith('cuda')
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+MEMORY_FORMATS = {'contiguous': torch.contiguous_format, 'channels_last_3d': torch.channels_last_3d}
+
+
+def channels_last_3d_supported(device):
+    """ whether `device` has channels-last Conv3d kernels (cudnn on cuda, oneDNN on cpu) """
+    if str(device).startswith('cuda'):
+        return torch.backends.cudnn.is_available()
+    return torch.backends.mkldnn.is_available()
+
+
+def set_memory_format(module, memory_format='contiguous'):
+    """
+    opt.memory_format for the conv stacks in `module` (DiffusionUNet / UNet3DModel, VQVAE / Encoder3D / Decoder3D).
+    'channels_last_3d' converts the 5d conv weights once and makes every submodule with a channels_last
+    attribute convert its input once, so ResBlocks, Up/Downsample and the skip concatenations stay
+    channels-last; their outputs are returned contiguous. 'contiguous' is the fallback (and undoes the
+    conversion). falls back with a warning on devices without channels-last conv kernels.
+    """
+    if memory_format not in MEMORY_FORMATS:
+        raise ValueError(f'memory_format must be one of {list(MEMORY_FORMATS)}, got {memory_format}')
+
+    device = next(module.parameters()).device
+    if memory_format == 'channels_last_3d' and not channels_last_3d_supported(device):
+        warnings.warn(f'no channels-last conv3d kernels on {device}, falling back to contiguous')
+        memory_format = 'contiguous'
+
+    module.to(memory_format=MEMORY_FORMATS[memory_format])
+    for m in module.modules():
+        if hasattr(m, 'channels_last'):
+            m.channels_last = memory_format == 'channels_last_3d'
+    return memory_format
@@ -0,0 +1,96 @@
+""" LRU cache of BERTTextEncoder outputs, in memory and optionally on disk, keyed by (text, encoder weights hash). """
+
+import os
+import hashlib
+from collections import OrderedDict
+
+import torch
+
+
+def state_dict_hash(module):
+    """ hex digest of every tensor in module.state_dict(), i.e. changes whenever the weights do """
+    h = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class TextEmbeddingCache(object):
+    """
+        max_entries: # of [max_seq_len, n_embed] embeddings kept in memory (on the encoder's device), least
+        recently used ones are dropped first. 0 disables the memory cache.
+        cache_dir: embeddings are also read from / written to cache_dir/<weights hash>/<text hash>.pt, so they
+        survive the process (see preprocess/encode_text2shape_captions.py). None keeps the cache in memory only.
+        weights_hash: state_dict_hash of the encoder. has to be (re)set whenever its weights change.
+    """
+    def __init__(self, max_entries=256, cache_dir=None, weights_hash=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.weights_hash = weights_hash
+        self.entries = OrderedDict()
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+
+    def path(self, text):
+        return os.path.join(self.cache_dir, self.weights_hash[:16], f'{text_hash(text)}.pt')
+
+    def get(self, text, device):
+        key = (text, self.weights_hash)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        if self.cache_dir is not None and os.path.exists(self.path(text)):
+            z = torch.load(self.path(text), map_location=lambda storage, loc: storage).to(device)
+            self.disk_hits += 1
+            self.put(text, z, write=False)
+            return z
+
+        self.misses += 1
+        return None
+
+    def put(self, text, z, write=True):
+        if self.max_entries > 0:
+            self.entries[(text, self.weights_hash)] = z
+            self.entries.move_to_end((text, self.weights_hash))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        if write and self.cache_dir is not None:
+            path = self.path(text)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write-then-rename, so concurrent readers never see a partial file
+            torch.save(z.detach().cpu().clone(), path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+    @torch.no_grad()
+    def encode(self, encoder, texts, device=None):
+        """
+            encoder(texts) [len(texts), max_seq_len, n_embed], with only the texts missing from the cache (each
+            distinct one once) going through the encoder, in a single batch.
+        """
+        assert self.weights_hash is not None, 'set weights_hash (state_dict_hash of the encoder) first'
+        if device is None:
+            device = next(encoder.parameters()).device
+
+        found = {}
+        for text in OrderedDict.fromkeys(texts):
+            z = self.get(text, device)
+            if z is not None:
+                found[text] = z
+
+        missing = [text for text in OrderedDict.fromkeys(texts) if text not in found]
+        if len(missing) > 0:
+            for text, z in zip(missing, encoder(missing)):
+                self.put(text, z)
+                found[text] = z
+
+        return torch.stack([found[text] for text in texts])
+
+    def clear(self):
+        self.entries.clear()
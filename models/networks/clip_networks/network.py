@@ -24,7 +24,9 @@ class CLIPImageEncoder(nn.Module):
         self.model, _ = clip.load(name=model, device=device, jit=jit)
 
         # self.model, self.preprocess = clip.load(name=model, device=device, jit=jit)
-        self.model = self.model.float() # turns out this is important...
+        # turns out this is important... clip.load gives fp16 weights on cuda. mixed precision
+        # comes from autocast (opt.precision), which needs fp32 weights
+        self.model = self.model.float()
 
         self.antialias = antialias
 
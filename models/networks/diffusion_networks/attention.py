@@ -152,20 +152,30 @@ class SpatialSelfAttention(nn.Module):
         return x+h_
 
 
+# default attention budget of SpatialTransformer3D (bytes, see CrossAttention.attend)
+ATTN_MEM_BUDGET = 256 * 2 ** 20
+
+
 class CrossAttention(nn.Module):
-    def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0.):
+    def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0., mem_budget=None):
         super().__init__()
         inner_dim = dim_head * heads
         context_dim = default(context_dim, query_dim)
 
         self.scale = dim_head ** -0.5
         self.heads = heads
+        # None: one (b*h, n, m) similarity matrix over all queries, as in ldm
+        self.mem_budget = mem_budget
+        self.use_sdpa = hasattr(F, 'scaled_dot_product_attention')
 
         self.to_q = nn.Linear(query_dim, inner_dim, bias=False)
         self.to_k = nn.Linear(context_dim, inner_dim, bias=False)
         self.to_v = nn.Linear(context_dim, inner_dim, bias=False)
 
-        self.soft_prompt = SoftPrompt3D(m_tokens=8, d_model=query_dim)
+        # learnable context tokens, projected by to_k / to_v and appended to the keys / values behind a gate
+        # (as in QKVPromptAttention): sigmoid(-20) keeps a pretrained layer as it was until the gate is trained
+        self.soft_prompt = SoftPrompt3D(m_tokens=8, d_model=context_dim)
+        self.prompt_gate_logit = nn.Parameter(torch.tensor(-20.))
 
         self.to_out = nn.Sequential(
             nn.Linear(inner_dim, query_dim),
@@ -189,7 +199,12 @@ class CrossAttention(nn.Module):
         k = self.to_k(context)
         v = self.to_v(context)
 
-        k, v = self.soft_prompt(k, v, B=x.shape[0])
+        # prompt keys / values (1, L, inner_dim), the same for every sample
+        p = self.soft_prompt(1).to(context.dtype)
+        k_p, v_p = self.to_k(p), self.to_v(p)
+        n_ctx, b = k.shape[1], x.shape[0]
+        k = torch.cat([k, k_p.expand(b, -1, -1)], dim=1)
+        v = torch.cat([v, v_p.expand(b, -1, -1)], dim=1)
 
         # if torch.isnan(q).any():
         #     import pdb; pdb.set_trace()
@@ -205,32 +220,71 @@ class CrossAttention(nn.Module):
 
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
 
+        out = self.attend(q, k, v, self.prompt_bias(mask, n_ctx, b, q.dtype, q.device))
+        out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
+        return self.to_out(out)
+
+    def prompt_bias(self, mask, n_ctx, b, dtype, device):
+        """
+        additive logit bias (b*h or 1, 1, n_ctx + L) for attend: 0 on the context columns (-max where the
+        boolean `mask` drops them), log(sigmoid(prompt_gate_logit)) on the prompt columns
+        """
+        n_prompt = self.soft_prompt.bank.shape[0]
+        log_g = F.logsigmoid(self.prompt_gate_logit).to(dtype).expand(1, n_prompt)
+        if not exists(mask):
+            return torch.cat([torch.zeros(1, n_ctx, dtype=dtype, device=device), log_g], dim=1)[:, None]
+        mask = rearrange(mask, 'b ... -> b (...)')
+        bias = torch.zeros(mask.shape, dtype=dtype, device=device)
+        bias.masked_fill_(~mask, max_neg_value(bias))
+        bias = torch.cat([bias, log_g.expand(mask.shape[0], -1)], dim=1)
+        return repeat(bias, 'b j -> (b h) () j', h=self.heads)
+
+    def attend(self, q, k, v, mask=None):
+        """
+        softmax(q k^T * scale) v for q (b*h, n, d), k / v (b*h, m, d) and a boolean mask or an additive
+        logit bias (b*h or 1, 1, m).
+        with mem_budget (bytes) set, the queries go through in chunks whose fp32 similarities and
+        softmax, 2 * (b*h, chunk, m), stay under it, via F.scaled_dot_product_attention where available.
+        outputs and gradients match the full matrix up to float rounding.
+        """
+        if self.mem_budget is None:
+            return self.attend_full(q, k, v, mask)
+
+        bh, n, m = q.shape[0], q.shape[1], k.shape[1]
+        chunk = max(1, int(self.mem_budget // (2 * 4 * bh * m)))
+        attend = self.attend_sdpa if self.use_sdpa else self.attend_full
+        if chunk >= n:
+            return attend(q, k, v, mask)
+        return torch.cat([attend(q[:, i:i + chunk], k, v, mask) for i in range(0, n, chunk)], dim=1)
+
+    def attend_full(self, q, k, v, mask=None):
         sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
 
-        if torch.isnan(sim).any():
-            import pdb; pdb.set_trace()
+        if exists(mask) and mask.dtype == torch.bool:
+            sim.masked_fill_(~mask, max_neg_value(sim))
+        elif exists(mask):
+            sim = sim + mask
 
-        if exists(mask):
-            mask = rearrange(mask, 'b ... -> b (...)')
-            max_neg_value = -torch.finfo(sim.dtype).max
-            mask = repeat(mask, 'b j -> (b h) () j', h=h)
-            sim.masked_fill_(~mask, max_neg_value)
+        # attention, what we cannot get enough of. softmax in fp32 under autocast
+        attn = sim.float().softmax(dim=-1).type(v.dtype)
 
-        # attention, what we cannot get enough of
-        attn = sim.softmax(dim=-1)
+        return einsum('b i j, b j d -> b i d', attn, v)
 
-        out = einsum('b i j, b j d -> b i d', attn, v)
-        out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
-        return self.to_out(out)
+    def attend_sdpa(self, q, k, v, mask=None):
+        # default scale of sdpa is dim_head ** -0.5, i.e. self.scale
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
 
 
 class BasicTransformerBlock(nn.Module):
-    def __init__(self, dim, n_heads, d_head, dropout=0., context_dim=None, gated_ff=True, checkpoint=True):
+    def __init__(self, dim, n_heads, d_head, dropout=0., context_dim=None, gated_ff=True, checkpoint=True,
+                 mem_budget=None):
         super().__init__()
-        self.attn1 = CrossAttention(query_dim=dim, heads=n_heads, dim_head=d_head, dropout=dropout)  # is a self-attention
+        self.attn1 = CrossAttention(query_dim=dim, heads=n_heads, dim_head=d_head, dropout=dropout,
+                                    mem_budget=mem_budget)  # is a self-attention
         self.ff = FeedForward(dim, dropout=dropout, glu=gated_ff)
         self.attn2 = CrossAttention(query_dim=dim, context_dim=context_dim,
-                                    heads=n_heads, dim_head=d_head, dropout=dropout)  # is self-attn if context is none
+                                    heads=n_heads, dim_head=d_head, dropout=dropout,
+                                    mem_budget=mem_budget)  # is self-attn if context is none
         self.norm1 = nn.LayerNorm(dim)
         self.norm2 = nn.LayerNorm(dim)
         self.norm3 = nn.LayerNorm(dim)
@@ -309,7 +363,7 @@ class SpatialTransformer3D(nn.Module):
     Finally, reshape to image
     """
     def __init__(self, in_channels, n_heads, d_head,
-                 depth=1, dropout=0., context_dim=None):
+                 depth=1, dropout=0., context_dim=None, mem_budget=ATTN_MEM_BUDGET):
         super().__init__()
         self.in_channels = in_channels
         inner_dim = n_heads * d_head
@@ -322,7 +376,8 @@ class SpatialTransformer3D(nn.Module):
                                  padding=0)
 
         self.transformer_blocks = nn.ModuleList(
-            [BasicTransformerBlock(inner_dim, n_heads, d_head, dropout=dropout, context_dim=context_dim)
+            [BasicTransformerBlock(inner_dim, n_heads, d_head, dropout=dropout, context_dim=context_dim,
+                                   mem_budget=mem_budget)
                 for d in range(depth)]
         )
 
@@ -353,4 +408,14 @@ class SpatialTransformer3D(nn.Module):
             # print(f"{i}: ", x.min(), x.max())
         x = rearrange(x, 'b (d h w) c -> b c d h w', d=d, h=h, w=w)
         x = self.proj_out(x)
-        return x + x_in
\ No newline at end of file
+        return x + x_in
+
+
+def set_attn_mem_budget(model, mem_budget_mb):
+    """ opt.attn_mem_budget (MB, 0 or None for the full similarity matrix) of every CrossAttention in a SpatialTransformer3D """
+    mem_budget = mem_budget_mb * 2 ** 20 if mem_budget_mb else None
+    for module in model.modules():
+        if isinstance(module, SpatialTransformer3D):
+            for attn in module.modules():
+                if isinstance(attn, CrossAttention):
+                    attn.mem_budget = mem_budget
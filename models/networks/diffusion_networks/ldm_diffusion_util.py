@@ -3,6 +3,7 @@
 
 import os
 import math
+import weakref
 import torch
 import torch.nn as nn
 import numpy as np
@@ -65,12 +66,31 @@ def make_beta_schedule(schedule, n_timestep, linear_start=1e-4, linear_end=2e-2,
     return betas.numpy()
 
 
+# the noise schedule SDFusionModel registers (and so the one its samplers run on), whatever the df yaml says
+SDFUSION_SCHEDULE = dict(beta_schedule="linear", timesteps=1000, linear_start=1e-4, linear_end=2e-2)
+
+
+def sdfusion_alphas_cumprod(device=None):
+    """
+    float32 alphas_cumprod of SDFUSION_SCHEDULE, computed like register_schedule (cumprod in float64). the
+    offline tools (distill / prune / quantize / export) use it, so their checkpoints match the loading model
+    """
+    betas = make_beta_schedule(SDFUSION_SCHEDULE["beta_schedule"], SDFUSION_SCHEDULE["timesteps"],
+                               linear_start=SDFUSION_SCHEDULE["linear_start"], linear_end=SDFUSION_SCHEDULE["linear_end"])
+    return torch.tensor(np.cumprod(1. - betas, axis=0), dtype=torch.float32, device=device)
+
+
 def make_ddim_timesteps(ddim_discr_method, num_ddim_timesteps, num_ddpm_timesteps, verbose=True):
     if ddim_discr_method == 'uniform':
         c = num_ddpm_timesteps // num_ddim_timesteps
         ddim_timesteps = np.asarray(list(range(0, num_ddpm_timesteps, c)))
     elif ddim_discr_method == 'quad':
         ddim_timesteps = ((np.linspace(0, np.sqrt(num_ddpm_timesteps * .8), num_ddim_timesteps)) ** 2).astype(int)
+    elif ddim_discr_method == 'trailing':
+        # ends on the last ddpm step, and the grid for n steps is every other step of the grid for 2n
+        # (what progressive distillation halves, see models/distillation.py). one is added below.
+        ddim_timesteps = np.round(np.arange(1, num_ddim_timesteps + 1) * num_ddpm_timesteps / num_ddim_timesteps)
+        ddim_timesteps = ddim_timesteps.astype(int) - 2
     else:
         raise NotImplementedError(f'There is no ddim discretization method called "{ddim_discr_method}"')
 
@@ -96,6 +116,60 @@ def make_ddim_sampling_parameters(alphacums, ddim_timesteps, eta, verbose=True):
     return sigmas, alphas, alphas_prev
 
 
+# model -> {(steps, eta, discretize, device): schedule}. entries go away with the model.
+_DDIM_SCHEDULE_CACHE = weakref.WeakKeyDictionary()
+
+
+def make_ddim_schedule(model, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
+    """
+    Build the DDIM sampling schedule of `model` once per (steps, eta, discretize, device).
+    All tensors are float32 and created on the device of `model.betas`, so samplers
+    can be re-instantiated every call without paying for the numpy round trips again.
+    :return: a dict of name -> tensor (plus `ddim_timesteps` as a numpy array).
+    """
+    device = model.betas.device
+    key = (int(ddim_num_steps), float(ddim_eta), ddim_discretize, str(device))
+    cache = _DDIM_SCHEDULE_CACHE.setdefault(model, {})
+    if key in cache:
+        return cache[key]
+
+    ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
+                                         num_ddpm_timesteps=model.num_timesteps, verbose=verbose)
+    alphas_cumprod = model.alphas_cumprod.detach().cpu().to(torch.float32)
+    alphas_cumprod_prev = model.alphas_cumprod_prev.detach().cpu().to(torch.float32)
+    assert alphas_cumprod.shape[0] == model.num_timesteps, 'alphas have to be defined for each timestep'
+    to_torch = lambda x: torch.as_tensor(x, dtype=torch.float32).to(device)
+
+    # ddim sampling parameters
+    ddim_sigmas, ddim_alphas, ddim_alphas_prev = make_ddim_sampling_parameters(alphacums=alphas_cumprod,
+                                                                               ddim_timesteps=ddim_timesteps,
+                                                                               eta=ddim_eta, verbose=verbose)
+    sigmas_for_original_sampling_steps = ddim_eta * torch.sqrt(
+        (1 - alphas_cumprod_prev) / (1 - alphas_cumprod) * (1 - alphas_cumprod / alphas_cumprod_prev))
+
+    schedule = {
+        'ddim_timesteps': ddim_timesteps,
+        'betas': to_torch(model.betas.detach().cpu()),
+        'alphas_cumprod': to_torch(alphas_cumprod),
+        'alphas_cumprod_prev': to_torch(alphas_cumprod_prev),
+
+        # calculations for diffusion q(x_t | x_{t-1}) and others
+        'sqrt_alphas_cumprod': to_torch(torch.sqrt(alphas_cumprod)),
+        'sqrt_one_minus_alphas_cumprod': to_torch(torch.sqrt(1. - alphas_cumprod)),
+        'log_one_minus_alphas_cumprod': to_torch(torch.log(1. - alphas_cumprod)),
+        'sqrt_recip_alphas_cumprod': to_torch(torch.sqrt(1. / alphas_cumprod)),
+        'sqrt_recipm1_alphas_cumprod': to_torch(torch.sqrt(1. / alphas_cumprod - 1)),
+
+        'ddim_sigmas': to_torch(ddim_sigmas),
+        'ddim_alphas': to_torch(ddim_alphas),
+        'ddim_alphas_prev': to_torch(ddim_alphas_prev),
+        'ddim_sqrt_one_minus_alphas': to_torch(np.sqrt(1. - ddim_alphas)),
+        'ddim_sigmas_for_original_num_steps': to_torch(sigmas_for_original_sampling_steps),
+    }
+    cache[key] = schedule
+    return schedule
+
+
 def betas_for_alpha_bar(num_diffusion_timesteps, alpha_bar, max_beta=0.999):
     """
     Create a beta schedule that discretizes the given alpha_t_bar function,
@@ -152,7 +226,9 @@ class CheckpointFunction(torch.autograd.Function):
 
     @staticmethod
     def backward(ctx, *output_grads):
-        ctx.input_tensors = [x.detach().requires_grad_(True) for x in ctx.input_tensors]
+        # only differentiate w.r.t. the inputs that need it, e.g. not the timestep embedding of a frozen unet
+        needs_grad = list(ctx.needs_input_grad[2:2 + len(ctx.input_tensors)])
+        ctx.input_tensors = [x.detach().requires_grad_(n) for x, n in zip(ctx.input_tensors, needs_grad)]
         with torch.enable_grad():
             # Fixes a bug where the first op in run_function modifies the
             # Tensor storage in place, which is not allowed for detach()'d
@@ -164,19 +240,21 @@ class CheckpointFunction(torch.autograd.Function):
         mask = [torch.is_tensor(p) and p.requires_grad for p in params]
         active_params = [p for p, m in zip(params, mask) if m]
     
-        # Ask autograd for grads of: all (re-made) input_tensors + only the active params
+        # Ask autograd for grads of: the (re-made) input_tensors that need them + only the active params
+        active_tensors = [x for x, n in zip(ctx.input_tensors, needs_grad) if n]
         grads_active = torch.autograd.grad(
             outputs=output_tensors,
-            inputs=list(ctx.input_tensors) + active_params,
+            inputs=active_tensors + active_params,
             grad_outputs=output_grads,
             allow_unused=True,
             retain_graph=False,
             create_graph=False,
         )
     
-        # Split: first part corresponds to input_tensors (we forced requires_grad_=True)
-        n_t = len(ctx.input_tensors)
-        grads_tensors = list(grads_active[:n_t])
+        # Split: first part corresponds to the active input_tensors, pad back with None for the others
+        n_t = len(active_tensors)
+        it = iter(grads_active[:n_t])
+        grads_tensors = [next(it) if n else None for n in needs_grad]
         grads_active_params = list(grads_active[n_t:])
     
         # ---- pad back to original param order (None for frozen) ----
@@ -3,6 +3,8 @@
 from abc import abstractmethod
 from functools import partial
 import math
+import warnings
+from contextlib import nullcontext
 from typing import Iterable
 
 import numpy as np
@@ -315,6 +317,49 @@ class ResBlock(TimestepBlock):
         return self.skip_connection(x) + h
 
 
+def bipartite_soft_matching(metric, r):
+    """
+    ToMe (Bolya et al., Token Merging: Your ViT But Faster, https://arxiv.org/abs/2210.09461) on tokens
+    metric (B, C, T): even tokens are sources, odd ones destinations, and the r sources with the most
+    similar (cosine) destination are averaged into it. returns
+        merge:   (B, C', T) -> (B, C', T - r), applied to any per-token features of the same tokens
+        unmerge: (B, C', T - r) -> (B, C', T), copies each merged output back to all of its tokens
+    """
+    T = metric.shape[-1]
+    r = min(r, T // 2)
+    if r <= 0:
+        return (lambda x: x), (lambda x: x)
+
+    with th.no_grad():
+        metric = F.normalize(metric.float(), dim=1)
+        scores = metric[..., ::2].transpose(1, 2) @ metric[..., 1::2]  # (B, T_src, T_dst)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)           # most similar sources first
+        unm_idx, src_idx = edge_idx[:, r:], edge_idx[:, :r]
+        dst_idx = node_idx.gather(1, src_idx)                          # (B, r)
+
+    def index(idx, c):
+        return idx[:, None, :].expand(-1, c, -1)
+
+    def merge(x):
+        c = x.shape[1]
+        src, dst = x[..., ::2], x[..., 1::2]
+        unm = src.gather(2, index(unm_idx, c))
+        dst = dst.scatter_reduce(2, index(dst_idx, c), src.gather(2, index(src_idx, c)), reduce='mean')
+        return th.cat([unm, dst], dim=2)
+
+    def unmerge(x):
+        c, n_unm = x.shape[1], unm_idx.shape[1]
+        unm, dst = x[..., :n_unm], x[..., n_unm:]
+        out = x.new_zeros(x.shape[0], c, T)
+        out[..., 1::2] = dst
+        out.scatter_(2, index(2 * unm_idx, c), unm)
+        out.scatter_(2, index(2 * src_idx, c), dst.gather(2, index(dst_idx, c)))
+        return out
+
+    return merge, unmerge
+
+
 class AttentionBlock(nn.Module):
     """
     An attention block that allows spatial positions to attend to each other.
@@ -350,6 +395,8 @@ class AttentionBlock(nn.Module):
             self.attention = QKVAttentionLegacy(self.num_heads)
 
         self.proj_out = zero_module(conv_nd(1, channels, channels, 1))
+        # share of spatial tokens merged before the attention, see set_token_merging
+        self.merge_ratio = 0.
 
     def forward(self, x):
         return checkpoint(self._forward, (x,), self.parameters(), True)   # TODO: check checkpoint usage, is True # TODO: fix the .half call!!!
@@ -358,9 +405,11 @@ class AttentionBlock(nn.Module):
     def _forward(self, x):
         b, c, *spatial = x.shape
         x = x.reshape(b, c, -1)
-        qkv = self.qkv(self.norm(x))
+        h = self.norm(x)
+        merge, unmerge = bipartite_soft_matching(h, int(x.shape[-1] * self.merge_ratio))
+        qkv = self.qkv(merge(h))
         h = self.attention(qkv)
-        h = self.proj_out(h)
+        h = unmerge(self.proj_out(h))
         return (x + h).reshape(b, c, *spatial)
 
 import torch
@@ -378,32 +427,37 @@ class QKVPromptAttention(nn.Module):
     applies a learnable gate to their influence. With gate=0, behavior
     equals the original attention exactly (masking avoids softmax dilution).
     """
-    def __init__(self, n_heads, prompt_len, init_gate_logit=-20.0):
+    def __init__(self, n_heads, prompt_len, init_gate_logit=-20.0, use_sdpa=True):
         super().__init__()
         self.n_heads = n_heads
         self.prompt_len = prompt_len
         # Learnable scalar gate (shared across heads & batch). Start ~0.
         self.gate_logit = nn.Parameter(torch.tensor(float(init_gate_logit)))
+        # fused path, see forward_sdpa. the einsum path below stays as the reference / torch<2.0 fallback
+        self.use_sdpa = use_sdpa and hasattr(F, 'scaled_dot_product_attention')
 
     def forward(self, q, k, v):
         """
         q,k,v: shapes (B, H*C, T_total) where T_total = T_main (+ prompt_len when present)
-               We'll split main/prompt by T_main that the caller provides.
+               We'll split main/prompt by T_main that the caller provides. q may also be (B, H*C, T_main).
         """
-        bs, width, t_total = q.shape
+        if self.use_sdpa:
+            return self.forward_sdpa(q, k, v)
+        bs, width, t_total = k.shape
         ch = width // self.n_heads
         H = self.n_heads
 
-        # Reshape for einsums: (B*H, C_head, T)
-        q = q.view(bs*H, ch, t_total)
-        k = k.view(bs*H, ch, t_total)
-        v = v.view(bs*H, ch, t_total)
-
         # The caller will have concatenated [main | prompt] along T.
         # We need T_main to create a mask; pass via attribute set by the caller.
         T = self.T_main
         Tp = t_total - T
 
+        # Reshape for einsums: (B*H, C_head, T). only the main positions are queried,
+        # q may come with or without the prompt positions
+        q = q[:, :, :T].reshape(bs*H, ch, T)
+        k = k.reshape(bs*H, ch, t_total)
+        v = v.reshape(bs*H, ch, t_total)
+
         scale = 1.0 / (ch ** 0.5)
 
         # Compute logits
@@ -422,11 +476,47 @@ class QKVPromptAttention(nn.Module):
                 # (equivalent to multiplying exp(logits) by g)
                 logits[:, :, T:] = logits[:, :, T:] + torch.log(g)
 
-        attn = torch.softmax(logits, dim=-1).to(v.dtype)  # (BH, T, T_total)
+        attn = torch.softmax(logits.float(), dim=-1).to(v.dtype)  # (BH, T, T_total), fp32 softmax
         out = torch.einsum("bts,bcs->bct", attn, v)       # (BH, C_head, T)
         out = out.view(bs, H*ch, T)                       # (B, H*C, T)
         return out
 
+    def gate_bias(self, t_total, dtype, device):
+        """
+        Additive logit bias (t_total,): 0 on the main columns, log(sigmoid(gate_logit)) on the prompt columns.
+        Adding log(g) is the soft mask of the einsum path; once g underflows, exp(log g) does too, which is
+        the hard mask. Stays on the device and keeps the gradient of gate_logit.
+        """
+        T = self.T_main
+        log_g = F.logsigmoid(self.gate_logit).to(dtype)
+        return torch.cat([torch.zeros(T, dtype=dtype, device=device), log_g.expand(t_total - T)])
+
+    def forward_sdpa(self, q, k, v):
+        """ same as the einsum path through F.scaled_dot_product_attention, with the gate as attn_mask """
+        bs, width, t_total = k.shape
+        H = self.n_heads
+        ch = width // H
+        T = self.T_main
+
+        # (B, H, T, C_head). only the main positions are queried. the einsum path scales q and k by
+        # 1/sqrt(ch) each, so logits by 1/ch: sdpa applies 1/sqrt(ch) itself, the other half goes on q.
+        q = q[:, :, :T].reshape(bs, H, ch, T).transpose(2, 3) * (ch ** -0.5)
+        k = k.reshape(bs, H, ch, t_total).transpose(2, 3)
+        v = v.reshape(bs, H, ch, t_total).transpose(2, 3)
+
+        bias = None
+        if t_total > T:
+            bias = self.gate_bias(t_total, q.dtype, q.device).view(1, 1, 1, t_total)
+
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=bias)  # (B, H, T, C_head)
+        return out.transpose(2, 3).reshape(bs, H * ch, T)
+
+    @staticmethod
+    def count_flops(model, x, y):
+        # thop counter like QKVAttention.count_flops: the main queries attend to main + prompt keys
+        b, c, t_main = y[0].shape if isinstance(y, (list, tuple)) else y.shape
+        model.total_ops += th.DoubleTensor([attention_macs(b, c, t_main, x[1].shape[-1])])
+
 
 
 # class PromptedAttentionBlock(AttentionBlock):
@@ -461,8 +551,19 @@ class PromptedAttentionBlock(nn.Module):
     """
     Drop-in replacement for AttentionBlock that appends L learnable K/V prompts.
     With gate ~ 0, it exactly reproduces the pretrained block.
+
+    prompt_norm decides which tokens share the GroupNorm statistics:
+        'joint'     norm over [main | prompt] together (how prompts have been trained so far). the prompts
+                    shift the statistics of the main tokens by their L/(T+L) share, and the main tokens
+                    those of the prompts, so prompt K/V change every step.
+        'separate'  main tokens normalized on their own, exactly as in the pretrained AttentionBlock, and
+                    the prompt tokens on their own with the same affine parameters. prompt K/V then only
+                    depend on the prompt and the frozen norm/qkv weights.
+    prompt_kv_cache (needs 'separate', see set_prompt_mode): without grad, the prompt K/V are projected once
+    per prompt version and reused. the cache key holds the version counters of the soft prompt and of the
+    norm/qkv parameters, so an optimizer step or a load_state_dict invalidates it by itself.
     """
-    def __init__(self, base_attn_block: "AttentionBlock", prompt_len=8):
+    def __init__(self, base_attn_block: "AttentionBlock", prompt_len=8, prompt_norm='joint'):
         super().__init__()
         # Copy pretrained submodules/weights verbatim
         self.channels = base_attn_block.channels
@@ -476,37 +577,142 @@ class PromptedAttentionBlock(nn.Module):
         # soft prompt lives in channel dim
         # shape: (1, prompt_len, C) and gets broadcast to batch
         self.soft_prompt = SoftPrompt3D(self.prompt_len, self.channels)
-        nn.init.normal_(self.soft_prompt, mean=0.0, std=1e-5)  # near-zero start
+        nn.init.normal_(self.soft_prompt.bank, mean=0.0, std=1e-5)  # near-zero start
 
         # our custom attention (replaces QKVAttention/Legacy in effect)
         self.prompt_attention = QKVPromptAttention(self.num_heads, self.prompt_len)
 
+        if prompt_norm not in ['joint', 'separate']:
+            raise ValueError(f"prompt_norm must be 'joint' or 'separate', got {prompt_norm}")
+        self.prompt_norm = prompt_norm
+        self.prompt_kv_cache = False
+        self.prompt_kv = None       # (key, k_p, v_p)
+        # off by default, set_lean_backward turns it on for prompt training
+        self.use_checkpoint = False
+        # share of spatial tokens merged before the attention (never the prompts), see set_token_merging
+        self.merge_ratio = 0.
+
     def forward(self, x):
         # Keep identical control flow (including checkpointing) by mirroring AttentionBlock._forward:
-        return self._forward(x)
+        return checkpoint(self._forward, (x,), self.parameters(), self.use_checkpoint)
+
+    def project_prompt(self):
+        """ prompt keys and values (1, C', L) under prompt_norm='separate'. the q rows of qkv are skipped """
+        # C' = C unless heads were pruned (models/pruning.py)
+        c = self.qkv.weight.shape[0] // 3
+        p = self.soft_prompt(1).transpose(1, 2)   # (1, C, L)
+        kv = F.conv1d(self.norm(p), self.qkv.weight[c:], self.qkv.bias[c:])
+        return kv.chunk(2, dim=1)
+
+    def cached_prompt_kv(self, dtype, device):
+        bank = self.soft_prompt.bank
+        key = (bank.data_ptr(), bank._version, dtype, device) + tuple(
+            p._version for p in [self.norm.weight, self.norm.bias, self.qkv.weight, self.qkv.bias])
+        if self.prompt_kv is None or self.prompt_kv[0] != key:
+            k_p, v_p = self.project_prompt()
+            self.prompt_kv = (key, k_p.to(dtype), v_p.to(dtype))
+        return self.prompt_kv[1], self.prompt_kv[2]
 
     def _forward(self, x):
         b, c, *spatial = x.shape
         x_flat = x.reshape(b, c, -1)              # (B,C,T)
         T = x_flat.shape[-1]
 
-        # Build token sequence with prompts appended as extra positions
-        # prompts: (B, C, L)
-        p = self.soft_prompt(b)    # (B, L, C)
-        p = p.transpose(1, 2).contiguous()        # (B, C, L)
-        x_tok = torch.cat([x_flat, p], dim=2)     # (B, C, T+L)
-
-        # qkv over concatenated sequence (uses pretrained conv + norm)
-        qkv = self.qkv(self.norm(x_tok))          # (B, 3C, T+L)
-        q, k, v = qkv.chunk(3, dim=1)
+        if self.prompt_norm == 'separate':
+            # main tokens only through norm + qkv, prompt K/V appended (cached when sampling)
+            h = self.norm(x_flat)
+            merge, unmerge = bipartite_soft_matching(h, int(T * self.merge_ratio))
+            q, k, v = self.qkv(merge(h)).chunk(3, dim=1)
+            if self.prompt_kv_cache and not torch.is_grad_enabled():
+                k_p, v_p = self.cached_prompt_kv(k.dtype, k.device)
+            else:
+                k_p, v_p = self.project_prompt()
+            k = torch.cat([k, k_p.expand(b, -1, -1)], dim=2)
+            v = torch.cat([v, v_p.expand(b, -1, -1)], dim=2)
+        else:
+            # Build token sequence with prompts appended as extra positions
+            # prompts: (B, C, L)
+            p = self.soft_prompt(b)    # (B, L, C)
+            p = p.transpose(1, 2)                     # (B, C, L), torch.cat copies anyway
+            x_tok = torch.cat([x_flat, p], dim=2)     # (B, C, T+L)
+
+            # qkv over concatenated sequence (uses pretrained conv + norm), merging only the main tokens
+            h = self.norm(x_tok)
+            merge, unmerge = bipartite_soft_matching(h[:, :, :T], int(T * self.merge_ratio))
+            qkv = self.qkv(torch.cat([merge(h[:, :, :T]), h[:, :, T:]], dim=2))  # (B, 3C, T-r+L)
+            q, k, v = qkv.chunk(3, dim=1)
 
         # tell the attention where the split is so it can mask/gate prompts
-        self.prompt_attention.T_main = T
-        h = self.prompt_attention(q, k, v)        # (B, C, T)  (returns main positions only)
+        self.prompt_attention.T_main = k.shape[-1] - self.prompt_len
+        h = self.prompt_attention(q, k, v)        # (B, C, T-r)  (returns main positions only)
 
-        h = self.proj_out(h)
+        h = unmerge(self.proj_out(h))             # (B, C, T)
         return (x_flat + h).reshape(b, c, *spatial)
 
+def set_prompt_mode(model, prompt_norm=None, kv_cache=None):
+    """
+    Set prompt_norm / prompt_kv_cache on every PromptedAttentionBlock of `model` (None leaves it as is).
+    The K/V cache needs prompt_norm='separate'; turning it on for 'joint' blocks switches them to
+    'separate', which no longer matches prompts trained with 'joint' exactly, hence the warning.
+    """
+    for module in model.modules():
+        if not isinstance(module, PromptedAttentionBlock):
+            continue
+        if prompt_norm is not None:
+            module.prompt_norm = prompt_norm
+        if kv_cache is not None:
+            module.prompt_kv_cache = kv_cache
+            module.prompt_kv = None
+        if module.prompt_kv_cache and module.prompt_norm != 'separate':
+            warnings.warn("prompt K/V cache needs prompt_norm='separate', switching from 'joint'.")
+            module.prompt_norm = 'separate'
+
+
+def set_token_merging(model, ratio):
+    """
+    ToMe merge ratio of the self-attention of every AttentionBlock / PromptedAttentionBlock in `model`: the
+    share (at most 0.5) of spatial tokens merged into similar ones before the attention and copied back
+    after it. a float (or a 1-element list) applies to every block, a list gives one ratio per block in
+    model.modules() order, i.e. input, middle then output blocks. prompt tokens are never merged.
+    """
+    blocks = [m for m in model.modules() if isinstance(m, (AttentionBlock, PromptedAttentionBlock))]
+    ratios = list(ratio) if isinstance(ratio, (list, tuple)) else [ratio]
+    if len(ratios) == 1:
+        ratios = ratios * len(blocks)
+    if len(ratios) != len(blocks):
+        raise ValueError(f'{len(ratios)} merge ratios for {len(blocks)} attention blocks')
+    for block, r in zip(blocks, ratios):
+        if not 0. <= r <= 0.5:
+            raise ValueError(f'merge ratio must be in [0, 0.5], got {r}')
+        block.merge_ratio = r
+
+
+def set_lean_backward(model, enabled=True, checkpoint='attn'):
+    """
+    Activation-lean backward for training only the SoftPrompt3D banks of a frozen UNet.
+    enabled: every UNet3DModel in `model` runs its timestep embedding and the input blocks in front of
+    the first block with trainable parameters under no_grad, i.e. autograd only covers the paths that
+    reach a prompted attention block.
+    checkpoint: which blocks behind it recompute their activations in backward instead of storing them.
+        'none'  nothing (fastest, most memory)
+        'attn'  the PromptedAttentionBlocks, whose (B*heads, T, T+L) attention weights dominate
+        'all'   the ResBlocks too (as use_checkpoint in the config), for the largest replay batches
+    """
+    if checkpoint not in ['none', 'attn', 'all']:
+        raise ValueError(f"checkpoint must be 'none', 'attn' or 'all', got {checkpoint}")
+    for module in model.modules():
+        if isinstance(module, UNet3DModel):
+            module.lean_backward = enabled
+        elif isinstance(module, PromptedAttentionBlock):
+            module.use_checkpoint = checkpoint in ['attn', 'all']
+        elif isinstance(module, ResBlock):
+            module.use_checkpoint = checkpoint == 'all'
+
+
+def has_trainable(module):
+    return any(p.requires_grad for p in module.parameters())
+
+
 def count_flops_attn(model, _x, y):
     """
     A counter for the `thop` package to count the operations in an
@@ -520,11 +726,112 @@ def count_flops_attn(model, _x, y):
     """
     b, c, *spatial = y[0].shape
     num_spatial = int(np.prod(spatial))
-    # We perform two matmuls with the same number of ops.
-    # The first computes the weight matrix, the second computes
-    # the combination of the value vectors.
-    matmul_ops = 2 * b * (num_spatial ** 2) * c
-    model.total_ops += th.DoubleTensor([matmul_ops])
+    model.total_ops += th.DoubleTensor([attention_macs(b, c, num_spatial)])
+
+
+def attention_macs(batch, channels, n_q, n_k=None):
+    """
+    Multiply-accumulates of softmax(q k^T) v over all heads (channels = heads * head channels),
+    for n_q queries and n_k keys (n_k defaults to n_q, i.e. self-attention).
+    We perform two matmuls with the same number of ops: the first computes
+    the weight matrix, the second the combination of the value vectors.
+    """
+    n_k = n_q if n_k is None else n_k
+    return 2 * batch * n_q * n_k * channels
+
+
+# Static (shape-only) counterparts of count_flops_attn for whole blocks, used by models/cost_model.py to
+# estimate a config without building or running it. Each returns a dict:
+#     macs    multiply-accumulates of one forward
+#     params  # of parameters
+#     out     bytes of the block output
+#     peak    bytes the block allocates on top of its input at its high-water mark (no grad), output included
+# voxels / tokens are per sample, act_bytes is the activation element size (4 fp32, 2 under autocast).
+# attention weights are always counted in fp32 (the softmax runs in fp32), materialized as in the einsum path.
+
+def block_cost(macs=0, params=0, out=0, peak=0):
+    return dict(macs=macs, params=params, out=out, peak=max(peak, out))
+
+
+def sequential_cost(*costs):
+    """ layers applied one after the other: each one's input is the output of the one before """
+    peak, prev_out = 0, 0
+    for c in costs:
+        peak = max(peak, prev_out + c['peak'])
+        prev_out = c['out']
+    return block_cost(macs=sum(c['macs'] for c in costs), params=sum(c['params'] for c in costs),
+                      out=prev_out, peak=peak)
+
+
+def conv_cost(batch, c_in, c_out, out_voxels, kernel=27, act_bytes=4):
+    """ a dense convolution with bias, `kernel` = kernel volume (27 for 3x3x3) """
+    return block_cost(macs=batch * out_voxels * c_in * c_out * kernel, params=c_in * c_out * kernel + c_out,
+                      out=batch * c_out * out_voxels * act_bytes)
+
+
+def norm_act_cost(batch, channels, voxels, act_bytes=4):
+    """ GroupNorm + SiLU: two temporaries the size of the input """
+    size = batch * channels * voxels * act_bytes
+    return block_cost(params=2 * channels, out=size, peak=2 * size)
+
+
+def resblock_cost(batch, c_in, c_out, emb_channels, voxels, use_scale_shift_norm=False, act_bytes=4):
+    """ ResBlock without up/down sampling """
+    emb_out = 2 * c_out if use_scale_shift_norm else c_out
+    h = sequential_cost(norm_act_cost(batch, c_in, voxels, act_bytes), conv_cost(batch, c_in, c_out, voxels, 27, act_bytes),
+                        norm_act_cost(batch, c_out, voxels, act_bytes), conv_cost(batch, c_out, c_out, voxels, 27, act_bytes))
+    skip = conv_cost(batch, c_in, c_out, voxels, 1, act_bytes) if c_in != c_out else block_cost()
+    out = batch * c_out * voxels * act_bytes
+    # skip(x) is computed once h is done, then added: h, skip(x) and the sum
+    return block_cost(macs=h['macs'] + skip['macs'] + batch * emb_channels * emb_out,
+                      params=h['params'] + skip['params'] + (emb_channels * emb_out + emb_out if emb_channels else 0),
+                      out=out, peak=max(h['peak'], h['out'] + skip['out'] + out))
+
+
+def attention_block_cost(batch, channels, heads, tokens, prompt_len=0, merge_ratio=0., act_bytes=4):
+    """ AttentionBlock, or PromptedAttentionBlock with prompt_len soft prompt tokens (prompt_norm='joint') """
+    n = tokens - min(int(tokens * merge_ratio), tokens // 2)   # after token merging
+    size = lambda c, t: batch * c * t * act_bytes
+    qkv = size(3 * channels, n + prompt_len)
+    weights = batch * heads * n * (n + prompt_len) * 4
+    # [x | prompt] and its norm, then qkv, the weights and their softmax, the attention output and proj_out
+    peak = max(2 * size(channels, tokens + prompt_len) + qkv, qkv + 2 * weights + size(channels, n),
+               2 * size(channels, tokens) + size(channels, n))
+    return block_cost(macs=batch * (n + prompt_len) * channels * 3 * channels + attention_macs(batch, channels, n, n + prompt_len) +
+                      batch * n * channels * channels,
+                      params=2 * channels + 4 * channels * channels + 4 * channels + (prompt_len * channels + 1 if prompt_len else 0),
+                      out=size(channels, tokens), peak=peak)
+
+
+def spatial_transformer_cost(batch, channels, heads, d_head, tokens, depth=1, context_dim=None, context_len=77,
+                             prompt_len=8, mem_budget=None, act_bytes=4):
+    """
+    SpatialTransformer3D. the CrossAttention layers append prompt_len soft prompt tokens (projected once per call,
+    behind a gate) to their keys / values,
+    mem_budget (bytes, CrossAttention.attend) caps the attention weights of one call.
+    """
+    inner = heads * d_head
+    if context_dim is None:
+        # no context: attn2 is a second self-attention
+        context_dim, context_len = inner, tokens
+    size = lambda c, t: batch * c * t * act_bytes
+
+    def attn(n_k, c_k):
+        weights = 2 * batch * heads * tokens * (n_k + prompt_len) * 4
+        weights = min(weights, mem_budget) if mem_budget else weights
+        return dict(macs=batch * tokens * inner * inner * 2 + (batch * n_k + prompt_len) * c_k * inner * 2 +
+                    attention_macs(batch, inner, tokens, n_k + prompt_len),
+                    params=2 * inner * inner + 2 * c_k * inner + inner + (prompt_len * c_k + 1 if prompt_len else 0),
+                    peak=3 * size(inner, tokens) + weights)
+
+    self_attn, cross_attn = attn(tokens, inner), attn(context_len, context_dim)
+    ff = dict(macs=batch * tokens * inner * 12 * inner, params=12 * inner * inner + 9 * inner,
+              peak=size(12 * inner, tokens))
+    layer_peak = size(inner, tokens) + max(self_attn['peak'], cross_attn['peak'], ff['peak'])
+    return block_cost(macs=2 * batch * tokens * channels * inner + depth * (self_attn['macs'] + cross_attn['macs'] + ff['macs']),
+                      params=2 * channels + 2 * channels * inner + inner + channels +
+                      depth * (self_attn['params'] + cross_attn['params'] + ff['params'] + 6 * inner),
+                      out=size(channels, tokens), peak=size(channels, tokens) + layer_peak)
 
 
 class QKVAttentionLegacy(nn.Module):
@@ -593,6 +900,39 @@ class QKVAttention(nn.Module):
         return count_flops_attn(model, _x, y)
 
 
+class DeepCache(object):
+    """
+    Cross-step feature cache for UNet3DModel.forward (DeepCache, Ma et al. 2023).
+    A full call runs the whole UNet and keeps the feature entering the last `branch`
+    output blocks. The following `interval - 1` calls are shallow: they only run the
+    first `branch` input blocks and the last `branch` output blocks, and take the deep
+    path (remaining input blocks, middle block, inner output blocks) from the cache.
+    A call whose batch size differs from the cached feature is always full.
+    Attach with `unet.deep_cache = DeepCache(...)`, detach with `unet.deep_cache = None`.
+    """
+    def __init__(self, branch=1, interval=3):
+        assert branch >= 1 and interval >= 1
+        self.branch = branch
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self.feature = None
+        self.calls = 0
+        self.n_full = 0
+        self.n_shallow = 0
+
+    def use_full(self, x):
+        full = self.feature is None or self.feature.shape[0] != x.shape[0] or self.calls % self.interval == 0
+        if full:
+            self.calls = 0
+            self.n_full += 1
+        else:
+            self.n_shallow += 1
+        self.calls += 1
+        return full
+
+
 class UNet3DModel(nn.Module):
     """
     The full UNet model with attention and timestep embedding.
@@ -890,6 +1230,13 @@ class UNet3DModel(nn.Module):
             #nn.LogSoftmax(dim=1)  # change to cross_entropy and produce non-normalized logits
         )
 
+        # set by the samplers while sampling, see DeepCache
+        self.deep_cache = None
+        # channels-last activations, see models.model_utils.set_memory_format
+        self.channels_last = False
+        # prompt-only training, see set_lean_backward
+        self.lean_backward = False
+
     def convert_to_fp16(self):
         """
         Convert the torso of the model to float16.
@@ -906,6 +1253,13 @@ class UNet3DModel(nn.Module):
         self.middle_block.apply(convert_module_to_f32)
         self.output_blocks.apply(convert_module_to_f32)
 
+    def frozen_prefix(self):
+        """ # of input blocks in front of the first one with trainable parameters (e.g. a SoftPrompt3D bank) """
+        for i, module in enumerate(self.input_blocks):
+            if has_trainable(module):
+                return i
+        return len(self.input_blocks)
+
     def forward(self, x, timesteps=None, context=None, y=None,**kwargs):
         """
         Apply the model to an input batch.
@@ -919,8 +1273,11 @@ class UNet3DModel(nn.Module):
             self.num_classes is not None
         ), "must specify y if and only if the model is class-conditional"
         hs = []
-        t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
-        emb = self.time_embed(t_emb)
+        # lean_backward: the frozen prefix cannot depend on trainable parameters, so it runs without autograd
+        n_frozen = self.frozen_prefix() if self.lean_backward and th.is_grad_enabled() else 0
+        with th.no_grad() if n_frozen > 0 and not has_trainable(self.time_embed) else nullcontext():
+            t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
+            emb = self.time_embed(t_emb)
 
         if self.num_classes is not None:
             assert y.shape == (x.shape[0],)
@@ -929,18 +1286,36 @@ class UNet3DModel(nn.Module):
         # import pdb; pdb.set_trace()
         # h = x.type(self.dtype)
         h = x
+        if self.channels_last:
+            # once: convs, norms, interpolate and the skip th.cat keep the layout from here on
+            h = h.contiguous(memory_format=th.channels_last_3d)
         # print(h.type)
-        for module in self.input_blocks:
-            h = module(h, emb, context)
-            hs.append(h)
-        h = self.middle_block(h, emb, context)
-        for module in self.output_blocks:
-            h = th.cat([h, hs.pop()], dim=1)
-            h = module(h, emb, context)
+        cache = self.deep_cache
+        if cache is not None and not cache.use_full(x):
+            # shallow call: outermost blocks only, deep path from the last full call
+            for module in self.input_blocks[:cache.branch]:
+                h = module(h, emb, context)
+                hs.append(h)
+            h = cache.feature
+            for module in self.output_blocks[len(self.output_blocks) - cache.branch:]:
+                h = th.cat([h, hs.pop()], dim=1)
+                h = module(h, emb, context)
+        else:
+            for i, module in enumerate(self.input_blocks):
+                with th.no_grad() if i < n_frozen else nullcontext():
+                    h = module(h, emb, context)
+                hs.append(h)
+            h = self.middle_block(h, emb, context)
+            for i, module in enumerate(self.output_blocks):
+                if cache is not None and i == len(self.output_blocks) - cache.branch:
+                    cache.feature = h
+                h = th.cat([h, hs.pop()], dim=1)
+                h = module(h, emb, context)
         # h = h.type(x.dtype)
         # h = h
 
         if self.predict_codebook_ids:
-            return self.id_predictor(h)
+            out = self.id_predictor(h)
         else:
-            return self.out(h)
\ No newline at end of file
+            out = self.out(h)
+        return out.contiguous() if self.channels_last else out
\ No newline at end of file
@@ -1,60 +1,245 @@
 """SAMPLING ONLY."""
 """ Reference: https://github.com/CompVis/latent-diffusion/tree/main/ldm/models/diffusion """
 
+import warnings
+from contextlib import contextmanager
+
 import torch
 import numpy as np
 from tqdm import tqdm
 from functools import partial
 
 from models.networks.diffusion_networks.ldm_diffusion_util import (
-    make_ddim_sampling_parameters,
-    make_ddim_timesteps,
+    make_ddim_schedule,
     noise_like
 )
+from models.networks.diffusion_networks.openai_model_3d import DeepCache
+
+
+def ddim_update(x, e_t, a_t, a_prev, sigma_t, sqrt_one_minus_at, noise=None):
+    """ one deterministic DDIM update, noise is already scaled by temperature """
+    pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
+    dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
+    x_prev = a_prev.sqrt() * pred_x0 + dir_xt
+    if noise is not None:
+        x_prev = x_prev + sigma_t * noise
+    return x_prev, pred_x0
+
+
+def get_compiled_fns(model, mode=None):
+    """
+        torch.compile'd (apply_model, ddim_update) for this model.
+        dynamic=False: one graph per input shape, i.e. per (batch, cfg) combination.
+        the step coefficients are passed as tensors so the number of ddim steps never triggers a recompile.
+        memoized per mode on the model itself (samplers are rebuilt every call): the compiled apply_model holds a
+        reference to the model, so a cache keyed by the model elsewhere would keep both alive.
+    """
+    if not hasattr(model, '_compiled_ddim'):
+        model._compiled_ddim = {}
+    per_model = model._compiled_ddim
+    if mode not in per_model:
+        per_model[mode] = (
+            torch.compile(model.apply_model, mode=mode, dynamic=False),
+            torch.compile(ddim_update, mode=mode, dynamic=False),
+        )
+    return per_model[mode]
+
+
+class GuidanceSchedule(object):
+    """
+        classifier-free guidance with a timestep window and reuse of the unconditional prediction.
+
+        window: (t_min, t_max) in ddpm timesteps. guidance only runs for t_min <= t <= t_max, elsewhere the
+            scale is treated as 1, which for plain CFG is a single conditional forward without the concat.
+        uncond_every: recompute the unconditional branch every n guided steps and reuse it in between, so
+            those steps run only the conditional rows. 1 recomputes it on every step.
+        unet_rows counts the batch rows sent through the UNet since the last reset(), for cost reports.
+    """
+    def __init__(self, window=None, uncond_every=1):
+        self.window = window
+        self.uncond_every = uncond_every
+        self.reset()
+
+    def reset(self):
+        self.e_t_uncond = None
+        self.age = 0
+        self.unet_rows = 0
+
+    def guided(self, timestep):
+        if self.window is None or timestep is None:
+            return True
+        return self.window[0] <= timestep <= self.window[1]
+
+    def forward(self, apply_model, x, t, c):
+        self.unet_rows += x.shape[0]
+        return apply_model(x, t, c)
+
+    def __call__(self, apply_model, x, c, t, timestep=None, unconditional_guidance_scale=1.,
+                 unconditional_conditioning=None, mm_cls_free=False):
+        """ eps for x at t; timestep is t as a python int, to decide the window without a device sync """
+        if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
+            return self.forward(apply_model, x, t, c)
+
+        if not self.guided(timestep):
+            if not mm_cls_free:
+                return self.forward(apply_model, x, t, c)
+            # the mm combination still needs every branch, at scale 1
+            unconditional_guidance_scale = 1.
+
+        reuse = self.e_t_uncond is not None and self.age < self.uncond_every and self.e_t_uncond.shape[0] == x.shape[0]
+        if mm_cls_free:
+            c_img, c_txt, img_w, txt_w = c['c_img'], c['c_txt'], c['img_w'], c['txt_w']
+            c_img_with_txt = torch.cat([c_img, torch.zeros_like(c_txt)], dim=1)
+            c_txt_with_img  = torch.cat([torch.zeros_like(c_img), c_txt], dim=1)
+
+            if reuse:
+                x_in = torch.cat([x] * 2)
+                t_in = torch.cat([t] * 2)
+                c_in = torch.cat([c_img_with_txt, c_txt_with_img])
+                e_t_img, e_t_txt = self.forward(apply_model, x_in, t_in, c_in).chunk(2)
+            else:
+                uc_img, uc_txt = unconditional_conditioning['uc_img'], unconditional_conditioning['uc_txt']
+                mm_uc_feat = torch.cat([uc_img, uc_txt], dim=1)
+
+                x_in = torch.cat([x] * 3)
+                t_in = torch.cat([t] * 3)
+                c_in = torch.cat([mm_uc_feat, c_img_with_txt, c_txt_with_img])
+                self.e_t_uncond, e_t_img, e_t_txt = self.forward(apply_model, x_in, t_in, c_in).chunk(3)
+                self.age = 0
+            e_t_uncond = self.e_t_uncond
+            e_t = e_t_uncond + \
+                  unconditional_guidance_scale * img_w * (e_t_img - e_t_uncond) + \
+                  unconditional_guidance_scale * txt_w * (e_t_txt - e_t_uncond)
+        else:
+            if reuse:
+                e_t = self.forward(apply_model, x, t, c)
+            else:
+                x_in = torch.cat([x] * 2)
+                t_in = torch.cat([t] * 2)
+                c_in = torch.cat([unconditional_conditioning, c])
+                self.e_t_uncond, e_t = self.forward(apply_model, x_in, t_in, c_in).chunk(2)
+                self.age = 0
+            e_t = self.e_t_uncond + unconditional_guidance_scale * (e_t - self.e_t_uncond)
+
+        self.age += 1
+        return e_t
+
+
+def guided_eps(apply_model, x, c, t, unconditional_guidance_scale=1., unconditional_conditioning=None,
+               mm_cls_free=False):
+    """ eps prediction with (multi-modal) classifier-free guidance on every step, shared by the samplers """
+    return GuidanceSchedule()(apply_model, x, c, t,
+                              unconditional_guidance_scale=unconditional_guidance_scale,
+                              unconditional_conditioning=unconditional_conditioning,
+                              mm_cls_free=mm_cls_free)
+
+
+def sampler_kwargs(opt):
+    """ the sampler settings carried on an option object, for DDIMSampler / PLMSSampler(model, **sampler_kwargs(opt)) """
+    return dict(compile=opt.compile_sampler, guidance_window=opt.cfg_window, uncond_every=opt.uncond_every,
+                deep_cache_interval=opt.deep_cache_interval, deep_cache_branch=opt.deep_cache_branch,
+                ddim_discretize=opt.ddim_discretize)
+
+
+
+def make_sampler(model, opt):
+    """
+        the sampler of opt.sampler for model: DDIMSampler(model, **sampler_kwargs(opt)), or DPMSolverSampler
+        (order opt.dpm_order). DPM-Solver++ has no candidate pruning, streaming or trailing grid, so the online
+        loop, the batched / streaming paths and distilled students stay on DDIM
+    """
+    if opt.sampler == 'ddim':
+        return DDIMSampler(model, **sampler_kwargs(opt))
+    if opt.sampler == 'dpm_solver++':
+        if opt.student_ckpt is not None:
+            raise ValueError('distilled students sample on their trailing ddim grid, use --sampler ddim')
+        from models.networks.diffusion_networks.samplers.dpm_solver import DPMSolverSampler
+        return DPMSolverSampler(model, order=opt.dpm_order, deep_cache_interval=opt.deep_cache_interval,
+                                deep_cache_branch=opt.deep_cache_branch)
+    raise ValueError(f'unknown sampler {opt.sampler}')
+
+@contextmanager
+def deep_cache(model, branch=1, interval=1):
+    """ attach a DeepCache to the model's UNet for the duration of a sampling loop. interval=1 disables it """
+    if interval <= 1:
+        yield None
+        return
+    unet = model.df_module.diffusion_net
+    unet.deep_cache = DeepCache(branch=branch, interval=interval)
+    try:
+        yield unet.deep_cache
+    finally:
+        unet.deep_cache = None
+
+
+def select_batch(obj, keep, b):
+    """ rows `keep` of every batch-sized tensor in obj (tensor / list / dict), anything else is returned as is """
+    if isinstance(obj, torch.Tensor):
+        return obj[keep] if obj.dim() > 0 and obj.shape[0] == b else obj
+    if isinstance(obj, dict):
+        return {k: select_batch(v, keep, b) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(select_batch(v, keep, b) for v in obj)
+    return obj
+
 
 class DDIMSampler(object):
-    def __init__(self, model, schedule="linear", **kwargs):
+    def __init__(self, model, schedule="linear", compile=False, compile_mode=None,
+                 guidance_window=None, uncond_every=1, deep_cache_interval=1, deep_cache_branch=1,
+                 ddim_discretize="uniform", **kwargs):
         super().__init__()
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        # "trailing" for progressive-distillation students, see models/distillation.py
+        self.ddim_discretize = ddim_discretize
+        self.guidance = GuidanceSchedule(window=guidance_window, uncond_every=uncond_every)
+        self.deep_cache_interval = deep_cache_interval
+        self.deep_cache_branch = deep_cache_branch
+
+        if compile and not hasattr(torch, 'compile'):
+            warnings.warn('torch.compile needs torch>=2.0, falling back to eager DDIM sampling.')
+            compile = False
+        self.compile = compile
+        self.compile_mode = compile_mode
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            if attr.device != self.model.betas.device:
+                attr = attr.to(self.model.betas.device)
         setattr(self, name, attr)
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
-        self.ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
-                                                  num_ddpm_timesteps=self.ddpm_num_timesteps,verbose=verbose)
-        alphas_cumprod = self.model.alphas_cumprod
-        assert alphas_cumprod.shape[0] == self.ddpm_num_timesteps, 'alphas have to be defined for each timestep'
-        to_torch = lambda x: x.clone().detach().to(torch.float32).to(self.model.device)
-
-        self.register_buffer('betas', to_torch(self.model.betas))
-        self.register_buffer('alphas_cumprod', to_torch(alphas_cumprod))
-        self.register_buffer('alphas_cumprod_prev', to_torch(self.model.alphas_cumprod_prev))
-
-        # calculations for diffusion q(x_t | x_{t-1}) and others
-        self.register_buffer('sqrt_alphas_cumprod', to_torch(np.sqrt(alphas_cumprod.cpu())))
-        self.register_buffer('sqrt_one_minus_alphas_cumprod', to_torch(np.sqrt(1. - alphas_cumprod.cpu())))
-        self.register_buffer('log_one_minus_alphas_cumprod', to_torch(np.log(1. - alphas_cumprod.cpu())))
-        self.register_buffer('sqrt_recip_alphas_cumprod', to_torch(np.sqrt(1. / alphas_cumprod.cpu())))
-        self.register_buffer('sqrt_recipm1_alphas_cumprod', to_torch(np.sqrt(1. / alphas_cumprod.cpu() - 1)))
-
-        # ddim sampling parameters
-        ddim_sigmas, ddim_alphas, ddim_alphas_prev = make_ddim_sampling_parameters(alphacums=alphas_cumprod.cpu(),
-                                                                                   ddim_timesteps=self.ddim_timesteps,
-                                                                                   eta=ddim_eta,verbose=verbose)
-        self.register_buffer('ddim_sigmas', ddim_sigmas)
-        self.register_buffer('ddim_alphas', ddim_alphas)
-        self.register_buffer('ddim_alphas_prev', ddim_alphas_prev)
-        self.register_buffer('ddim_sqrt_one_minus_alphas', np.sqrt(1. - ddim_alphas))
-        sigmas_for_original_sampling_steps = ddim_eta * torch.sqrt(
-            (1 - self.alphas_cumprod_prev) / (1 - self.alphas_cumprod) * (
-                        1 - self.alphas_cumprod / self.alphas_cumprod_prev))
-        self.register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
+        # memoized per (steps, eta, discretize, device) on the model, see make_ddim_schedule
+        schedule = make_ddim_schedule(self.model, ddim_num_steps, ddim_discretize=ddim_discretize,
+                                      ddim_eta=ddim_eta, verbose=verbose)
+        for name, attr in schedule.items():
+            self.register_buffer(name, attr)
+        self.ddim_eta = ddim_eta
+
+    def prepare_sampling(self, S, batch_size, shape, conditioning=None, eta=0., verbose=True):
+        """ schedule for S steps and the full latent size for `shape` """
+        if conditioning is not None:
+            if isinstance(conditioning, dict):
+                # cbs = conditioning[list(conditioning.keys())[0]].shape[0]
+                cbs = conditioning[list(conditioning.keys())[0]][0].shape[0]
+                if cbs != batch_size:
+                    print(f"Warning: Got {cbs} conditionings but batch-size is {batch_size}")
+            else:
+                if conditioning.shape[0] != batch_size:
+                    print(f"Warning: Got {conditioning.shape[0]} conditionings but batch-size is {batch_size}")
+
+        self.make_schedule(ddim_num_steps=S, ddim_discretize=self.ddim_discretize, ddim_eta=eta, verbose=verbose)
+        # sampling
+        if len(shape) == 4:
+            C, D, H, W = shape
+            size = (batch_size, C, D, H, W)
+        else:
+            C, H, W = shape
+            size = (batch_size, C, H, W)
+        
+        print(f'Data shape for DDIM sampling is {size}, eta {eta}')
+        return size
 
     @torch.no_grad()
     def sample(self,
@@ -79,30 +264,21 @@ class DDIMSampler(object):
                unconditional_guidance_scale=1.,
                unconditional_conditioning=None,
                mm_cls_free=False,
+               prune_at=None,
+               prune_fn=None,
                # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
                **kwargs
                ):
-        if conditioning is not None:
-            if isinstance(conditioning, dict):
-                # cbs = conditioning[list(conditioning.keys())[0]].shape[0]
-                cbs = conditioning[list(conditioning.keys())[0]][0].shape[0]
-                if cbs != batch_size:
-                    print(f"Warning: Got {cbs} conditionings but batch-size is {batch_size}")
-            else:
-                if conditioning.shape[0] != batch_size:
-                    print(f"Warning: Got {conditioning.shape[0]} conditionings but batch-size is {batch_size}")
-
-        self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=verbose)
-        # sampling
-        if len(shape) == 4:
-            C, D, H, W = shape
-            size = (batch_size, C, D, H, W)
-        else:
-            C, H, W = shape
-            size = (batch_size, C, H, W)
-        
-        print(f'Data shape for DDIM sampling is {size}, eta {eta}')
+        """
+            log_every_t: keep x_t / pred_x0 every log_every_t steps in intermediates. None keeps nothing, for
+            callers that throw the intermediates away; use sample_iter to look at selected steps instead.
 
+            prune_at / prune_fn: after step `prune_at` (0 = first step), prune_fn(pred_x0) -> list of reasons
+            (None to keep) is called once; rejected candidates are dropped and the remaining steps run on the
+            smaller batch. intermediates['kept'] then holds the original batch indices of the returned samples
+            and intermediates['pruned'] one dict(index, step, reason) per dropped candidate.
+        """
+        size = self.prepare_sampling(S, batch_size, shape, conditioning=conditioning, eta=eta, verbose=verbose)
 
         samples, intermediates = self.ddim_sampling(conditioning, size,
                                                     callback=callback,
@@ -119,9 +295,54 @@ class DDIMSampler(object):
                                                     unconditional_guidance_scale=unconditional_guidance_scale,
                                                     unconditional_conditioning=unconditional_conditioning,
                                                     mm_cls_free=mm_cls_free,
+                                                    prune_at=prune_at, prune_fn=prune_fn,
                                                     )
         return samples, intermediates
 
+    @torch.no_grad()
+    def sample_iter(self,
+                    S,
+                    batch_size,
+                    shape,
+                    conditioning=None,
+                    steps=None,
+                    quantize_x0=False,
+                    eta=0.,
+                    mask=None,
+                    x0=None,
+                    temperature=1.,
+                    verbose=True,
+                    x_T=None,
+                    unconditional_guidance_scale=1.,
+                    unconditional_conditioning=None,
+                    mm_cls_free=False,
+                    prune_at=None,
+                    prune_fn=None,
+                    **kwargs
+                    ):
+        """
+            generator version of sample(): yields (step, x_t, pred_x0) as the steps are taken, step 0 being the
+            first (noisiest) one. nothing is kept between yields, so memory stays at the working latent.
+            steps: the step indices to yield, None for all of them. the last step is always yielded, its x_t is
+            the sample. with pruning (see sample) the kept / pruned candidates are on self.kept / self.pruned.
+        """
+        size = self.prepare_sampling(S, batch_size, shape, conditioning=conditioning, eta=eta, verbose=verbose)
+        total_steps = self.ddim_timesteps.shape[0]
+        steps = None if steps is None else set(steps)
+
+        for i, img, pred_x0 in self.ddim_sampling_iter(conditioning, size,
+                                                       quantize_denoised=quantize_x0,
+                                                       mask=mask, x0=x0,
+                                                       temperature=temperature,
+                                                       x_T=x_T,
+                                                       unconditional_guidance_scale=unconditional_guidance_scale,
+                                                       unconditional_conditioning=unconditional_conditioning,
+                                                       mm_cls_free=mm_cls_free,
+                                                       prune_at=prune_at, prune_fn=prune_fn,
+                                                       ):
+            if steps is None or i in steps or i == total_steps - 1 or img.shape[0] == 0:
+                yield i, img, pred_x0
+
     @torch.no_grad()
     def ddim_sampling(self, cond, shape,
                       x_T=None, ddim_use_original_steps=False,
@@ -129,9 +350,57 @@ class DDIMSampler(object):
                       mask=None, x0=None, img_callback=None, log_every_t=100,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
                       unconditional_guidance_scale=1., unconditional_conditioning=None,
-                      mm_cls_free=False,
+                      mm_cls_free=False, prune_at=None, prune_fn=None,
                       ):
         device = self.model.betas.device
+        if x_T is None:
+            img = torch.randn(shape, device=device)
+        else:
+            img = x_T
+
+        # same step count as ddim_sampling_iter, for the log_every_t bookkeeping
+        if ddim_use_original_steps:
+            total_steps = self.ddpm_num_timesteps if timesteps is None else timesteps
+        elif timesteps is None:
+            total_steps = self.ddim_timesteps.shape[0]
+        else:
+            total_steps = int(min(timesteps / self.ddim_timesteps.shape[0], 1) * self.ddim_timesteps.shape[0]) - 1
+
+        intermediates = {} if log_every_t is None else {'x_inter': [img], 'pred_x0': [img]}
+        for i, img, pred_x0 in self.ddim_sampling_iter(cond, shape, x_T=img,
+                                                       ddim_use_original_steps=ddim_use_original_steps,
+                                                       callback=callback, timesteps=timesteps,
+                                                       quantize_denoised=quantize_denoised,
+                                                       mask=mask, x0=x0, img_callback=img_callback,
+                                                       temperature=temperature, noise_dropout=noise_dropout,
+                                                       score_corrector=score_corrector,
+                                                       corrector_kwargs=corrector_kwargs,
+                                                       unconditional_guidance_scale=unconditional_guidance_scale,
+                                                       unconditional_conditioning=unconditional_conditioning,
+                                                       mm_cls_free=mm_cls_free,
+                                                       prune_at=prune_at, prune_fn=prune_fn,
+                                                       ):
+            index = total_steps - i - 1
+            if log_every_t is not None and (index % log_every_t == 0 or index == total_steps - 1):
+                intermediates['x_inter'].append(img)
+                intermediates['pred_x0'].append(pred_x0)
+
+        if prune_fn is not None:
+            intermediates.update({'kept': self.kept, 'pruned': self.pruned})
+
+        return img, intermediates
+
+    @torch.no_grad()
+    def ddim_sampling_iter(self, cond, shape,
+                           x_T=None, ddim_use_original_steps=False,
+                           callback=None, timesteps=None, quantize_denoised=False,
+                           mask=None, x0=None, img_callback=None,
+                           temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
+                           unconditional_guidance_scale=1., unconditional_conditioning=None,
+                           mm_cls_free=False, prune_at=None, prune_fn=None,
+                           ):
+        """ the ddim loop, yielding (i, x_t, pred_x0) after every step """
+        device = self.model.betas.device
         b = shape[0]
         if x_T is None:
             img = torch.randn(shape, device=device)
@@ -144,39 +413,90 @@ class DDIMSampler(object):
             subset_end = int(min(timesteps / self.ddim_timesteps.shape[0], 1) * self.ddim_timesteps.shape[0]) - 1
             timesteps = self.ddim_timesteps[:subset_end]
 
-        intermediates = {'x_inter': [img], 'pred_x0': [img]}
+        self.guidance.reset()
+        if prune_fn is not None:
+            self.kept, self.pruned = torch.arange(b, device=device), []
         time_range = reversed(range(0,timesteps)) if ddim_use_original_steps else np.flip(timesteps)
         total_steps = timesteps if ddim_use_original_steps else timesteps.shape[0]
         print(f"Running DDIM Sampling with {total_steps} timesteps")
 
-        iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps)
+        # the compiled path skips the progress bar, its per-step host overhead shows up at small latents
+        iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps, disable=self.compile)
 
-        for i, step in enumerate(iterator):
-            index = total_steps - i - 1
-            ts = torch.full((b,), step, device=device, dtype=torch.long)
-
-            if mask is not None:
-                assert x0 is not None
-                img_orig = self.model.q_sample(x0, ts)  # TODO: deterministic forward pass?
-                img = img_orig * mask + (1. - mask) * img
-
-            outs = self.p_sample_ddim(img, cond, ts, index=index, use_original_steps=ddim_use_original_steps,
-                                      quantize_denoised=quantize_denoised, temperature=temperature,
-                                      noise_dropout=noise_dropout, score_corrector=score_corrector,
-                                      corrector_kwargs=corrector_kwargs,
-                                      unconditional_guidance_scale=unconditional_guidance_scale,
-                                      unconditional_conditioning=unconditional_conditioning,
-                                      mm_cls_free=mm_cls_free,
-                                      )
-            img, pred_x0 = outs
-            if callback: callback(i)
-            if img_callback: img_callback(pred_x0, i)
-
-            if index % log_every_t == 0 or index == total_steps - 1:
-                intermediates['x_inter'].append(img)
-                intermediates['pred_x0'].append(pred_x0)
+        with deep_cache(self.model, self.deep_cache_branch, self.deep_cache_interval):
+            for i, step in enumerate(iterator):
+                index = total_steps - i - 1
+                ts = torch.full((b,), step, device=device, dtype=torch.long)
 
-        return img, intermediates
+                if mask is not None:
+                    assert x0 is not None
+                    img_orig = self.model.q_sample(x0, ts)  # TODO: deterministic forward pass?
+                    img = img_orig * mask + (1. - mask) * img
+
+                if self.compile and not (quantize_denoised or noise_dropout > 0. or score_corrector is not None):
+                    outs = self.p_sample_ddim_compiled(img, cond, ts, index=index, use_original_steps=ddim_use_original_steps,
+                                                       temperature=temperature,
+                                                       unconditional_guidance_scale=unconditional_guidance_scale,
+                                                       unconditional_conditioning=unconditional_conditioning,
+                                                       mm_cls_free=mm_cls_free,
+                                                       )
+                else:
+                    outs = self.p_sample_ddim(img, cond, ts, index=index, use_original_steps=ddim_use_original_steps,
+                                              quantize_denoised=quantize_denoised, temperature=temperature,
+                                              noise_dropout=noise_dropout, score_corrector=score_corrector,
+                                              corrector_kwargs=corrector_kwargs,
+                                              unconditional_guidance_scale=unconditional_guidance_scale,
+                                              unconditional_conditioning=unconditional_conditioning,
+                                              mm_cls_free=mm_cls_free,
+                                              )
+                img, pred_x0 = outs
+                if callback: callback(i)
+                if img_callback: img_callback(pred_x0, i)
+
+                if prune_fn is not None and i == prune_at:
+                    reasons = prune_fn(pred_x0)
+                    keep = torch.tensor([r is None for r in reasons], device=device)
+                    self.pruned += [dict(index=int(self.kept[j]), step=i, reason=r)
+                                    for j, r in enumerate(reasons) if r is not None]
+                    if not keep.all():
+                        img, pred_x0, cond, x0, mask, unconditional_conditioning = [
+                            select_batch(o, keep, b) for o in (img, pred_x0, cond, x0, mask, unconditional_conditioning)]
+                        self.kept = self.kept[keep]
+                        b = img.shape[0]
+
+                yield i, img, pred_x0
+                if b == 0:
+                    break
+
+    def get_step_params(self, index, ndim, use_original_steps=False):
+        """ (a_t, a_prev, sigma_t, sqrt_one_minus_at) at `index`, shaped to broadcast against a ndim-d x """
+        alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
+        alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
+        sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod if use_original_steps else self.ddim_sqrt_one_minus_alphas
+        sigmas = self.model.ddim_sigmas_for_original_num_steps if use_original_steps else self.ddim_sigmas
+
+        # select parameters corresponding to the currently considered timestep.
+        # indexing gives views into the cached schedule instead of four torch.full allocations per step
+        param_shape = (1,) * ndim
+        return tuple(p[index].view(param_shape) for p in (alphas, alphas_prev, sigmas, sqrt_one_minus_alphas))
+
+    @torch.no_grad()
+    def p_sample_ddim_compiled(self, x, c, t, index, use_original_steps=False, temperature=1.,
+                               unconditional_guidance_scale=1., unconditional_conditioning=None, mm_cls_free=False):
+        apply_model, update = get_compiled_fns(self.model, self.compile_mode)
+
+        timestep = index if use_original_steps else int(self.ddim_timesteps[index])
+        e_t = self.guidance(apply_model, x, c, t, timestep=timestep,
+                            unconditional_guidance_scale=unconditional_guidance_scale,
+                            unconditional_conditioning=unconditional_conditioning,
+                            mm_cls_free=mm_cls_free)
+
+        a_t, a_prev, sigma_t, sqrt_one_minus_at = self.get_step_params(index, x.dim(), use_original_steps)
+        # eta=0 is deterministic, skip drawing noise that would be multiplied by zero
+        noise = None
+        if use_original_steps or self.ddim_eta != 0.:
+            noise = torch.randn_like(x) * temperature
+        return update(x, e_t, a_t, a_prev, sigma_t, sqrt_one_minus_at, noise)
 
     @torch.no_grad()
     def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
@@ -184,51 +504,17 @@ class DDIMSampler(object):
                       unconditional_guidance_scale=1., unconditional_conditioning=None, mm_cls_free=False):
         b, *_, device = *x.shape, x.device
 
-        if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
-            e_t = self.model.apply_model(x, t, c)
-        elif mm_cls_free:
-
-            uc_img, uc_txt = unconditional_conditioning['uc_img'], unconditional_conditioning['uc_txt']
-            mm_uc_feat = torch.cat([uc_img, uc_txt], dim=1)
-
-            c_img, c_txt, img_w, txt_w = c['c_img'], c['c_txt'], c['img_w'], c['txt_w']
-            c_img_with_txt = torch.cat([c_img, torch.zeros_like(c_txt)], dim=1)
-            c_txt_with_img  = torch.cat([torch.zeros_like(c_img), c_txt], dim=1)
-            
-            x_in = torch.cat([x] * 3)
-            t_in = torch.cat([t] * 3)
-            c_in = torch.cat([mm_uc_feat, c_img_with_txt, c_txt_with_img])
-            e_t_uncond, e_t_img, e_t_txt = self.model.apply_model(x_in, t_in, c_in).chunk(3)
-            e_t = e_t_uncond + \
-                  unconditional_guidance_scale * img_w * (e_t_img - e_t_uncond) + \
-                  unconditional_guidance_scale * txt_w * (e_t_txt - e_t_uncond)
-        else:
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([t] * 2)
-            c_in = torch.cat([unconditional_conditioning, c])
-            e_t_uncond, e_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
-            e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
+        timestep = index if use_original_steps else int(self.ddim_timesteps[index])
+        e_t = self.guidance(self.model.apply_model, x, c, t, timestep=timestep,
+                            unconditional_guidance_scale=unconditional_guidance_scale,
+                            unconditional_conditioning=unconditional_conditioning,
+                            mm_cls_free=mm_cls_free)
 
         if score_corrector is not None:
             assert self.model.parameterization == "eps"
             e_t = score_corrector.modify_score(self.model, e_t, x, t, c, **corrector_kwargs)
 
-        alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
-        alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
-        sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod if use_original_steps else self.ddim_sqrt_one_minus_alphas
-        sigmas = self.model.ddim_sigmas_for_original_num_steps if use_original_steps else self.ddim_sigmas
-
-        # select parameters corresponding to the currently considered timestep
-        
-        if x.dim() == 5:
-            param_shape = (b, 1, 1, 1, 1)
-        else:
-            param_shape = (b, 1, 1, 1)
-
-        a_t = torch.full(param_shape, alphas[index], device=device)
-        a_prev = torch.full(param_shape, alphas_prev[index], device=device)
-        sigma_t = torch.full(param_shape, sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full(param_shape, sqrt_one_minus_alphas[index],device=device)
+        a_t, a_prev, sigma_t, sqrt_one_minus_at = self.get_step_params(index, x.dim(), use_original_steps)
 
         # current prediction for x_0
         pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
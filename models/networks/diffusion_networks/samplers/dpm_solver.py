@@ -0,0 +1,189 @@
+"""SAMPLING ONLY."""
+""" Reference: DPM-Solver++ (Lu et al., 2022), https://github.com/LuChengTHU/dpm-solver """
+
+import math
+
+import torch
+import numpy as np
+from tqdm import tqdm
+
+from models.networks.diffusion_networks.samplers.ddim import guided_eps, deep_cache
+
+
+class DPMSolverSampler(object):
+    """
+        multistep DPM-Solver++ in data-prediction form for the discrete-time eps model.
+        order=2 is DPM-Solver++(2M), order=3 is DPM-Solver++(3M); the first steps warm up with lower orders.
+        deterministic (an ODE solver), so eta has to be 0. 10-20 steps is the intended range.
+    """
+    def __init__(self, model, order=2, lower_order_final=True, deep_cache_interval=1, deep_cache_branch=1, **kwargs):
+        super().__init__()
+        if order not in [1, 2, 3]:
+            raise ValueError(f'DPM-Solver++ order must be 1, 2 or 3, got {order}')
+        self.model = model
+        self.ddpm_num_timesteps = model.num_timesteps
+        self.order = order
+        self.lower_order_final = lower_order_final
+        self.deep_cache_interval = deep_cache_interval
+        self.deep_cache_branch = deep_cache_branch
+
+    def make_schedule(self, num_steps, verbose=True):
+        # time-uniform grid from T-1 down to 0, ending on the same t=0 as the last DDIM step
+        self.dpm_timesteps = np.linspace(self.ddpm_num_timesteps - 1, 0, num_steps + 1).round().astype(np.int64)
+        # coefficients stay float64 python scalars on the host: no per-step allocation or device sync
+        alphas_cumprod = self.model.alphas_cumprod.detach().cpu().double().numpy()[self.dpm_timesteps]
+        self.dpm_alphas = np.sqrt(alphas_cumprod)
+        self.dpm_sigmas = np.sqrt(1. - alphas_cumprod)
+        self.dpm_lambdas = np.log(self.dpm_alphas) - np.log(self.dpm_sigmas)
+        if verbose:
+            print(f'Selected timesteps for DPM-Solver++ sampler: {self.dpm_timesteps}')
+
+    @torch.no_grad()
+    def sample(self,
+               S,
+               batch_size,
+               shape,
+               conditioning=None,
+               callback=None,
+               normals_sequence=None,
+               img_callback=None,
+               quantize_x0=False,
+               eta=0.,
+               mask=None,
+               x0=None,
+               temperature=1.,
+               noise_dropout=0.,
+               score_corrector=None,
+               corrector_kwargs=None,
+               verbose=True,
+               x_T=None,
+               log_every_t=100,
+               unconditional_guidance_scale=1.,
+               unconditional_conditioning=None,
+               mm_cls_free=False,
+               # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+               **kwargs
+               ):
+        if eta != 0:
+            raise ValueError('eta must be 0 for DPM-Solver++')
+
+        if conditioning is not None:
+            if isinstance(conditioning, dict):
+                cbs = conditioning[list(conditioning.keys())[0]][0].shape[0]
+                if cbs != batch_size:
+                    print(f"Warning: Got {cbs} conditionings but batch-size is {batch_size}")
+            else:
+                if conditioning.shape[0] != batch_size:
+                    print(f"Warning: Got {conditioning.shape[0]} conditionings but batch-size is {batch_size}")
+
+        self.make_schedule(num_steps=S, verbose=verbose)
+        # sampling
+        if len(shape) == 4:
+            C, D, H, W = shape
+            size = (batch_size, C, D, H, W)
+        else:
+            C, H, W = shape
+            size = (batch_size, C, H, W)
+
+        print(f'Data shape for DPM-Solver++({self.order}M) sampling is {size}')
+
+        samples, intermediates = self.dpm_sampling(conditioning, size,
+                                                   callback=callback,
+                                                   img_callback=img_callback,
+                                                   quantize_denoised=quantize_x0,
+                                                   mask=mask, x0=x0,
+                                                   score_corrector=score_corrector,
+                                                   corrector_kwargs=corrector_kwargs,
+                                                   x_T=x_T,
+                                                   log_every_t=log_every_t,
+                                                   unconditional_guidance_scale=unconditional_guidance_scale,
+                                                   unconditional_conditioning=unconditional_conditioning,
+                                                   mm_cls_free=mm_cls_free,
+                                                   )
+        return samples, intermediates
+
+    @torch.no_grad()
+    def dpm_sampling(self, cond, shape, x_T=None, callback=None, quantize_denoised=False,
+                     mask=None, x0=None, img_callback=None, log_every_t=100,
+                     score_corrector=None, corrector_kwargs=None,
+                     unconditional_guidance_scale=1., unconditional_conditioning=None, mm_cls_free=False):
+        device = self.model.betas.device
+        b = shape[0]
+        if x_T is None:
+            img = torch.randn(shape, device=device)
+        else:
+            img = x_T
+
+        intermediates = {} if log_every_t is None else {'x_inter': [img], 'pred_x0': [img]}
+        total_steps = len(self.dpm_timesteps) - 1
+        print(f"Running DPM-Solver++ Sampling with {total_steps} timesteps")
+
+        iterator = tqdm(self.dpm_timesteps[:-1], desc='DPM-Solver++ Sampler', total=total_steps)
+        old_x0 = []
+
+        with deep_cache(self.model, self.deep_cache_branch, self.deep_cache_interval):
+            for i, step in enumerate(iterator):
+                index = total_steps - i - 1
+                ts = torch.full((b,), step, device=device, dtype=torch.long)
+
+                if mask is not None:
+                    assert x0 is not None
+                    img_orig = self.model.q_sample(x0, ts)
+                    img = img_orig * mask + (1. - mask) * img
+
+                e_t = guided_eps(self.model.apply_model, img, cond, ts,
+                                 unconditional_guidance_scale=unconditional_guidance_scale,
+                                 unconditional_conditioning=unconditional_conditioning,
+                                 mm_cls_free=mm_cls_free)
+                if score_corrector is not None:
+                    assert self.model.parameterization == "eps"
+                    e_t = score_corrector.modify_score(self.model, e_t, img, ts, cond, **corrector_kwargs)
+
+                pred_x0 = (img - float(self.dpm_sigmas[i]) * e_t) / float(self.dpm_alphas[i])
+                if quantize_denoised:
+                    pred_x0, _, *_ = self.model.vqvae.quantize(pred_x0, is_voxel=True)
+
+                old_x0.append(pred_x0)
+                if len(old_x0) > self.order:
+                    old_x0.pop(0)
+
+                order = min(self.order, i + 1)
+                if self.lower_order_final and total_steps < 15:
+                    # higher orders are unstable on the last, largest steps of very short schedules
+                    order = min(order, total_steps - i)
+
+                img = self.multistep_update(img, old_x0, i, order)
+                if callback: callback(i)
+                if img_callback: img_callback(pred_x0, i)
+
+                if log_every_t is not None and (index % log_every_t == 0 or index == total_steps - 1):
+                    intermediates['x_inter'].append(img)
+                    intermediates['pred_x0'].append(pred_x0)
+
+        return img, intermediates
+
+    def multistep_update(self, x, old_x0, i, order):
+        """ x at dpm_timesteps[i] -> x at dpm_timesteps[i + 1] from the last `order` data predictions """
+        lambdas, alphas, sigmas = self.dpm_lambdas.tolist(), self.dpm_alphas.tolist(), self.dpm_sigmas.tolist()
+        s, t0 = i + 1, i
+        h = lambdas[s] - lambdas[t0]
+        phi_1 = math.expm1(-h)  # exp(-h) - 1
+
+        m0 = old_x0[-1]
+        x_s = (sigmas[s] / sigmas[t0]) * x - (alphas[s] * phi_1) * m0
+        if order == 1:
+            # first order DPM-Solver++ is DDIM
+            return x_s
+
+        t1 = i - 1
+        r0 = (lambdas[t0] - lambdas[t1]) / h
+        D1_0 = (1. / r0) * (m0 - old_x0[-2])
+        if order == 2:
+            return x_s - (0.5 * alphas[s] * phi_1) * D1_0
+
+        t2 = i - 2
+        r1 = (lambdas[t1] - lambdas[t2]) / h
+        D1_1 = (1. / r1) * (old_x0[-2] - old_x0[-3])
+        D1 = D1_0 + (r0 / (r0 + r1)) * (D1_0 - D1_1)
+        D2 = (1. / (r0 + r1)) * (D1_0 - D1_1)
+        return x_s + (alphas[s] * (phi_1 / h + 1.)) * D1 - (alphas[s] * ((phi_1 + h) / h ** 2 - 0.5)) * D2
@@ -14,6 +14,7 @@ from einops import rearrange
 
 from models.networks.vqvae_networks.vqvae_modules import Encoder3D, Decoder3D
 from models.networks.vqvae_networks.quantizer import VectorQuantizer
+from models.networks.vqvae_networks.tiled_decode import decode_tiled, quantize_slabs
 
 def init_weights(net, init_type='normal', gain=0.01):
     def init_func(m):
@@ -102,6 +103,15 @@ class VQVAE(nn.Module):
         dec = self.decoder(quant)
         return dec
 
+    def decode_no_quant_tiled(self, h, tile=None, overlap=None, mem_budget=None, store=None, force_not_quantize=False):
+        """ decode_no_quant through overlapping tiles of the latent, see tiled_decode.py. mem_budget in bytes """
+        if not force_not_quantize:
+            quant = quantize_slabs(self.quantize, h, mem_budget)
+        else:
+            quant = h
+        quant = self.post_quant_conv(quant)
+        return decode_tiled(self.decoder, quant, tile=tile, overlap=overlap, mem_budget=mem_budget, store=store)
+
     def decode_from_quant(self,quant_code):
         embed_from_code = self.quantize.embedding(quant_code)
         return embed_from_code
@@ -0,0 +1,237 @@
+""" Tiled VQ-VAE decoding (VQVAE.decode_no_quant_tiled) for outputs that do not fit one Decoder3D pass.
+
+    The latent is quantized in slabs (nearest code per voxel, exact). conv_in and the mid blocks run on the whole
+    latent, with the mid AttnBlock over all voxels in query chunks (exact). The up path (ResnetBlocks, Upsample,
+    norm_out, conv_out) then runs on overlapping tiles of the latent grid, one layer over all tiles at a time:
+        GroupNorm   statistics over the tile cores (every voxel once), i.e. the statistics of the full volume
+        convs       per tile, zero padded at the tile border, so each conv spoils 1 voxel of the tile's halo
+        AttnBlock   (up levels with attn_resolutions) queries per tile against the keys / values of all cores
+    and the tiles are blended into the output with weights ramping down over the part of their halos the padding
+    did not reach. With an overlap of at least receptive_margin(decoder) latent voxels (4.5 for vqvae_snet) that
+    part exists on every side and the output is the full decode up to float rounding; smaller overlaps cost less
+    and ramp over the whole halo instead, blending the remaining seams.
+
+    tile (latent voxels per side of a tile core) or mem_budget (bytes, picks the largest tile whose working set
+    fits, see tile_for_budget) bound the memory of one tile. Between layers the tiles wait on `store`: the
+    device itself by default, 'cpu' to bound device memory by one tile.
+"""
+
+import math
+import itertools
+
+import torch
+import torch.nn.functional as F
+
+from models.networks.vqvae_networks.vqvae_modules import nonlinearity
+
+# conv activations alive per tile in a ResnetBlock: input, hidden, its normalized copy and the output
+TILE_TENSORS = 4
+
+
+def receptive_margin(decoder):
+    """ how far (latent voxels, fractional) into a tile's halo the zero padding of the up-path convs reaches """
+    margin, scale = 0., 1
+    for i_level in reversed(range(decoder.num_resolutions)):
+        # conv1 and conv2 of every ResnetBlock (the shortcut runs next to them)
+        margin += 2 * decoder.num_res_blocks / scale
+        if i_level != 0:
+            scale *= 2
+            if decoder.up[i_level].upsample.with_conv:
+                margin += 1 / scale
+    if not decoder.give_pre_end:
+        # conv_out
+        margin += 1 / scale
+    return margin
+
+
+def tile_for_budget(decoder, z_shape, batch, mem_budget, overlap, act_bytes=4):
+    """ the largest tile (latent voxels per side) whose up-path activations stay under mem_budget bytes """
+    spatial = z_shape[-3:]
+    # (widest activation, scale) per level of the up path
+    levels = [(max(max(blk.in_channels, blk.out_channels) for blk in decoder.up[i].block),
+               2 ** (decoder.num_resolutions - 1 - i)) for i in range(decoder.num_resolutions)]
+    for tile in range(max(spatial), 0, -1):
+        vox = [min(tile + 2 * overlap, s) for s in spatial]
+        peak = max(TILE_TENSORS * batch * c * math.prod(v * f for v in vox) * act_bytes for c, f in levels)
+        if peak <= mem_budget:
+            return tile
+    return 1
+
+
+def tile_grid(spatial, tile, overlap):
+    """ [(core, pad)] of the tiles: per spatial dim the (start, end) of the core and of the core + overlap """
+    ranges = [[(s, min(s + tile, size)) for s in range(0, size, tile)] for size in spatial]
+    grid = []
+    for core in itertools.product(*ranges):
+        pad = tuple((max(0, s - overlap), min(size, e + overlap)) for (s, e), size in zip(core, spatial))
+        grid.append((core, pad))
+    return grid
+
+
+def _crop(x, box, scale=1):
+    return x[(Ellipsis,) + tuple(slice(s * scale, e * scale) for s, e in box)]
+
+
+def _core(core, pad):
+    """ the core of a tile relative to its padded box """
+    return tuple((cs - ps, ce - ps) for (cs, ce), (ps, _) in zip(core, pad))
+
+
+def _attend(q, k, v, mem_budget=None):
+    """ AttnBlock attention of queries (b, c, n) over keys / values (b, c, m), in query chunks under mem_budget """
+    b, c, n = q.shape
+    m = k.shape[-1]
+    # the (b, chunk, m) weights and their softmax
+    chunk = n if mem_budget is None else max(1, int(mem_budget // (2 * b * m * q.element_size())))
+    out = []
+    for i in range(0, n, chunk):
+        w = torch.bmm(q[:, :, i:i + chunk].permute(0, 2, 1), k) * (int(c) ** (-0.5))
+        w = F.softmax(w, dim=2)
+        out.append(torch.bmm(v, w.permute(0, 2, 1)))
+    return torch.cat(out, dim=2)
+
+
+def attn_chunked(block, x, mem_budget=None):
+    """ AttnBlock.forward(x) with the (T, T) weights in query chunks """
+    h = block.norm(x)
+    b, c = x.shape[:2]
+    q, k, v = [f(h).reshape(b, c, -1) for f in [block.q, block.k, block.v]]
+    return x + block.proj_out(_attend(q, k, v, mem_budget).reshape(x.shape))
+
+
+class _Tiles(object):
+    """ the tiles of one up-path activation, and the layer-at-a-time ops over them """
+    def __init__(self, x, grid, device, store):
+        self.grid, self.device, self.store = grid, device, store
+        self.scale = 1
+        self.data = [_crop(x, pad).to(store) for _, pad in grid]
+
+    def map(self, fn, *data):
+        """ fn(tile of data[0], tile of data[1], ...) on the device for every tile. default data: (self.data,) """
+        data = data or (self.data,)
+        return [fn(*[t.to(self.device) for t in ts]).to(self.store) for ts in zip(*data)]
+
+    def cores(self, data=None):
+        for t, (core, pad) in zip(self.data if data is None else data, self.grid):
+            yield _crop(t.to(self.device), _core(core, pad), self.scale)
+
+    def group_norm(self, norm, data=None):
+        """ fn(tile) applying `norm` with the statistics of all tile cores together """
+        s = s2 = n = 0
+        for c in self.cores(data):
+            g = c.double().reshape(c.shape[0], norm.num_groups, -1)
+            s, s2, n = s + g.sum(dim=2), s2 + g.pow(2).sum(dim=2), n + g.shape[2]
+        mean = s / n
+        inv_std = ((s2 / n - mean.pow(2)).clamp(min=0.) + norm.eps).rsqrt()
+        shape = (1, -1) + (1,) * 3
+
+        def fn(t):
+            g = t.float().reshape(t.shape[0], norm.num_groups, -1)
+            g = (g - mean[..., None].float()) * inv_std[..., None].float()
+            return (g.reshape(t.shape) * norm.weight.view(shape) + norm.bias.view(shape)).to(t.dtype)
+        return fn
+
+    def resnet(self, block):
+        n1 = self.group_norm(block.norm1)
+        h = self.map(lambda t: block.conv1(nonlinearity(n1(t))))
+        n2 = self.group_norm(block.norm2, h)
+        h = self.map(lambda t: block.conv2(block.dropout(nonlinearity(n2(t)))), h)
+        if block.in_channels != block.out_channels:
+            shortcut = block.conv_shortcut if block.use_conv_shortcut else block.nin_shortcut
+        else:
+            shortcut = lambda t: t
+        self.data = self.map(lambda x, t: shortcut(x) + t, self.data, h)
+
+    def attn(self, block, mem_budget=None):
+        norm = self.group_norm(block.norm)
+        b, c = self.data[0].shape[:2]
+        # keys and values of every voxel once, from the cores
+        k = torch.cat([block.k(norm(t)).reshape(b, c, -1) for t in self.cores()], dim=2)
+        v = torch.cat([block.v(norm(t)).reshape(b, c, -1) for t in self.cores()], dim=2)
+
+        def fn(x):
+            q = block.q(norm(x)).reshape(b, c, -1)
+            return x + block.proj_out(_attend(q, k, v, mem_budget).reshape(x.shape))
+        self.data = self.map(fn)
+
+    def upsample(self, block):
+        self.data = self.map(block)
+        self.scale *= 2
+
+    def _ramp(self, halo, spoiled):
+        """
+            blend weights of the `halo` output voxels on one side of a tile, outermost first: 0 on the ones the
+            padding spoiled, then up towards the core. a halo narrower than the spoiled part ramps over all of it
+        """
+        k = torch.arange(halo, dtype=self.data[0].dtype, device=self.store)
+        valid = halo - spoiled
+        if valid < 0:
+            return (k + 1) / (halo + 1)
+        return ((k - spoiled + 1) / (valid + 1)).clamp(min=0.)
+
+    def blend(self, spatial, margin):
+        """ the tiles blended into one (b, c, *spatial * scale) tensor, see _ramp. margin: receptive_margin """
+        f = self.scale
+        spoiled = int(math.ceil(margin * f))
+        b, c = self.data[0].shape[:2]
+        out = torch.zeros(b, c, *[s * f for s in spatial], dtype=self.data[0].dtype, device=self.store)
+        total = torch.zeros(1, 1, *[s * f for s in spatial], dtype=self.data[0].dtype, device=self.store)
+        for t, (core, pad) in zip(self.data, self.grid):
+            w = 1.
+            for d, ((cs, ce), (ps, pe)) in enumerate(zip(core, pad)):
+                ones = torch.ones((ce - cs) * f, dtype=t.dtype, device=self.store)
+                ramp = torch.cat([self._ramp((cs - ps) * f, spoiled), ones,
+                                  self._ramp((pe - ce) * f, spoiled).flip(0)])
+                w = w * ramp.view((-1,) + (1,) * (2 - d))
+            _crop(out, pad, f).add_(t.to(self.store) * w)
+            _crop(total, pad, f).add_(w)
+        return out / total
+
+
+def decode_tiled(decoder, z, tile=None, overlap=None, mem_budget=None, store=None):
+    """
+        Decoder3D.forward(z) through overlapping tiles of the latent grid, see the module docstring.
+        tile: latent voxels per side of a tile core. default: from mem_budget, or one tile (the whole latent).
+        overlap: latent voxels each tile reaches into its neighbours. from receptive_margin(decoder) on (the
+            default) the output is the full decode up to rounding.
+    """
+    store = z.device if store is None else store
+    overlap = int(math.ceil(receptive_margin(decoder))) if overlap is None else overlap
+    if decoder.channels_last:
+        z = z.contiguous(memory_format=torch.channels_last_3d)
+    if tile is None:
+        tile = max(z.shape[2:]) if mem_budget is None else tile_for_budget(decoder, z.shape, z.shape[0], mem_budget,
+                                                                          overlap, z.element_size())
+
+    # whole latent: conv_in and the mid blocks (the attention over all voxels)
+    h = decoder.conv_in(z)
+    h = decoder.mid.block_1(h, None)
+    h = attn_chunked(decoder.mid.attn_1, h, mem_budget)
+    h = decoder.mid.block_2(h, None)
+
+    spatial = h.shape[2:]
+    tiles = _Tiles(h, tile_grid(spatial, tile, overlap), z.device, store)
+    del h
+    for i_level in reversed(range(decoder.num_resolutions)):
+        up = decoder.up[i_level]
+        for i_block in range(decoder.num_res_blocks):
+            tiles.resnet(up.block[i_block])
+            if len(up.attn) > 0:
+                tiles.attn(up.attn[i_block], mem_budget)
+        if i_level != 0:
+            tiles.upsample(up.upsample)
+
+    if not decoder.give_pre_end:
+        norm = tiles.group_norm(decoder.norm_out)
+        tiles.data = tiles.map(lambda t: decoder.conv_out(decoder.nonlinearity(norm(t))))
+    out = tiles.blend(spatial, receptive_margin(decoder)).to(z.device)
+    return out.contiguous() if decoder.channels_last else out
+
+
+def quantize_slabs(quantize, h, mem_budget=None):
+    """ quantize(h, is_voxel=True)[0] in slabs along the first spatial dim: the (voxels, n_embed) distances fit """
+    b, _, d, hh, w = h.shape
+    n_embed = quantize.embedding.weight.shape[0]
+    # the distances and their terms, fp32
+    slab = d if mem_budget is None else max(1, int(mem_budget // (3 * 4 * b * hh * w * n_embed)))
+    return torch.cat([quantize(h[:, :, i:i + slab], is_voxel=True)[0] for i in range(0, d, slab)], dim=2)
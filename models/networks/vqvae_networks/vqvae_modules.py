@@ -252,6 +252,9 @@ class Encoder3D(nn.Module):
                                         kernel_size=3,
                                         stride=1,
                                         padding=1)
+
+        # channels-last activations, see models.model_utils.set_memory_format
+        self.channels_last = False
     
 
 
@@ -261,6 +264,9 @@ class Encoder3D(nn.Module):
         # timestep embedding
         temb = None
 
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last_3d)
+
         # downsampling
         # hs = [self.conv_in(x)]
         h = self.conv_in(x)
@@ -287,7 +293,7 @@ class Encoder3D(nn.Module):
         # h = nonlinearity(h)
         h = self.nonlinearity(h)
         h = self.conv_out(h)
-        return h
+        return h.contiguous() if self.channels_last else h
 
 class Decoder3D(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1,2,4,8), num_res_blocks,
@@ -373,6 +379,9 @@ class Decoder3D(nn.Module):
                                         stride=1,
                                         padding=1)
 
+        # channels-last activations, see models.model_utils.set_memory_format
+        self.channels_last = False
+
     def forward(self, z):
         #assert z.shape[1:] == self.z_shape[1:]
         self.last_z_shape = z.shape
@@ -380,6 +389,9 @@ class Decoder3D(nn.Module):
         # timestep embedding
         temb = None
 
+        if self.channels_last:
+            z = z.contiguous(memory_format=torch.channels_last_3d)
+
         # z to block_in
         h = self.conv_in(z)
 
@@ -400,10 +412,10 @@ class Decoder3D(nn.Module):
 
         # end
         if self.give_pre_end:
-            return h
+            return h.contiguous() if self.channels_last else h
 
         h = self.norm_out(h)
         # h = nonlinearity(h)
         h = self.nonlinearity(h)
         h = self.conv_out(h)
-        return h
\ No newline at end of file
+        return h.contiguous() if self.channels_last else h
\ No newline at end of file
@@ -0,0 +1,247 @@
+""" Per-block forward / backward profiler for UNet3DModel, Encoder3D / Decoder3D and BERTTextEncoder.
+
+    Hooks the top-level blocks of every network it is attached to:
+        UNet3DModel         time_embed, input_blocks.i, middle_block, output_blocks.i, out, and every attention block
+                            (AttentionBlock, PromptedAttentionBlock, SpatialTransformer3D) nested in them
+        Encoder3D/Decoder3D conv_in, every ResnetBlock / AttnBlock / Downsample / Upsample, norm_out, conv_out
+        BERTTextEncoder     tokenizer, token embedding, every attention / feed-forward layer
+    plus the network itself. Per block it records call counts, wall time, host cpu time (of the calling thread),
+    cuda time (cuda events) and the bytes of the activations it returns. Blocks nest, so times are inclusive.
+
+    A run (ModuleProfiler.run, or BaseModel.profile_run around the sampling methods with --profile_dir) writes
+    <out_dir>/<run>_<tag>.json, the aggregated table, and <out_dir>/<run>_<tag>.trace.json, a Chrome trace
+    (chrome://tracing, ui.perfetto.dev) with one event per call. With sync=True, the default, every hook
+    synchronizes cuda, which makes wall times per block exact and sampling slower. Outside a run the hooks return
+    right away: unprofiled calls (e.g. the forwards of training) record nothing and do not synchronize.
+    Backward times (backward=True) come from runs that backpropagate, i.e. the 'prompt_update' run of
+    SDFusionModel.optimize_parameters.
+"""
+
+import os
+import json
+import time
+import functools
+import warnings
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+
+from models.networks.diffusion_networks.openai_model_3d import UNet3DModel, AttentionBlock, PromptedAttentionBlock
+from models.networks.diffusion_networks.attention import SpatialTransformer3D
+from models.networks.vqvae_networks.vqvae_modules import Encoder3D, Decoder3D, ResnetBlock, AttnBlock, Downsample, Upsample
+from models.networks.bert_networks.network import BERTTextEncoder
+
+UNET_ATTENTION = (AttentionBlock, PromptedAttentionBlock, SpatialTransformer3D)
+VQ_BLOCKS = (ResnetBlock, AttnBlock, Downsample, Upsample)
+
+
+def _block_ids(model):
+    """ ids of the modules of `model` profile_targets hooks """
+    ids = set()
+    for module in model.modules():
+        if isinstance(module, UNet3DModel):
+            ids.add(id(module))
+            ids.update(id(m) for m in [module.time_embed, module.middle_block, module.out])
+            ids.update(id(m) for m in list(module.input_blocks) + list(module.output_blocks))
+            ids.update(id(m) for m in module.modules() if isinstance(m, UNET_ATTENTION))
+        elif isinstance(module, (Encoder3D, Decoder3D)):
+            ids.add(id(module))
+            ids.update(id(m) for m in [module.conv_in, module.norm_out, module.conv_out])
+            ids.update(id(m) for m in module.modules() if isinstance(m, VQ_BLOCKS))
+        elif isinstance(module, BERTTextEncoder):
+            ids.add(id(module))
+            if module.use_tknz_fn:
+                ids.add(id(module.tknz_fn))
+            ids.add(id(module.transformer.token_emb))
+            # AttentionLayers.layers: [norm, block, residual] per layer
+            ids.update(id(layer[1]) for layer in module.transformer.attn_layers.layers)
+    return ids
+
+
+def profile_targets(model, prefix=''):
+    """ [(name, module)] of the blocks profiled in `model`, in named_modules order (parents first) """
+    ids = _block_ids(model)
+    targets = []
+    for name, module in model.named_modules():
+        if id(module) in ids:
+            ids.discard(id(module))
+            full = '.'.join(n for n in [prefix, name] if n)
+            targets.append((full, module))
+    return targets
+
+
+def tensor_bytes(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, (list, tuple)):
+        return sum(tensor_bytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(tensor_bytes(o) for o in obj.values())
+    return 0
+
+
+class ModuleProfiler(object):
+    """
+        profiler = ModuleProfiler('logs/profile', device='cuda')
+        profiler.attach(model.df, 'df').attach(model.vqvae, 'vqvae')
+        with profiler.run('uncond'):
+            model.uncond(ngen=4)
+
+        backward: also time the backward of every block (full backward hooks, torch>=2.0).
+    """
+    def __init__(self, out_dir, device='cuda', backward=False, sync=True):
+        self.out_dir = out_dir
+        self.cuda = str(device).startswith('cuda') and torch.cuda.is_available()
+        self.backward = backward
+        self.sync = sync
+        self.names = []
+        self.handles = []
+        self.depth = 0
+        self.runs = 0
+        if backward and not hasattr(nn.Module, 'register_full_backward_pre_hook'):
+            warnings.warn('backward profiling needs torch>=2.0 (register_full_backward_pre_hook), forward only.')
+            self.backward = False
+        self.reset()
+
+    def reset(self):
+        self.stats = {name: self._empty() for name in self.names}
+        self.events = []
+        self.open = {}
+        self.t_origin = time.perf_counter()
+
+    @staticmethod
+    def _empty():
+        return dict(calls=0, wall_ms=0., cpu_ms=0., cuda_ms=0., act_bytes=0, act_bytes_max=0,
+                    bwd_calls=0, bwd_wall_ms=0., bwd_cuda_ms=0.)
+
+    def attach(self, model, prefix=''):
+        for name, module in profile_targets(model, prefix):
+            self.names.append(name)
+            self.stats[name] = self._empty()
+            self.handles.append(module.register_forward_pre_hook(self._pre_hook(name, 'fwd')))
+            self.handles.append(module.register_forward_hook(self._post_hook(name, 'fwd')))
+            if self.backward:
+                self.handles.append(module.register_full_backward_pre_hook(self._pre_hook(name, 'bwd')))
+                self.handles.append(module.register_full_backward_hook(self._post_hook(name, 'bwd')))
+        return self
+
+    def detach(self):
+        for h in self.handles:
+            h.remove()
+        self.handles, self.names = [], []
+
+    def _pre_hook(self, name, phase):
+        def fn(module, *args):
+            # attached for good, but only recording inside run()
+            if self.depth == 0:
+                return
+            if self.cuda and self.sync:
+                torch.cuda.synchronize()
+            start = None
+            if self.cuda:
+                start = torch.cuda.Event(enable_timing=True)
+                start.record()
+            self.open.setdefault((name, phase), []).append((time.perf_counter(), time.thread_time(), start))
+        return fn
+
+    def _post_hook(self, name, phase):
+        def fn(module, inputs, outputs):
+            if self.depth == 0 or not self.open.get((name, phase)):
+                return
+            t0, c0, start = self.open[(name, phase)].pop()
+            end = None
+            if self.cuda:
+                end = torch.cuda.Event(enable_timing=True)
+                end.record()
+                if self.sync:
+                    torch.cuda.synchronize()
+            t1, c1 = time.perf_counter(), time.thread_time()
+
+            stat = self.stats[name]
+            if phase == 'fwd':
+                nbytes = tensor_bytes(outputs)
+                stat['calls'] += 1
+                stat['wall_ms'] += (t1 - t0) * 1e3
+                stat['cpu_ms'] += (c1 - c0) * 1e3
+                stat['act_bytes'] += nbytes
+                stat['act_bytes_max'] = max(stat['act_bytes_max'], nbytes)
+            else:
+                nbytes = tensor_bytes(inputs)
+                stat['bwd_calls'] += 1
+                stat['bwd_wall_ms'] += (t1 - t0) * 1e3
+            # cuda events are read in summary(), reading them here would synchronize
+            self.events.append((name, phase, t0, t1, start, end, nbytes))
+        return fn
+
+    def _resolve_cuda(self):
+        if not self.cuda:
+            return
+        torch.cuda.synchronize()
+        events = []
+        for name, phase, t0, t1, start, end, nbytes in self.events:
+            if end is not None:
+                # (start, end) events -> (cuda ms, None), once
+                start = start.elapsed_time(end)
+                self.stats[name]['cuda_ms' if phase == 'fwd' else 'bwd_cuda_ms'] += start
+            events.append((name, phase, t0, t1, start, None, nbytes))
+        self.events = events
+
+    def summary(self):
+        """ one row per block: name, calls, total and per-call times, activation MB """
+        self._resolve_cuda()
+        rows = []
+        for name in self.names:
+            s = self.stats[name]
+            calls = max(s['calls'], 1)
+            rows.append(dict(name=name, **s, wall_ms_per_call=s['wall_ms'] / calls,
+                             cuda_ms_per_call=s['cuda_ms'] / calls, act_mb_per_call=s['act_bytes'] / calls / 2 ** 20))
+        return rows
+
+    def chrome_trace(self):
+        """ Chrome trace event format: complete events, forward on thread 0 and backward on thread 1 """
+        self._resolve_cuda()
+        pid = os.getpid()
+        trace = [dict(ph='M', pid=pid, tid=tid, name='thread_name', args=dict(name=label))
+                 for tid, label in [(0, 'forward'), (1, 'backward')]]
+        for name, phase, t0, t1, cuda_ms, _, nbytes in self.events:
+            args = dict(bytes=nbytes)
+            if cuda_ms is not None:
+                args['cuda_ms'] = cuda_ms
+            trace.append(dict(ph='X', pid=pid, tid=0 if phase == 'fwd' else 1, name=name, cat=phase,
+                              ts=(t0 - self.t_origin) * 1e6, dur=(t1 - t0) * 1e6, args=args))
+        return dict(traceEvents=trace, displayTimeUnit='ms')
+
+    def dump(self, tag):
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, f'{self.runs:04d}_{tag}')
+        summary = dict(tag=tag, cuda=self.cuda, sync=self.sync, wall_ms=(time.perf_counter() - self.t_origin) * 1e3,
+                       modules=self.summary())
+        with open(f'{path}.json', 'w') as f:
+            json.dump(summary, f, indent=1)
+        with open(f'{path}.trace.json', 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        return path
+
+    @contextmanager
+    def run(self, tag):
+        """ one profiled run, dumped on exit. nested runs (e.g. txt2shape -> txt2shape_batch) join the outer one """
+        if self.depth == 0:
+            self.reset()
+        self.depth += 1
+        try:
+            yield self
+        finally:
+            self.depth -= 1
+            if self.depth == 0:
+                self.runs += 1
+                self.dump(tag)
+
+
+def profiled(fn):
+    """ decorator for the sampling methods of a BaseModel: each call is one BaseModel.profile_run """
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        with self.profile_run(fn.__name__):
+            return fn(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,233 @@
+""" Structured pruning of the frozen SDFusion UNet.
+
+    Two kinds of structure are removed, both inside a block, so the residual stream, the skip connections and
+    the SoftPrompt3D banks keep their width and PromptedAttentionBlock stays wired as before:
+        ResBlock                the hidden channels (in_layers conv out, emb_layers, out_layers norm + conv in), in
+                                whole GroupNorm groups. the norm becomes GroupNorm(kept groups, kept channels), so
+                                the statistics of the kept channels do not change
+        PromptedAttentionBlock  heads: their q / k / v rows of qkv and their proj_out columns. norm, the soft prompt
+                                (in residual channels) and the gate stay, the prompt K/V come out of the pruned qkv
+    Units (groups, heads) are ranked on calibration latents by the mean |activation| they feed into the last
+    conv of the block (out_layers conv, proj_out) times the norm of its weights on them. The plan
+    {module name: kept unit indices} is applied in place by prune; finetune then trains the pruned UNet briefly
+    with the diffusion loss (prompts frozen).
+
+    Checkpoints are SDFusionModel.save checkpoints of the pruned df plus the plan under 'prune_plan', so
+    load_pruned prunes a freshly built DiffusionUNet to the same shapes before it loads the weights.
+"""
+
+from termcolor import cprint
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import optim
+
+from models.networks.diffusion_networks.openai_model_3d import ResBlock, PromptedAttentionBlock
+from models.networks.diffusion_networks.ldm_diffusion_util import GroupNorm32
+from models.networks.diffusion_networks.prompt import SoftPrompt3D
+from models.distillation import apply_net
+from models.model_utils import set_memory_format
+
+
+def prunable(model):
+    """ {name: module} of the ResBlocks and PromptedAttentionBlocks of `model` """
+    return {name: m for name, m in model.named_modules() if isinstance(m, (ResBlock, PromptedAttentionBlock))}
+
+
+def units(module):
+    """ (# of units, channels per unit): GroupNorm groups of a ResBlock's hidden channels, or attention heads """
+    if isinstance(module, ResBlock):
+        norm = module.out_layers[0]
+        return norm.num_groups, norm.num_channels // norm.num_groups
+    heads = module.num_heads
+    return heads, module.qkv.weight.shape[0] // 3 // heads
+
+
+def _last_conv(module):
+    """ the conv the pruned channels feed into """
+    return module.out_layers[-1] if isinstance(module, ResBlock) else module.proj_out
+
+
+@torch.no_grad()
+def importance(model, run_fn, names=None):
+    """
+        run_fn(model) runs `model` on a few calibration inputs (noised latents and their timesteps).
+        returns {name: (# of units,) scores} for the prunable modules (default: all of prunable(model)).
+    """
+    modules = prunable(model)
+    if names is not None:
+        modules = {name: modules[name] for name in names}
+    act, hooks = {}, []
+
+    def hook(name):
+        def fn(conv, inputs):
+            x = inputs[0].detach().float()
+            act[name] = act.get(name, 0.) + x.abs().transpose(0, 1).flatten(1).mean(dim=1)
+        return fn
+
+    for name, module in modules.items():
+        hooks.append(_last_conv(module).register_forward_pre_hook(hook(name)))
+    try:
+        run_fn(model)
+    finally:
+        for h in hooks:
+            h.remove()
+
+    scores = {}
+    for name, module in modules.items():
+        if name not in act:
+            continue
+        weight = _last_conv(module).weight.detach().float()
+        # (out, in, *k) -> norm per input channel
+        w_norm = weight.transpose(0, 1).flatten(1).norm(dim=1)
+        n, size = units(module)
+        scores[name] = (act[name] * w_norm).view(n, size).sum(dim=1).cpu()
+    return scores
+
+
+def make_plan(model, scores, ratio=0.5, head_ratio=None):
+    """
+        {name: kept unit indices}: the top 1 - ratio of each ResBlock's groups by score, and the top
+        1 - head_ratio (default: ratio) of each attention block's heads. at least one unit per module stays.
+    """
+    head_ratio = ratio if head_ratio is None else head_ratio
+    modules = prunable(model)
+    plan = {}
+    for name, s in scores.items():
+        r = ratio if isinstance(modules[name], ResBlock) else head_ratio
+        n_keep = max(1, len(s) - int(round(len(s) * r)))
+        plan[name] = sorted(s.topk(n_keep).indices.tolist())
+    return plan
+
+
+def _take(module, idx, dim, size_attr):
+    """ keep the channels `idx` along `dim` of module.weight (and of the bias for dim 0) """
+    for pname in ['weight', 'bias']:
+        p = getattr(module, pname, None)
+        if p is None or (pname == 'bias' and dim != 0):
+            continue
+        new = nn.Parameter(p.data.index_select(dim, idx.to(p.device)).clone(), requires_grad=p.requires_grad)
+        setattr(module, pname, new)
+    setattr(module, size_attr, len(idx))
+
+
+def _channels(keep, size):
+    keep = torch.as_tensor(keep, dtype=torch.long)
+    return (keep[:, None] * size + torch.arange(size)[None]).flatten()
+
+
+def prune_resblock(block, keep):
+    """ keep the hidden GroupNorm groups `keep` of a ResBlock, in place """
+    norm = block.out_layers[0]
+    hidden = norm.num_channels
+    idx = _channels(keep, hidden // norm.num_groups)
+
+    conv_in, linear, conv_out = block.in_layers[-1], block.emb_layers[-1], block.out_layers[-1]
+    _take(conv_in, idx, 0, 'out_channels')
+    # scale and shift halves with use_scale_shift_norm
+    _take(linear, torch.cat([idx, hidden + idx]) if block.use_scale_shift_norm else idx, 0, 'out_features')
+    _take(conv_out, idx, 1, 'in_channels')
+
+    # same group size, fewer groups
+    new_norm = GroupNorm32(len(keep), len(idx), eps=norm.eps).to(norm.weight.device)
+    new_norm.weight.data.copy_(norm.weight.data[idx.to(norm.weight.device)])
+    new_norm.bias.data.copy_(norm.bias.data[idx.to(norm.weight.device)])
+    block.out_layers[0] = new_norm.requires_grad_(norm.weight.requires_grad)
+
+
+def prune_heads(block, keep):
+    """ keep the heads `keep` of a PromptedAttentionBlock, in place """
+    n, d = units(block)
+    width = n * d
+    idx = _channels(keep, d)
+    # QKVPromptAttention splits qkv into q, k, v first, then each into heads
+    _take(block.qkv, torch.cat([idx, width + idx, 2 * width + idx]), 0, 'out_channels')
+    _take(block.proj_out, idx, 1, 'in_channels')
+    block.num_heads = len(keep)
+    block.prompt_attention.n_heads = len(keep)
+    block.prompt_kv = None
+
+
+def prune(model, plan):
+    """ apply plan {name: kept units} to `model` in place (see make_plan), returns it """
+    modules = prunable(model)
+    for name, keep in plan.items():
+        module = modules[name]
+        if isinstance(module, ResBlock):
+            prune_resblock(module, keep)
+        else:
+            prune_heads(module, keep)
+    return model
+
+
+def n_params(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def finetune(model, alphas_cumprod, data_fn, iters, lr=1e-5, log_every=100):
+    """
+        recover a pruned UNet with the diffusion loss: ||eps - model(q_sample(z0, t, eps), t)||^2 on uniformly
+        drawn timesteps. data_fn() -> (z0, cond). every parameter trains but the SoftPrompt3D banks.
+        returns the model in eval mode, frozen again.
+    """
+    model.train()
+    model.requires_grad_(True)
+    for module in model.modules():
+        if isinstance(module, SoftPrompt3D):
+            module.requires_grad_(False)
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = optim.Adam(params, lr=lr)
+    scheduler = optim.lr_scheduler.LambdaLR(optimizer, lambda it: 1. - it / iters)
+    alphas_cumprod = alphas_cumprod.detach().float()
+
+    for it in range(iters):
+        z0, cond = data_fn()
+        t = torch.randint(0, alphas_cumprod.shape[0], (z0.shape[0],), device=z0.device)
+        a = alphas_cumprod.to(z0.device)[t].view(-1, *([1] * (z0.dim() - 1)))
+        noise = torch.randn_like(z0)
+        z_t = a.sqrt() * z0 + (1. - a).sqrt() * noise
+
+        loss = F.mse_loss(apply_net(model, z_t, t, cond), noise)
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        optimizer.step()
+        scheduler.step()
+
+        if log_every and (it % log_every == 0 or it == iters - 1):
+            cprint(f'[prune finetune] iter {it}: loss {loss.item():.5f}', 'blue')
+
+    model.eval()
+    model.requires_grad_(False)
+    return model
+
+
+def save_pruned(path, df, plan, vqvae_state_dict=None):
+    """ same layout as SDFusionModel.save, plus the plan that gives the pruned shapes """
+    state_dict = {'df': df.state_dict(), 'prune_plan': plan, 'global_step': 0}
+    if vqvae_state_dict is not None:
+        state_dict['vqvae'] = vqvae_state_dict
+    torch.save(state_dict, path)
+
+
+def load_pruned_unet(df, ckpt):
+    """ prune a DiffusionUNet built from the original config to the shapes of `ckpt`, then load its weights """
+    map_fn = lambda storage, loc: storage
+    state_dict = torch.load(ckpt, map_location=map_fn) if type(ckpt) == str else ckpt
+    if 'prune_plan' not in state_dict:
+        raise ValueError(f'{ckpt} has no prune_plan, prune it with prune.py first')
+    prune(df, state_dict['prune_plan'])
+    # save_pruned writes the whole pruned df: a wrong plan / checkpoint pairing must not load half of it
+    df.load_state_dict(state_dict['df'])
+    return state_dict
+
+
+def load_pruned(model, ckpt):
+    """ load a pruned checkpoint (save_pruned) into an SDFusion model: pruned df, and the vqvae if saved """
+    state_dict = load_pruned_unet(model.df, ckpt)
+    if 'vqvae' in state_dict:
+        model.vqvae.load_state_dict(state_dict['vqvae'])
+    # the pruned weights are new tensors
+    set_memory_format(model.df, model.opt.memory_format)
+    plan = state_dict['prune_plan']
+    cprint(f'[*] pruned unet ({len(plan)} blocks, {n_params(model.df) / 1e6:.1f} M params) load from: {ckpt}', 'blue')
@@ -0,0 +1,187 @@
+""" Int8 CPU inference for the diffusion UNet and the VQ-VAE decoder.
+
+    Linear layers and 1x1 convolutions (qkv, proj_out, time_embed, 1x1x1 skip / shortcut convs) become dynamically
+    quantized int8 matmuls (fbgemm / qnnpack), the other Conv3d layers keep fp32 compute with int8 per-channel
+    weights (weight-only, 4x smaller). A calibration pass on a few latents measures the output error of every
+    layer against fp32 and keeps the layers above a tolerance in fp32; the result is a plan {layer name: kind}.
+
+    Checkpoints are SDFusionModel.save checkpoints (fp32 'df' / 'vqvae') plus the plan under 'int8_plan', so
+    load_int8 loads them like load_ckpt and re-quantizes the weights on load.
+"""
+
+import copy
+
+from termcolor import cprint
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def _dynamic_linear(weight, bias):
+    """ torch.ao dynamic int8 Linear with the given fp32 weight (out, in) and bias """
+    linear = nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None)
+    linear.weight.data.copy_(weight)
+    if bias is not None:
+        linear.bias.data.copy_(bias)
+    linear.qconfig = torch.ao.quantization.default_dynamic_qconfig
+    return torch.ao.nn.quantized.dynamic.Linear.from_float(linear)
+
+
+class DynamicQuantLinear(nn.Module):
+    """ nn.Linear, or a conv with kernel size 1 (channels first), as a dynamically quantized int8 matmul """
+    def __init__(self, module):
+        super().__init__()
+        self.channels_first = isinstance(module, (nn.Conv1d, nn.Conv2d, nn.Conv3d))
+        self.weight_shape = module.weight.shape
+        weight = module.weight.detach().float().flatten(1)
+        bias = module.bias.detach().float() if module.bias is not None else None
+        self.linear = _dynamic_linear(weight, bias)
+
+    # dequantized, in the shape of the original layer, for code that reads the weights directly
+    # (e.g. PromptedAttentionBlock.project_prompt)
+    @property
+    def weight(self):
+        return self.linear.weight().dequantize().view(self.weight_shape)
+
+    @property
+    def bias(self):
+        return self.linear.bias()
+
+    def forward(self, x):
+        if not self.channels_first:
+            return self.linear(x.float())
+        # (B, C, ...) -> (B, ..., C) -> matmul -> back
+        h = self.linear(x.float().movedim(1, -1))
+        return h.movedim(-1, 1)
+
+
+class Int8WeightConv3d(nn.Module):
+    """ Conv3d with symmetric per-output-channel int8 weights, dequantized for an fp32 convolution """
+    def __init__(self, conv):
+        super().__init__()
+        weight = conv.weight.detach().float()
+        scale = weight.abs().flatten(1).amax(dim=1).clamp(min=1e-12) / 127.
+        self.register_buffer('weight_int8', torch.round(weight / scale.view(-1, 1, 1, 1, 1)).to(torch.int8))
+        self.register_buffer('scale', scale)
+        self.register_buffer('bias', conv.bias.detach().float().clone() if conv.bias is not None else None)
+        self.stride, self.padding, self.dilation, self.groups = conv.stride, conv.padding, conv.dilation, conv.groups
+
+    @property
+    def weight(self):
+        return self.weight_int8.float() * self.scale.view(-1, 1, 1, 1, 1)
+
+    def forward(self, x):
+        return F.conv3d(x.float(), self.weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
+
+
+QUANTIZED = {'dynamic': DynamicQuantLinear, 'weight_only': Int8WeightConv3d}
+
+
+def quant_kind(module):
+    """ 'dynamic', 'weight_only' or None (stays fp32) """
+    if isinstance(module, nn.Linear):
+        return 'dynamic'
+    if isinstance(module, (nn.Conv1d, nn.Conv3d)) and module.groups == 1 and \
+            all(k == 1 for k in module.kernel_size) and all(s == 1 for s in module.stride) and \
+            all(p == 0 for p in module.padding):
+        return 'dynamic'
+    if isinstance(module, nn.Conv3d):
+        return 'weight_only'
+    return None
+
+
+def candidate_layers(model):
+    return {name: quant_kind(m) for name, m in model.named_modules() if quant_kind(m) is not None}
+
+
+def _replace(model, name, new):
+    parent_name, _, child = name.rpartition('.')
+    parent = model.get_submodule(parent_name) if parent_name else model
+    setattr(parent, child, new)
+
+
+@torch.no_grad()
+def calibrate(model, run_fn, tol=0.05, candidates=None):
+    """
+        run_fn(model) runs `model` in fp32 on a few calibration inputs (e.g. latents and timesteps for the UNet).
+        every candidate layer (default: candidate_layers(model)) is also run quantized on the inputs it sees,
+        and kept in fp32 if its relative output error ||y_int8 - y|| / ||y|| exceeds tol.
+        returns (plan {name: kind}, errors {name: rel. error}).
+    """
+    if candidates is None:
+        candidates = candidate_layers(model)
+    err, norm, hooks = {}, {}, []
+
+    def hook(name, quantized):
+        def fn(module, inputs, output):
+            diff = quantized(inputs[0]) - output.float()
+            err[name] = err.get(name, 0.) + diff.pow(2).sum().item()
+            norm[name] = norm.get(name, 0.) + output.float().pow(2).sum().item()
+        return fn
+
+    for name, kind in candidates.items():
+        module = model.get_submodule(name)
+        hooks.append(module.register_forward_hook(hook(name, QUANTIZED[kind](module))))
+    try:
+        run_fn(model)
+    finally:
+        for h in hooks:
+            h.remove()
+
+    # layers the calibration inputs never reach are quantized, as they would be without calibration
+    errors = {name: (err[name] / max(norm[name], 1e-12)) ** 0.5 for name in err}
+    plan = {name: kind for name, kind in candidates.items() if errors.get(name, 0.) <= tol}
+    return plan, errors
+
+
+def quantize(model, plan=None, inplace=False):
+    """ `model` with the layers of `plan` (default: all candidates) swapped for their int8 versions. cpu only. """
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.cpu().eval()
+    if plan is None:
+        plan = candidate_layers(model)
+    for name, kind in plan.items():
+        _replace(model, name, QUANTIZED[kind](model.get_submodule(name)))
+    return model
+
+
+def decoder_layers(vqvae):
+    """ candidate layers of the decoding path of a VQVAE (post_quant_conv + decoder), the encoder stays fp32 """
+    return {name: kind for name, kind in candidate_layers(vqvae).items()
+            if name.startswith(('post_quant_conv', 'decoder.'))}
+
+
+def quantize_sdfusion(model, df_plan=None, vqvae_plan=None):
+    """ quantize model.df and the decoding path of model.vqvae in place (default plans: every candidate) """
+    if str(model.device) != 'cpu':
+        raise ValueError(f'int8 inference is cpu only, got device {model.device}')
+    quantize(model.df, df_plan, inplace=True)
+    quantize(model.vqvae, decoder_layers(model.vqvae) if vqvae_plan is None else vqvae_plan, inplace=True)
+
+
+def save_int8(path, df, vqvae, df_plan, vqvae_plan):
+    """ SDFusionModel.save layout (fp32 weights of the unquantized df / vqvae) plus the calibrated plans """
+    torch.save({
+        'df': df.state_dict(),
+        'vqvae': vqvae.state_dict(),
+        'int8_plan': {'df': df_plan, 'vqvae': vqvae_plan},
+        'global_step': 0,
+    }, path)
+
+
+def load_int8(model, ckpt):
+    """ load an int8 checkpoint (save_int8) into an SDFusion model on the cpu: fp32 weights, then the plan """
+    map_fn = lambda storage, loc: storage
+    state_dict = torch.load(ckpt, map_location=map_fn) if type(ckpt) == str else ckpt
+    if 'int8_plan' not in state_dict:
+        raise ValueError(f'{ckpt} has no int8_plan, calibrate it with quantize.py first')
+
+    # same keys as SDFusionModel.load_ckpt
+    model.vqvae.load_state_dict(state_dict['vqvae'])
+    # save_int8 writes the whole fp32 df: every key has to match
+    model.df.load_state_dict(state_dict['df'])
+    plan = state_dict['int8_plan']
+    quantize_sdfusion(model, plan['df'], plan['vqvae'])
+    cprint(f'[*] int8 model ({len(plan["df"])} unet / {len(plan["vqvae"])} decoder layers) load from: {ckpt}', 'blue')
@@ -21,10 +21,12 @@ import torchvision.utils as vutils
 import torchvision.transforms as transforms
 
 from models.base_model import BaseModel
+from models.profiler import profiled
 from models.networks.vqvae_networks.network import VQVAE
 from models.networks.diffusion_networks.network import DiffusionUNet
+from models.networks.diffusion_networks.attention import set_attn_mem_budget
 from models.networks.clip_networks.network import CLIPImageEncoder
-from models.model_utils import load_vqvae
+from models.model_utils import load_vqvae, grad_scaler, set_memory_format
 
 ## ldm util
 from models.networks.diffusion_networks.ldm_diffusion_util import (
@@ -34,7 +36,7 @@ from models.networks.diffusion_networks.ldm_diffusion_util import (
     exists,
     default,
 )
-from models.networks.diffusion_networks.samplers.ddim import DDIMSampler
+from models.networks.diffusion_networks.samplers.ddim import DDIMSampler, sampler_kwargs
 
 # distributed 
 from utils.distributed import reduce_loss_dict
@@ -72,13 +74,17 @@ class SDFusionImage2ShapeModel(BaseModel):
         self.uc_scale = 1.
         self.df = DiffusionUNet(unet_params, vq_conf=vq_conf, conditioning_key=df_model_params.conditioning_key)
         self.df.to(self.device)
+        set_attn_mem_budget(self.df, opt.attn_mem_budget)
         self.init_diffusion_params(uc_scale=self.uc_scale, opt=opt)
 
         # sampler 
-        self.ddim_sampler = DDIMSampler(self)
+        self.ddim_sampler = DDIMSampler(self, **sampler_kwargs(self.opt))
 
         # init vqvae
         self.vqvae = load_vqvae(vq_conf, vq_ckpt=opt.vq_ckpt, opt=opt)
+        # opt-in channels-last conv stacks, before the weights are loaded / wrapped
+        set_memory_format(self.df, opt.memory_format)
+        set_memory_format(self.vqvae, opt.memory_format)
 
         # init cond model
         clip_param = df_conf.clip.params
@@ -97,6 +103,8 @@ class SDFusionImage2ShapeModel(BaseModel):
         if self.isTrain:
             # initialize optimizers
             self.optimizer = optim.AdamW(trainable_params, lr=opt.lr)
+            # loss scaling for --precision fp16 (pass-through otherwise)
+            self.scaler = grad_scaler(self.device, opt.precision)
             self.scheduler = optim.lr_scheduler.StepLR(self.optimizer, 1000, 0.9)
 
             self.optimizers = [self.optimizer]
@@ -131,6 +139,7 @@ class SDFusionImage2ShapeModel(BaseModel):
         if self.opt.debug == "1":
             self.ddim_steps = 20
         cprint(f'[*] setting ddim_steps={self.ddim_steps}', 'blue')
+        self.init_profiler(df=self.df, vqvae=self.vqvae, cond_model=self.cond_model)
 
     def make_distributed(self, opt):
         self.df = nn.parallel.DistributedDataParallel(
@@ -277,13 +286,14 @@ class SDFusionImage2ShapeModel(BaseModel):
             key = 'c_concat' if self.df_module.conditioning_key == 'concat' else 'c_crossattn'
             cond = {key: cond}
 
-        # eps
-        out = self.df(x_noisy, t, **cond)
+        # eps, under the precision policy. returned in fp32, so the sampler updates and losses stay fp32
+        with self.autocast():
+            out = self.df(x_noisy, t, **cond)
 
         if isinstance(out, tuple) and not return_ids:
-            return out[0]
+            return out[0].float()
         else:
-            return out
+            return out.float() if torch.is_tensor(out) else out
 
     def get_loss(self, pred, target, loss_type='l2', mean=True):
         if loss_type == 'l1':
@@ -361,6 +371,7 @@ class SDFusionImage2ShapeModel(BaseModel):
 
     # check: ddpm.py, log_images(). line 1317~1327
     @torch.no_grad()
+    @profiled
     def inference(self, data, ddim_steps=None, ddim_eta=0., uc_scale=None,
                   infer_all=False, max_sample=16):
 
@@ -378,11 +389,13 @@ class SDFusionImage2ShapeModel(BaseModel):
             uc_scale = self.uc_scale
 
         # get noise, denoise, and decode with vqvae
-        uc = self.cond_model(self.uc_img).float() # img shape
-        c_img = self.cond_model(self.img).float()
+        with self.autocast():
+            uc = self.cond_model(self.uc_img).float() # img shape
+            c_img = self.cond_model(self.img).float()
         B = c_img.shape[0]
         shape = self.z_shape
         samples, intermediates = self.ddim_sampler.sample(S=ddim_steps,
+                                                        log_every_t=None,
                                                         batch_size=B,
                                                         shape=shape,
                                                         conditioning=c_img,
@@ -393,11 +406,12 @@ class SDFusionImage2ShapeModel(BaseModel):
                                                         quantize_x0=False)
 
 
-        self.gen_df = self.vqvae_module.decode_no_quant(samples)
+        self.gen_df = self.decode(samples)
 
         self.switch_train()
 
     @torch.no_grad()
+    @profiled
     def img2shape(self, image, mask, ddim_steps=None, ddim_eta=0., uc_scale=None,
                   infer_all=False, max_sample=16):
         #######################
@@ -428,11 +442,13 @@ class SDFusionImage2ShapeModel(BaseModel):
             uc_scale = self.uc_scale
 
         # get noise, denoise, and decode with vqvae
-        uc = self.cond_model(self.uc_img).float() # img shape
-        c_img = self.cond_model(self.img).float()
+        with self.autocast():
+            uc = self.cond_model(self.uc_img).float() # img shape
+            c_img = self.cond_model(self.img).float()
         B = c_img.shape[0]
         shape = self.z_shape
         samples, intermediates = self.ddim_sampler.sample(S=ddim_steps,
+                                                        log_every_t=None,
                                                         batch_size=B,
                                                         shape=shape,
                                                         conditioning=c_img,
@@ -443,7 +459,7 @@ class SDFusionImage2ShapeModel(BaseModel):
                                                         quantize_x0=False)
 
 
-        self.gen_df = self.vqvae_module.decode_no_quant(samples)
+        self.gen_df = self.decode(samples)
 
         return self.gen_df
 
@@ -470,7 +486,7 @@ class SDFusionImage2ShapeModel(BaseModel):
         if 'loss_gamma' in self.loss_dict:
             self.loss_gamma = self.loss_dict['loss_gamma']
 
-        self.loss.backward()
+        self.scaler.scale(self.loss).backward()
 
     def optimize_parameters(self, total_steps):
         
@@ -480,7 +496,8 @@ class SDFusionImage2ShapeModel(BaseModel):
         self.forward()
         self.optimizer.zero_grad()
         self.backward()
-        self.optimizer.step()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
 
     def get_logs_data(self):
         """ return a dictionary with
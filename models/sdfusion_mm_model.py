@@ -20,11 +20,13 @@ import torchvision.utils as vutils
 import torchvision.transforms as transforms
 
 from models.base_model import BaseModel
+from models.profiler import profiled
 from models.networks.vqvae_networks.network import VQVAE
 from models.networks.diffusion_networks.network import DiffusionUNet
+from models.networks.diffusion_networks.attention import set_attn_mem_budget
 from models.networks.resnet_v1 import resnet18
 from models.networks.bert_networks.network import BERTTextEncoder
-from models.model_utils import load_vqvae
+from models.model_utils import load_vqvae, grad_scaler, set_memory_format
 
 ## ldm util
 from models.networks.diffusion_networks.ldm_diffusion_util import (
@@ -34,7 +36,7 @@ from models.networks.diffusion_networks.ldm_diffusion_util import (
     exists,
     default,
 )
-from models.networks.diffusion_networks.samplers.ddim import DDIMSampler
+from models.networks.diffusion_networks.samplers.ddim import DDIMSampler, sampler_kwargs
 
 # distributed 
 from utils.distributed import reduce_loss_dict
@@ -72,13 +74,17 @@ class SDFusionMultiModal2ShapeModel(BaseModel):
         self.uc_scale = 1.
         self.df = DiffusionUNet(unet_params, vq_conf=vq_conf, conditioning_key=df_model_params.conditioning_key)
         self.df.to(self.device)
+        set_attn_mem_budget(self.df, opt.attn_mem_budget)
         self.init_diffusion_params(uc_scale=self.uc_scale, opt=opt)
         
         # sampler 
-        self.ddim_sampler = DDIMSampler(self)
+        self.ddim_sampler = DDIMSampler(self, **sampler_kwargs(self.opt))
 
         # init vqvae
         self.vqvae = load_vqvae(vq_conf, vq_ckpt=opt.vq_ckpt, opt=opt)
+        # opt-in channels-last conv stacks, before the weights are loaded / wrapped
+        set_memory_format(self.df, opt.memory_format)
+        set_memory_format(self.vqvae, opt.memory_format)
 
         # init cond model
         self.img_enc = resnet18(pretrained=True) # context dim: 512
@@ -111,6 +117,8 @@ class SDFusionMultiModal2ShapeModel(BaseModel):
         if self.isTrain:
             # initialize optimizers
             self.optimizer = optim.AdamW(trainable_params, lr=opt.lr)
+            # loss scaling for --precision fp16 (pass-through otherwise)
+            self.scaler = grad_scaler(self.device, opt.precision)
             self.scheduler = optim.lr_scheduler.StepLR(self.optimizer, 1000, 0.9)
 
             self.optimizers = [self.optimizer]
@@ -149,6 +157,7 @@ class SDFusionMultiModal2ShapeModel(BaseModel):
         if self.opt.debug == "1":
             self.ddim_steps = 7
         cprint(f'[*] setting ddim_steps={self.ddim_steps}', 'blue')
+        self.init_profiler(df=self.df, vqvae=self.vqvae, txt_enc=self.txt_enc)
 
     def make_distributed(self, opt):
         self.df = nn.parallel.DistributedDataParallel(
@@ -316,13 +325,14 @@ class SDFusionMultiModal2ShapeModel(BaseModel):
             key = 'c_concat' if self.df_module.conditioning_key == 'concat' else 'c_crossattn'
             cond = {key: cond}
 
-        # eps
-        out = self.df(x_noisy, t, **cond)
+        # eps, under the precision policy. returned in fp32, so the sampler updates and losses stay fp32
+        with self.autocast():
+            out = self.df(x_noisy, t, **cond)
 
         if isinstance(out, tuple) and not return_ids:
-            return out[0]
+            return out[0].float()
         else:
-            return out
+            return out.float() if torch.is_tensor(out) else out
 
     def get_loss(self, pred, target, loss_type='l2', mean=True):
         if loss_type == 'l1':
@@ -410,6 +420,7 @@ class SDFusionMultiModal2ShapeModel(BaseModel):
 
     # check: ddpm.py, log_images(). line 1317~1327
     @torch.no_grad()
+    @profiled
     # def inference(self, data, sample=True, ddim_steps=None, ddim_eta=0., quantize_denoised=True, infer_all=False):
     def inference(self, data, ddim_steps=None, ddim_eta=0., uc_scale=None,
                   infer_all=False, max_sample=16):
@@ -430,21 +441,23 @@ class SDFusionMultiModal2ShapeModel(BaseModel):
         B = self.x.shape[0]
 
         # get uc/c features from img and txt
-        img_uc_feat = self.img_enc(self.uc_img)
-        txt_uc_feat = self.txt_enc(self.uc_txt)
+        with self.autocast():
+            img_uc_feat = self.img_enc(self.uc_img)
+            txt_uc_feat = self.txt_enc(self.uc_txt)
 
-        img_uc_feat = self.img_linear(img_uc_feat)
-        mm_uc_feat = torch.cat([img_uc_feat, txt_uc_feat], dim=1)
+            img_uc_feat = self.img_linear(img_uc_feat)
+            mm_uc_feat = torch.cat([img_uc_feat, txt_uc_feat], dim=1)
 
-        c_img = self.img_enc(self.img)
-        c_txt = self.txt_enc(self.txt)
+            c_img = self.img_enc(self.img)
+            c_txt = self.txt_enc(self.txt)
 
-        c_img = self.img_linear(c_img)
-        c_mm = torch.cat([c_img, c_txt], dim=1)
+            c_img = self.img_linear(c_img)
+            c_mm = torch.cat([c_img, c_txt], dim=1)
         shape = self.z_shape
 
         # get noise, denoise, and decode with vqvae
         samples, intermediates = self.ddim_sampler.sample(S=ddim_steps,
+                                                        log_every_t=None,
                                                         batch_size=B,
                                                         shape=shape,
                                                         conditioning=c_mm,
@@ -454,13 +467,14 @@ class SDFusionMultiModal2ShapeModel(BaseModel):
                                                         eta=ddim_eta,
                                                         quantize_x0=False)
 
-        self.gen_df = self.vqvae_module.decode_no_quant(samples)
+        self.gen_df = self.decode(samples)
         self.switch_train()
 
     # def mm_inference(self, data, ddim_steps=None, ddim_eta=0., uc_scale=3.,
     #         txt_scale=1.0, img_scale=1.0, mask_mode='1', mask_x=False,
     #         mm_cls_free=False,
     #     ):
+    @profiled
     def mm_inference(self, data, mask_mode=None, ddim_steps=None, ddim_eta=0., uc_scale=None, 
                   txt_scale=1.0, img_scale=1.0, mm_cls_free=False, infer_all=False, max_sample=16):
     
@@ -494,14 +508,15 @@ class SDFusionMultiModal2ShapeModel(BaseModel):
         shape = self.z_shape
 
         # get feat
-        img_uc_feat = self.img_enc(self.uc_img)
-        img_uc_feat = self.img_linear(img_uc_feat)
-        txt_uc_feat = self.txt_enc(self.uc_txt)
+        with self.autocast():
+            img_uc_feat = self.img_enc(self.uc_img)
+            img_uc_feat = self.img_linear(img_uc_feat)
+            txt_uc_feat = self.txt_enc(self.uc_txt)
 
-        print(f'[mm inference]: t: {txt_scale}, i:{img_scale}')
-        c_img = self.img_enc(self.img)
-        c_img = self.img_linear(c_img)
-        c_txt = self.txt_enc(self.txt)
+            print(f'[mm inference]: t: {txt_scale}, i:{img_scale}')
+            c_img = self.img_enc(self.img)
+            c_img = self.img_linear(c_img)
+            c_txt = self.txt_enc(self.txt)
 
         # naive inference mode
         if not mm_cls_free:
@@ -515,6 +530,7 @@ class SDFusionMultiModal2ShapeModel(BaseModel):
             c_mm = torch.cat([c_img, c_txt], dim=1)
 
             samples, intermediates = self.ddim_sampler.sample(S=ddim_steps,
+                                                            log_every_t=None,
                                                             batch_size=B,
                                                             shape=shape,
                                                             conditioning=c_mm,
@@ -536,6 +552,7 @@ class SDFusionMultiModal2ShapeModel(BaseModel):
                 'uc_txt': txt_uc_feat,
             }
             samples, intermediates = self.ddim_sampler.sample(S=ddim_steps,
+                                                log_every_t=None,
                                                 batch_size=B,
                                                 shape=shape,
                                                 conditioning=c_mm,
@@ -547,7 +564,7 @@ class SDFusionMultiModal2ShapeModel(BaseModel):
                                                 eta=ddim_eta,
                                                 mm_cls_free=True)
 
-        self.gen_df = self.vqvae_module.decode_no_quant(samples)
+        self.gen_df = self.decode(samples)
 
     @torch.no_grad()
     def eval_metrics(self, dataloader, thres=0.0, global_step=0):
@@ -572,14 +589,15 @@ class SDFusionMultiModal2ShapeModel(BaseModel):
         if 'loss_gamma' in self.loss_dict:
             self.loss_gamma = self.loss_dict['loss_gamma']
 
-        self.loss.backward()
+        self.scaler.scale(self.loss).backward()
 
     def optimize_parameters(self, total_steps):
 
         self.forward()
         self.optimizer.zero_grad()
         self.backward()
-        self.optimizer.step()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
 
     def get_logs_data(self):
         """ return a dictionary with
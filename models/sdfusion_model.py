@@ -2,6 +2,7 @@
 # Specifically, functions from: https://github.com/CompVis/latent-diffusion/blob/main/ldm/models/diffusion/ddpm.py
 
 import os
+import time
 from collections import OrderedDict
 from functools import partial
 from typing import List
@@ -23,9 +24,14 @@ import torchvision.transforms as transforms
 
 from models.online_loss import OnlineLoss
 from models.base_model import BaseModel
+from models.profiler import profiled
 from models.networks.vqvae_networks.network import VQVAE
 from models.networks.diffusion_networks.network import DiffusionUNet
-from models.model_utils import load_vqvae
+from models.networks.diffusion_networks.openai_model_3d import set_prompt_mode, set_lean_backward, set_token_merging
+from models.model_utils import load_vqvae, grad_scaler, set_memory_format
+from models.distillation import load_student
+from models.quantization import load_int8
+from models.pruning import load_pruned
 # add near the other imports
 from models.networks.diffusion_networks.prompt import SoftPrompt3D
 
@@ -34,13 +40,14 @@ from utils.replay_buffer import TopKBuffer
 
 # ldm util
 from models.networks.diffusion_networks.ldm_diffusion_util import (
+    SDFUSION_SCHEDULE,
     make_beta_schedule,
     extract_into_tensor,
     noise_like,
     exists,
     default,
 )
-from models.networks.diffusion_networks.samplers.ddim import DDIMSampler
+from models.networks.diffusion_networks.samplers.ddim import DDIMSampler, make_sampler, sampler_kwargs
 
 # distributed 
 from utils.distributed import reduce_loss_dict
@@ -48,7 +55,9 @@ from utils.distributed import reduce_loss_dict
 # rendering
 # from utils.util_3d import init_mesh_renderer, render_sdf
 from simulation.run_simulation import run_simulation
-from simulation.sofa_live_runner import SofaLiveRunner, run_simulation_keepalive
+from simulation.sofa_live_runner import SofaLiveRunner, run_simulation_keepalive, run_simulation_worker
+from simulation.sdf_ring import SimulationPool
+from simulation.sdf_checks import quick_cavity_check
 
 class SDFusionModel(BaseModel):
     def name(self):
@@ -64,6 +73,7 @@ class SDFusionModel(BaseModel):
         self.loss_dict, self.loss_total, self.loss_simple, self.loss_vlb, self.loss_gamma = None, None, None, None, None
 
         self.simulation_runner = SofaLiveRunner()
+        self.t_start = time.time()
         
         # setup renderer
         if 'snet' in opt.dataset_mode:
@@ -94,10 +104,15 @@ class SDFusionModel(BaseModel):
         unet_params = df_conf.unet.params
         self.df = DiffusionUNet(unet_params, vq_conf=vq_conf)
         self.df.to(self.device)
+        set_prompt_mode(self.df, prompt_norm=opt.prompt_norm, kv_cache=opt.prompt_kv_cache)
+        set_token_merging(self.df, opt.tome_ratio)
         self.init_diffusion_params(scale=1, opt=opt)
 
         # init vqvae
         self.vqvae = load_vqvae(vq_conf, vq_ckpt=opt.vq_ckpt, opt=opt)
+        # opt-in channels-last conv stacks, before the weights are loaded / wrapped
+        set_memory_format(self.df, opt.memory_format)
+        set_memory_format(self.vqvae, opt.memory_format)
         # if opt.online_sofa:
         self.df.requires_grad_(False)  # freeze UNet except prompt
         self.vqvae.requires_grad_(False)  # freeze VQ-VAE
@@ -107,6 +122,10 @@ class SDFusionModel(BaseModel):
                 self.prompt_modules.append(module)   # remember it
                 module.requires_grad_(True)  # unfreeze prompt  
 
+        self.init_prompt_training(opt)
+
+        self.init_sim_workers(opt, (shape_res,) * 3)
+
         total = sum(p.numel() for p in self.df.parameters())
         train  = sum(p.numel() for p in self.df.parameters() if p.requires_grad)
         soft_prompt_param = sum(p.numel() for m in self.prompt_modules for p in m.parameters())
@@ -128,6 +147,8 @@ class SDFusionModel(BaseModel):
         for i in prm:
             assert i.requires_grad
         self.optimizer= optim.AdamW(prm, lr=opt.lr)
+        # loss scaling for --precision fp16 (pass-through otherwise)
+        self.scaler   = grad_scaler(self.device, opt.precision)
         self.scheduler= optim.lr_scheduler.StepLR(self.optimizer, 1000, 0.9)
         self.optimizers = [self.optimizer]
         self.schedulers = [self.scheduler]
@@ -155,6 +176,21 @@ class SDFusionModel(BaseModel):
                 self.optimizers = [self.optimizer]
             # self.schedulers = [self.scheduler]
 
+        self.ddim_steps = 200
+        if self.opt.debug == "1":
+            # NOTE: for debugging purpose
+            self.ddim_steps = 7
+        # these replace or reshape parameters: on the bare networks, before DDP wraps them
+        if opt.pruned_ckpt is not None:
+            # structurally pruned unet from prune.py, replaces the df weights of --ckpt
+            load_pruned(self, opt.pruned_ckpt)
+        if opt.student_ckpt is not None:
+            # few-step student from distill.py, sets ddim_steps and the trailing ddim grid
+            load_student(self, opt.student_ckpt)
+        if opt.int8_ckpt is not None:
+            # cpu inference build from quantize.py: int8 unet and vqvae decoder
+            load_int8(self, opt.int8_ckpt)
+
         # for distributed training
         if self.opt.distributed:
             self.make_distributed(opt)
@@ -165,11 +201,29 @@ class SDFusionModel(BaseModel):
             self.df_module = self.df
             self.vqvae_module = self.vqvae
 
-        self.ddim_steps = 200
-        if self.opt.debug == "1":
-            # NOTE: for debugging purpose
-            self.ddim_steps = 7
         cprint(f'[*] setting ddim_steps={self.ddim_steps}', 'blue')
+        self.init_profiler(df=self.df, vqvae=self.vqvae)
+
+    def init_prompt_training(self, opt):
+        """ backward mode of the online prompt updates. gated on opt alone: SDFusionOpt (train.py) has isTrain=False """
+        if opt.lean_backward:
+            # only the prompts train: no autograd for the frozen prefix, selective recomputation behind it
+            set_lean_backward(self.df, checkpoint=opt.lean_checkpoint)
+
+    def init_sim_workers(self, opt, sdf_shape):
+        """ --sim_workers: decoded sdfs go to simulation processes through a shared-memory ring (no pickling) """
+        self.sim_pool = None
+        if opt.sim_workers > 0:
+            self.sim_pool = SimulationPool(partial(run_simulation_worker, n_steps=200), opt.sim_workers,
+                                           sdf_shape, n_slots=opt.sim_slots or None)
+            cprint(f'[*] {opt.sim_workers} simulation workers, {self.sim_pool.ring.n_slots} sdf slots '
+                   f'({"pinned" if self.sim_pool.ring.pinned else "pageable"})', 'blue')
+
+    def close(self):
+        """ stop the simulation workers and free their sdf ring """
+        if getattr(self, 'sim_pool', None) is not None:
+            self.sim_pool.close()
+            self.sim_pool = None
 
     def make_distributed(self, opt):
         self.df = nn.parallel.DistributedDataParallel(
@@ -194,8 +248,8 @@ class SDFusionModel(BaseModel):
         self.v_posterior = 0.
         self.original_elbo_weight = 0.
         self.l_simple_weight = 1.
-        # ref: ddpm.py, register_schedule
-        self.register_schedule()
+        # ref: ddpm.py, register_schedule. SDFUSION_SCHEDULE is shared with distill / prune / quantize / export
+        self.register_schedule(**SDFUSION_SCHEDULE)
         logvar_init = 0.
         self.logvar = torch.full(fill_value=logvar_init, size=(self.num_timesteps,)).to(self.device)
         self.scale = scale # default for uncond
@@ -295,13 +349,14 @@ class SDFusionModel(BaseModel):
             key = 'c_concat' if self.df_module.conditioning_key == 'concat' else 'c_crossattn'
             cond = {key: cond}
 
-        # eps
-        out = self.df(x_noisy, t, **cond)
+        # eps, under the precision policy. returned in fp32, so the sampler updates and losses stay fp32
+        with self.autocast():
+            out = self.df(x_noisy, t, **cond)
 
         if isinstance(out, tuple) and not return_ids:
-            return out[0]
+            return out[0].float()
         else:
-            return out
+            return out.float() if torch.is_tensor(out) else out
 
     def get_loss(self, pred, target, loss_type='l2', mean=True):
         if loss_type == 'l1':
@@ -340,6 +395,7 @@ class SDFusionModel(BaseModel):
         # l2
         loss_simple = self.get_loss(model_output, target, mean=False).mean([1, 2, 3, 4])
         loss_dict.update({f'loss_simple': loss_simple.mean()})
+        loss_dict.update({f'loss_simple_var': loss_simple.detach().var(unbiased=False)})
 
         logvar_t = self.logvar[t].to(self.device)
         loss = loss_simple / torch.exp(logvar_t) + logvar_t
@@ -378,6 +434,7 @@ class SDFusionModel(BaseModel):
 
     # check: ddpm.py, log_images(). line 1317~1327
     @torch.no_grad()
+    @profiled
     def inference(self, data, sample=True, ddim_steps=None, ddim_eta=0., quantize_denoised=True,
                   infer_all=False, max_sample=16):
 
@@ -389,7 +446,7 @@ class SDFusionModel(BaseModel):
         else:
             self.set_input(data)
 
-        ddim_sampler = DDIMSampler(self)
+        ddim_sampler = make_sampler(self, self.opt)
 
         # ddim_eta=0.0  # 0.0 for deterministic
         scale = self.scale
@@ -403,6 +460,7 @@ class SDFusionModel(BaseModel):
         c = None
         
         samples, intermediates = ddim_sampler.sample(S=ddim_steps,
+                                                     log_every_t=None,
                                                      batch_size=B,
                                                      shape=shape,
                                                      conditioning=c,
@@ -413,13 +471,14 @@ class SDFusionModel(BaseModel):
 
 
         # decode z
-        self.gen_df = self.vqvae_module.decode_no_quant(samples)
+        self.gen_df = self.decode(samples)
 
         self.df.train()
 
     @torch.no_grad()
-    def uncond(self, ngen=1, ddim_steps=200, ddim_eta=0., scale=None):
-        ddim_sampler = DDIMSampler(self)
+    @profiled
+    def uncond(self, ngen=1, ddim_steps=None, ddim_eta=0., scale=None):
+        ddim_sampler = make_sampler(self, self.opt)
 
         if scale is None:
             scale = self.scale
@@ -433,6 +492,7 @@ class SDFusionModel(BaseModel):
         c = None
         
         samples, intermediates = ddim_sampler.sample(S=ddim_steps,
+                                                     log_every_t=None,
                                                      batch_size=B,
                                                      shape=shape,
                                                      conditioning=c,
@@ -443,13 +503,14 @@ class SDFusionModel(BaseModel):
 
 
         # decode z
-        self.gen_df = self.vqvae_module.decode_no_quant(samples)
+        self.gen_df = self.decode(samples)
         return self.gen_df
 
     @torch.no_grad()
-    def shape_comp(self, shape, xyz_dict, ngen=1, ddim_steps=100, ddim_eta=0.0, scale=None):        
+    @profiled
+    def shape_comp(self, shape, xyz_dict, ngen=1, ddim_steps=None, ddim_eta=0.0, scale=None):        
         from utils.demo_util import get_partial_shape
-        ddim_sampler = DDIMSampler(self)
+        ddim_sampler = make_sampler(self, self.opt)
         
         if scale is None:
             scale = self.scale
@@ -479,6 +540,7 @@ class SDFusionModel(BaseModel):
         shape = self.z_shape
         c = None
         samples, intermediates = ddim_sampler.sample(S=ddim_steps,
+                                                     log_every_t=None,
                                                      batch_size=B,
                                                      shape=shape,
                                                      conditioning=c,
@@ -491,7 +553,7 @@ class SDFusionModel(BaseModel):
 
 
         # decode z
-        self.gen_df = self.vqvae_module.decode_no_quant(samples)
+        self.gen_df = self.decode(samples)
         
         return self.gen_df
 
@@ -518,93 +580,111 @@ class SDFusionModel(BaseModel):
 
         self.loss.backward()
 
+    @torch.no_grad()
+    def prune_candidates(self, pred_x0):
+        """ prune_fn for DDIMSampler.sample: decode the pred_x0 preview and return a reject reason (or None) per candidate """
+        scale = self.opt.prune_preview_scale
+        if scale != 1.0:
+            # smaller latent -> proportionally cheaper decode, coarser preview
+            pred_x0 = F.interpolate(pred_x0, scale_factor=scale, mode='trilinear', align_corners=False)
+        sdf = self.decode(pred_x0)[:, 0].cpu().numpy()
+        min_cavity = max(1, int(round(self.opt.prune_min_cavity * scale ** 3)))
+        return [quick_cavity_check(sdf_i, min_cavity_voxels=min_cavity) for sdf_i in sdf]
+
     def optimize_parameters(self):
-        ddim_sampler = DDIMSampler(self)
+        ddim_sampler = DDIMSampler(self, **sampler_kwargs(self.opt))
+        prune_fn = self.prune_candidates if self.opt.prune_step >= 0 else None
         with torch.no_grad():
-            latent, _ = ddim_sampler.sample(
-                            S      = 25,
+            latent, intermediates = ddim_sampler.sample(
+                            # a distilled student only knows the timesteps of its own trailing grid
+                            S      = self.ddim_steps if self.opt.student_ckpt is not None else 25,
                             batch_size = self.opt.batch_size,
                             shape      = self.z_shape,
                             conditioning= None,
-                            eta        = 0.0)
-            sdf = self.vqvae_module.decode_no_quant(latent).squeeze().cpu().numpy()
-            latent = latent.to(self.device)
-            if self.opt.batch_size == 1:
-                sdf = [sdf]
-                latent = [latent.squeeze(0)]  # Remove batch dimension but keep as tensor
-            else:
-                latent = [latent[i] for i in range(latent.shape[0])]
+                            eta        = 0.0,
+                            log_every_t= None,
+                            prune_at   = self.opt.prune_step,
+                            prune_fn   = prune_fn)
+            # pruned candidates never reach the simulator, so they are not pushed to the replay buffer
+            self.n_pruned = len(intermediates['pruned']) if prune_fn is not None else 0
+            sdf = self.decode(latent)[:, 0]
+            latent = list(latent.to(self.device))
 
 
         # -- 2. run SOFA, obtain bending angle ------------
         # from utils.sofa_wrapper import run_sofa_once
 
-        ## TODO: parallelize this ~ each mature sdf takes 12s to mesh + simulate
-        angle = [run_simulation_keepalive(runner = self.simulation_runner, sdf = sdf_i, n_steps = 200) for sdf_i in sdf]  
+        # each mature sdf takes ~12s to mesh + simulate: --sim_workers runs them in parallel
+        t_sim = time.time()
+        if self.sim_pool is not None:
+            angle = self.sim_pool.map(sdf)
+        else:
+            angle = [run_simulation_keepalive(runner = self.simulation_runner, sdf = sdf_i, n_steps = 200) for sdf_i in sdf.cpu().numpy()]
+        self.sec_per_sim = (time.time() - t_sim) / max(len(sdf), 1)
         
         # -- 3. push into replay buffer -------------------
         self.replay.push(zip(list(angle), list(latent)))   # store clean z₀
         
         #size of the buffer dataset
         buffer = self.opt.buffer_size + self.opt.top_k
-        # -- 4. optimise prompt on a minibatch from buffer
+        # -- 4. optimise prompt on minibatches from buffer
+        #    utd_ratio: optimizer steps per simulation round
+        #    timesteps_per_latent: K noise levels per replayed z0, evaluated in one batched forward
         if len(self.replay) >= buffer:
-            batch = self.replay.sample(self.opt.batch_size) #list of tuples (angle, counter, z0)
-            z0 = torch.stack([item[2] for item in batch], dim =0).to(self.device)  # stack z0
-            c = None
-
-            t  = torch.randint(0, self.num_timesteps, (z0.shape[0],), device=self.device)
-            z_noisy, target, loss, loss_dict = self.p_losses(z0, c, t)
-            self.loss_dict = loss_dict
-            self.loss = loss 
-
-            self.loss_dict = reduce_loss_dict(self.loss_dict)
+            K = self.opt.timesteps_per_latent
+            loss_var = []
+            cuda = str(self.device).startswith('cuda')
+            if cuda:
+                torch.cuda.reset_peak_memory_stats()
+            # one profiled run (--profile_dir), the one that times backward with --profile_backward
+            with self.profile_run('prompt_update'):
+                for _ in range(self.opt.utd_ratio):
+                    z0, t = self.replay_batch(K)
+                    c = None
+
+                    z_noisy, target, loss, loss_dict = self.p_losses(z0, c, t)
+                    loss_var.append(loss_dict.pop('loss_simple_var'))
+
+                    self.optimizer.zero_grad()
+                    self.scaler.scale(loss).backward()   # grads flow ONLY into soft-prompt tensors
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+
+            self.loss = loss
+            self.loss_dict = reduce_loss_dict(loss_dict)
             self.loss_total = self.loss_dict['loss_total']
             self.loss_simple = self.loss_dict['loss_simple']
             self.loss_vlb = self.loss_dict['loss_vlb']
             if 'loss_gamma' in self.loss_dict:
                 self.loss_gamma = self.loss_dict['loss_gamma']
+            self.loss_var = torch.stack(loss_var).mean()
+            if cuda:
+                # peak over the prompt updates, what bounds the replay batch size
+                self.peak_mem_mb = torch.cuda.max_memory_allocated() / 2 ** 20
 
-            # for _, _, z0 in batch:
-            #     z0 = z0.to(self.device)
-            #     eps= torch.randn_like(z0)
-            #     zt = self.q_sample(z0, t, noise=eps).unsqueeze(0)
-            #     eps_pred = self.apply_model(zt, t, cond=None)  # frozen UNet + prompt
-            #     loss     += F.mse_loss(eps_pred, eps)
-
-            loss /= buffer_batch
-
-            loss_dict = {}
-            loss_simple = loss
-            loss_dict.update({f'loss_simple': loss_simple.mean()})
-
-            logvar_t = self.logvar[t].to(self.device)
-            loss_v = loss_simple / torch.exp(logvar_t) + logvar_t
-            if self.learn_logvar:
-                loss_dict.update({f'loss_gamma': loss_v.mean()})
-                loss_dict.update({'logvar': self.logvar.data.mean()})
-
-            loss_v = self.l_simple_weight * loss_v.mean()
-
-            loss_vlb = loss
-            loss_vlb = (self.lvlb_weights[t] * loss_vlb).mean()
-            loss_dict.update({f'loss_vlb': loss_vlb})
-            loss_v += (self.original_elbo_weight * loss_vlb)
-            loss_dict.update({f'loss_total': loss_v.clone().detach().mean()})
-            self.loss_dict = loss_dict
-            self.loss_dict = reduce_loss_dict(self.loss_dict)
-            self.loss_total = self.loss_dict['loss_total']
-            self.loss_simple = self.loss_dict['loss_simple']
-            self.loss_vlb = self.loss_dict['loss_vlb']
-
-            self.optimizer.zero_grad()
-            self.loss.backward()          # grads flow ONLY into soft-prompt tensors
-            self.optimizer.step()
+        self.wall_time = time.time() - self.t_start
 
         # bookkeeping for logger
         # self.loss_total = torch.tensor(angle)   # display current physical score
-        # bookkeeping for logger
-        # self.loss_total = torch.tensor(angle)   # display current physical score
+
+    def sample_timesteps(self, n, k=1):
+        """
+            stratified draw of k timesteps per latent: one per [bins[i], bins[i+1]) with bins = arange(k+1)*T//k,
+            so the bins cover all of [0, T) when k does not divide T. returns (n*k,), latent-major
+        """
+        if k == 1:
+            return torch.randint(0, self.num_timesteps, (n,), device=self.device).long()
+        bins = torch.arange(k + 1, device=self.device) * self.num_timesteps // k
+        width = (bins[1:] - bins[:-1])[None, :]
+        t = bins[None, :-1] + (torch.rand(n, k, device=self.device) * width).long()
+        return t.reshape(-1).long()
+
+    def replay_batch(self, k=1):
+        """ a replay minibatch for the prompt updates: z0 repeated k times (B*k, ...) and the k timesteps of each """
+        batch = self.replay.sample(self.opt.batch_size) #list of tuples (angle, counter, z0)
+        z0 = torch.stack([item[2] for item in batch], dim =0).to(self.device)  # stack z0
+        z0 = z0.repeat_interleave(k, dim=0)                                    # (B*K, C, D, H, W)
+        return z0, self.sample_timesteps(z0.shape[0] // k, k)
 
     def get_current_errors(self):
         
@@ -617,6 +697,16 @@ class SDFusionModel(BaseModel):
         if hasattr(self, 'loss_gamma'):
             ret['gamma'] = self.loss_gamma.data
 
+        # online loop: per-sample loss variance and sim cost vs. wall clock
+        if hasattr(self, 'loss_var'):
+            ret['loss_var'] = self.loss_var.data
+        if hasattr(self, 'sec_per_sim'):
+            ret['sec_per_sim'] = self.sec_per_sim
+            ret['wall_time'] = self.wall_time
+            ret['n_pruned'] = self.n_pruned
+        if hasattr(self, 'peak_mem_mb'):
+            ret['peak_mem_mb'] = self.peak_mem_mb
+
         return ret
 
     def get_current_visuals(self):
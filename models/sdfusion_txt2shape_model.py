@@ -23,10 +23,13 @@ import torchvision.utils as vutils
 import torchvision.transforms as transforms
 
 from models.base_model import BaseModel
+from models.profiler import profiled
 from models.networks.vqvae_networks.network import VQVAE
 from models.networks.diffusion_networks.network import DiffusionUNet
+from models.networks.diffusion_networks.attention import set_attn_mem_budget
 from models.networks.bert_networks.network import BERTTextEncoder
-from models.model_utils import load_vqvae
+from models.networks.bert_networks.embedding_cache import TextEmbeddingCache, state_dict_hash
+from models.model_utils import load_vqvae, grad_scaler, set_memory_format
 
 # ldm util
 from models.networks.diffusion_networks.ldm_diffusion_util import (
@@ -36,7 +39,7 @@ from models.networks.diffusion_networks.ldm_diffusion_util import (
     exists,
     default,
 )
-from models.networks.diffusion_networks.samplers.ddim import DDIMSampler
+from models.networks.diffusion_networks.samplers.ddim import DDIMSampler, sampler_kwargs
 
 # distributed 
 from utils.distributed import reduce_loss_dict
@@ -73,13 +76,17 @@ class SDFusionText2ShapeModel(BaseModel):
         unet_params = df_conf.unet.params
         self.df = DiffusionUNet(unet_params, vq_conf=vq_conf, conditioning_key=df_model_params.conditioning_key)
         self.df.to(self.device)
+        set_attn_mem_budget(self.df, opt.attn_mem_budget)
         self.init_diffusion_params(uc_scale=3., opt=opt)
         
         # sampler 
-        self.ddim_sampler = DDIMSampler(self)
+        self.ddim_sampler = DDIMSampler(self, **sampler_kwargs(self.opt))
         
         # init vqvae
         self.vqvae = load_vqvae(vq_conf, vq_ckpt=opt.vq_ckpt, opt=opt)
+        # opt-in channels-last conv stacks, before the weights are loaded / wrapped
+        set_memory_format(self.df, opt.memory_format)
+        set_memory_format(self.vqvae, opt.memory_format)
 
         # init cond model
         bert_params = df_conf.bert.params
@@ -101,6 +108,8 @@ class SDFusionText2ShapeModel(BaseModel):
             
             # initialize optimizers
             self.optimizer = optim.AdamW(trainable_params, lr=opt.lr)
+            # loss scaling for --precision fp16 (pass-through otherwise)
+            self.scaler = grad_scaler(self.device, opt.precision)
             self.scheduler = optim.lr_scheduler.StepLR(self.optimizer, 1000, 0.9)
 
             self.optimizers = [self.optimizer]
@@ -130,12 +139,20 @@ class SDFusionText2ShapeModel(BaseModel):
             self.vqvae_module = self.vqvae
             self.cond_model_module = self.cond_model
 
+        # BERT outputs for sampling, keyed by the cond_model weights. off while training, the weights keep changing
+        self.text_cache = None
+        self.uc_embedding = None
+        if not self.isTrain:
+            self.text_cache = TextEmbeddingCache(max_entries=opt.text_cache_size, cache_dir=opt.text_cache_dir)
+            self.refresh_text_cache()
+
         # for debugging purpose
         self.ddim_steps = 100
         if self.opt.debug == "1":
             # NOTE: for debugging purpose
             self.ddim_steps = 7
         cprint(f'[*] setting ddim_steps={self.ddim_steps}', 'blue')
+        self.init_profiler(df=self.df, vqvae=self.vqvae, cond_model=self.cond_model)
 
 
     def make_distributed(self, opt):
@@ -282,13 +299,14 @@ class SDFusionText2ShapeModel(BaseModel):
             key = 'c_concat' if self.df_module.conditioning_key == 'concat' else 'c_crossattn'
             cond = {key: cond}
 
-        # eps
-        out = self.df(x_noisy, t, **cond)
+        # eps, under the precision policy. returned in fp32, so the sampler updates and losses stay fp32
+        with self.autocast():
+            out = self.df(x_noisy, t, **cond)
 
         if isinstance(out, tuple) and not return_ids:
-            return out[0]
+            return out[0].float()
         else:
-            return out
+            return out.float() if torch.is_tensor(out) else out
 
     def get_loss(self, pred, target, loss_type='l2', mean=True):
         if loss_type == 'l1':
@@ -365,8 +383,33 @@ class SDFusionText2ShapeModel(BaseModel):
         self.loss_dict = loss_dict
 
 
+    def refresh_text_cache(self):
+        """ rekey the text embedding cache on the current cond_model weights and recompute the uc embedding """
+        if self.text_cache is None:
+            return
+        self.text_cache.weights_hash = state_dict_hash(self.cond_model_module)
+        self.uc_embedding = self.encode_text([''])
+
+    @torch.no_grad()
+    def encode_text(self, texts):
+        """ cond_model(texts) [B, 77, 1280], from the text embedding cache when it is on """
+        if self.text_cache is None:
+            with self.autocast():
+                return self.cond_model(texts).float()
+        # cached embeddings are always computed in fp32, BERT runs once per string anyway
+        return self.text_cache.encode(self.cond_model_module, texts, device=self.device)
+
+    @torch.no_grad()
+    def encode_uc(self, B):
+        """ embedding of the empty uc text for B rows, precomputed once per load when the cache is on """
+        if self.uc_embedding is None:
+            with self.autocast():
+                return self.cond_model([''] * B).float()
+        return self.uc_embedding.expand(B, -1, -1)
+
     # check: ddpm.py, log_images(). line 1317~1327
     @torch.no_grad()
+    @profiled
     def inference(self, data, ddim_steps=None, ddim_eta=0., uc_scale=None,
                   infer_all=False, max_sample=16):
 
@@ -385,11 +428,12 @@ class SDFusionText2ShapeModel(BaseModel):
             uc_scale = self.uc_scale
             
         # get noise, denoise, and decode with vqvae
-        uc = self.cond_model(self.uc_text)
-        c_text = self.cond_model(self.text)  
+        c_text = self.encode_text(self.text)
         B = c_text.shape[0]
+        uc = self.encode_uc(B)
         shape = self.z_shape
         samples, intermediates = self.ddim_sampler.sample(S=ddim_steps,
+                                                     log_every_t=None,
                                                      batch_size=B,
                                                      shape=shape,
                                                      conditioning=c_text,
@@ -399,47 +443,99 @@ class SDFusionText2ShapeModel(BaseModel):
                                                      eta=ddim_eta)
         
         # decode z
-        self.gen_df = self.vqvae_module.decode_no_quant(samples)
+        self.gen_df = self.decode(samples)
 
         self.switch_train()
 
     @torch.no_grad()
+    @profiled
     def txt2shape(self, input_txt, ngen=6, ddim_steps=100, ddim_eta=0.0, uc_scale=None):
+        # get_current_visuals writes the prompt on the renders
+        self.text = [input_txt] * ngen
+        self.gen_df = self.txt2shape_batch([input_txt], ngen=ngen, ddim_steps=ddim_steps, ddim_eta=ddim_eta,
+                                           uc_scale=uc_scale)[0]
+        return self.gen_df
 
+    @torch.no_grad()
+    @profiled
+    def txt2shape_batch(self, prompts, ngen=6, ddim_steps=None, ddim_eta=0.0, uc_scale=None,
+                        max_batch=None, mem_budget=None):
+        """
+            ngen shapes for every prompt in `prompts`, as a list with one [ngen, 1, res, res, res] sdf per prompt.
+            each distinct string goes through BERT at most once (see encode_text), in a single call, and is
+            broadcast to its rows. all rows are then sampled in as few DDIM batches as fit `max_batch` rows, or the rows that
+            fit `mem_budget` GB of activations (cuda only, see rows_per_batch).
+        """
         self.switch_eval()
 
-        data = {
-            'sdf': torch.zeros(ngen),
-            'text': [input_txt] * ngen,
-        }
-        
-        self.set_input(data)
-
-        ddim_sampler = DDIMSampler(self)
-        
         if ddim_steps is None:
             ddim_steps = self.ddim_steps
 
         if uc_scale is None:
-            uc_scale = self.scale
-            
-        # get noise, denoise, and decode with vqvae
-        uc = self.cond_model(self.uc_text)
-        c_text = self.cond_model(self.text)  
-        B = c_text.shape[0]
-        shape = self.z_shape
-        samples, intermediates = ddim_sampler.sample(S=ddim_steps,
-                                                     batch_size=B,
-                                                     shape=shape,
-                                                     conditioning=c_text,
-                                                     verbose=False,
-                                                     unconditional_guidance_scale=uc_scale,
-                                                     unconditional_conditioning=uc,
-                                                     eta=ddim_eta)
-        
-        # decode z
-        self.gen_df = self.vqvae_module.decode_no_quant(samples)
-        return self.gen_df
+            uc_scale = self.uc_scale
+
+        # encode every distinct string once, the uc text last
+        unique = OrderedDict((p, i) for i, p in enumerate(OrderedDict.fromkeys(prompts)))
+        c_unique = self.encode_text(list(unique))
+        uc = self.encode_uc(1)
+        rows = torch.tensor([unique[p] for p in prompts], device=c_unique.device).repeat_interleave(ngen)
+
+        n_rows = rows.shape[0]
+        batch = self.rows_per_batch(mem_budget=mem_budget, max_batch=max_batch)
+        # same number of rows in every batch, instead of a full ones and a small remainder
+        n_batches = -(-n_rows // batch)
+        batch = -(-n_rows // n_batches)
+
+        gen_df = []
+        for i in range(0, n_rows, batch):
+            c_text = c_unique[rows[i:i + batch]]
+            B = c_text.shape[0]
+            samples, _ = self.ddim_sampler.sample(S=ddim_steps,
+                                                  log_every_t=None,
+                                                  batch_size=B,
+                                                  shape=self.z_shape,
+                                                  conditioning=c_text,
+                                                  verbose=False,
+                                                  unconditional_guidance_scale=uc_scale,
+                                                  unconditional_conditioning=uc.expand(B, -1, -1),
+                                                  eta=ddim_eta)
+            gen_df.append(self.decode(samples))
+
+        return list(torch.cat(gen_df).split(ngen))
+
+    @torch.no_grad()
+    def rows_per_batch(self, mem_budget=None, max_batch=None):
+        """
+            # of samples per DDIM batch in txt2shape_batch: max_batch (default opt.max_sample_batch), lowered to
+            what keeps the allocated memory, weights included, under mem_budget GB (default opt.sample_mem_budget).
+            the cost of a row is measured once, on the first call with a budget, as the difference in peak memory
+            of a guided UNet call / a decode with 2 vs. 1 rows.
+        """
+        if max_batch is None:
+            max_batch = self.opt.max_sample_batch
+        if mem_budget is None:
+            mem_budget = self.opt.sample_mem_budget
+        if mem_budget is None or not str(self.device).startswith('cuda'):
+            return max_batch
+
+        if getattr(self, 'bytes_per_row', None) is None:
+            def peak(n):
+                x = torch.zeros(n, *self.z_shape, device=self.device)
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+                base = torch.cuda.memory_allocated()
+                # a guided step runs 2 UNet rows per sample
+                c = torch.zeros(2 * n, 77, self.text_embed_dim, device=self.device)
+                t = torch.zeros(2 * n, dtype=torch.long, device=self.device)
+                self.apply_model(torch.cat([x] * 2), t, c)
+                unet = torch.cuda.max_memory_allocated() - base
+                torch.cuda.reset_peak_memory_stats()
+                self.decode(x)
+                return max(unet, torch.cuda.max_memory_allocated() - base)
+            self.bytes_per_row = max(peak(2) - peak(1), 1)
+
+        free = mem_budget * 1024 ** 3 - torch.cuda.memory_allocated()
+        return int(max(1, min(max_batch, free // self.bytes_per_row)))
 
     @torch.no_grad()
     def eval_metrics(self, dataloader, thres=0.0, global_step=0):
@@ -464,7 +560,7 @@ class SDFusionText2ShapeModel(BaseModel):
         if 'loss_gamma' in self.loss_dict:
             self.loss_gamma = self.loss_dict['loss_gamma']
 
-        self.loss.backward()
+        self.scaler.scale(self.loss).backward()
 
     def optimize_parameters(self, total_steps):
 
@@ -474,7 +570,8 @@ class SDFusionText2ShapeModel(BaseModel):
         self.forward()
         self.optimizer.zero_grad()
         self.backward()
-        self.optimizer.step()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
 
     def get_logs_data(self):
         """ return a dictionary with
@@ -572,6 +669,9 @@ class SDFusionText2ShapeModel(BaseModel):
         self.df.load_state_dict(state_dict['df'])
         self.cond_model.load_state_dict(state_dict['cond_model'])
         print(colored('[*] weight successfully load from: %s' % ckpt, 'blue'))
+        # no-op during initialize, the cache is set up after the first load
+        if getattr(self, 'text_cache', None) is not None:
+            self.refresh_text_cache()
 
         if load_opt:
             self.optimizer.load_state_dict(state_dict['opt'])
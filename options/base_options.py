@@ -53,6 +53,33 @@ class BaseOptions():
         self.parser.add_argument('--ddim_steps', type=int, default=100, help='steps for ddim sampler')
         self.parser.add_argument('--ddim_eta', type=float, default=0.0)
         self.parser.add_argument('--uc_scale', type=float, default=1.0, help='scale for un guidance')
+        self.parser.add_argument('--compile_sampler', action='store_true', help='torch.compile the unet forward and ddim update during sampling')
+        self.parser.add_argument('--cfg_window', type=int, nargs=2, default=None, help='[t_min t_max] ddpm timesteps where classifier-free guidance is applied. default: all')
+        self.parser.add_argument('--uncond_every', type=int, default=1, help='recompute the unconditional prediction every n guided steps, reuse it in between')
+        self.parser.add_argument('--deep_cache_interval', type=int, default=1, help='full unet call every n sampling calls, the rest reuse the cached deep features. 1 disables the cache')
+        self.parser.add_argument('--deep_cache_branch', type=int, default=1, help='# of outermost input/output blocks recomputed on cached calls')
+        self.parser.add_argument('--sampler', type=str, default='ddim', choices=['ddim', 'dpm_solver++'], help='sampler of SDFusionModel.uncond / shape_comp / inference. the online loop, txt2shape / img2shape / mm and distilled students always use ddim')
+        self.parser.add_argument('--dpm_order', type=int, default=2, choices=[1, 2, 3], help='multistep order of --sampler dpm_solver++, 10-20 steps is its range')
+        self.parser.add_argument('--ddim_discretize', type=str, default='uniform', choices=['uniform', 'quad', 'trailing'], help='ddim timestep grid. distilled students sample on "trailing"')
+        self.parser.add_argument('--student_ckpt', type=str, default=None, help='progressively distilled student (distill.py) to sample with, instead of the df weights of --ckpt')
+        self.parser.add_argument('--int8_ckpt', type=str, default=None, help='int8 cpu build of the unet and vqvae decoder from quantize.py, replaces --ckpt')
+        self.parser.add_argument('--pruned_ckpt', type=str, default=None, help='channel / head pruned unet from prune.py, replaces the df weights of --ckpt')
+        self.parser.add_argument('--max_sample_batch', type=int, default=32, help='max # of shapes per ddim batch when sampling many prompts (txt2shape_batch)')
+        self.parser.add_argument('--sample_mem_budget', type=float, default=None, help='GB of cuda memory batched sampling may allocate, lowers --max_sample_batch to fit. default: no budget')
+        self.parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='autocast dtype for the unet, vqvae decoder and conditioning encoders. fp16 is cuda only and uses loss scaling when training')
+        self.parser.add_argument('--attn_mem_budget', type=float, default=256, help='MB for the similarities of one 3d cross-attention call, queries are chunked to fit. 0: full (b*heads, n, m) matrix')
+        self.parser.add_argument('--tome_ratio', type=float, nargs='+', default=[0.], help='share of spatial tokens merged (ToMe) before each unet self-attention, one value for all blocks or one per block. 0: off, at most 0.5')
+        self.parser.add_argument('--decode_tile', type=int, default=0, help='decode the sdf through overlapping tiles of this many latent voxels per side (vqvae_networks/tiled_decode.py). 0: one pass, or from --decode_mem_budget')
+        self.parser.add_argument('--decode_mem_budget', type=float, default=0, help='MB for the activations of one decode tile, picks the tile size unless --decode_tile. 0: no budget')
+        self.parser.add_argument('--decode_overlap', type=int, default=None, help='latent voxels a decode tile reaches into its neighbours. default: the decoder receptive margin (5 for vqvae_snet), where tiled = one-pass decode. less is cheaper and blends the seams')
+        self.parser.add_argument('--decode_store', type=str, default=None, help='device holding the decode tiles between layers, e.g. cpu to bound gpu memory by one tile. default: --device')
+        self.parser.add_argument('--memory_format', type=str, default='contiguous', choices=['contiguous', 'channels_last_3d'], help='layout of the unet / vqvae conv activations. contiguous is the fallback if channels_last_3d is slower on a backend')
+        self.parser.add_argument('--prompt_norm', type=str, default='joint', choices=['joint', 'separate'], help='groupnorm statistics of prompted attention blocks: over main + prompt tokens, or each on their own (needed by --prompt_kv_cache)')
+        self.parser.add_argument('--prompt_kv_cache', action='store_true', help='project soft prompt keys/values once per prompt update instead of every sampling step. implies --prompt_norm separate')
+        self.parser.add_argument('--profile_dir', type=str, default=None, help='dump a per-block time / activation profile (json + chrome trace) of every sampling call here. default: off')
+        self.parser.add_argument('--profile_backward', action='store_true', help='with --profile_dir, also time the backward of every block in the online prompt updates (run prompt_update)')
+        self.parser.add_argument('--text_cache_size', type=int, default=256, help='# of bert text embeddings kept in memory when sampling txt2shape. 0 disables the memory cache')
+        self.parser.add_argument('--text_cache_dir', type=str, default=None, help='on-disk text embedding cache, e.g. written by preprocess/encode_text2shape_captions.py. default: memory only')
         
         # vqvae stuff
         self.parser.add_argument('--vq_model', type=str, default='vqvae', help='for choosing the vqvae model to use.')
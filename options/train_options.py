@@ -25,6 +25,15 @@ class TrainOptions(BaseOptions):
         self.parser.add_argument('--lambda_L1', type=float, default=10.0, help='weight for L1 loss')
         self.parser.add_argument('--soft_prompt_tokens', type=int, default=8)
         self.parser.add_argument('--buffer_batch', type=int, default=50)
+        self.parser.add_argument('--utd_ratio', type=int, default=1, help='optimizer steps per simulation round (update-to-data ratio)')
+        self.parser.add_argument('--timesteps_per_latent', type=int, default=1, help='# of diffusion timesteps evaluated per replayed latent in one batched forward')
+        self.parser.add_argument('--prune_step', type=int, default=-1, help='ddim step at which candidates without a cavity in pred_x0 are dropped. -1 disables pruning')
+        self.parser.add_argument('--prune_preview_scale', type=float, default=1.0, help='latent scale for decoding the pruning preview, < 1 trades accuracy for decode cost')
+        self.parser.add_argument('--prune_min_cavity', type=int, default=1, help='min # of enclosed air voxels (at full resolution) for a candidate to survive pruning')
+        self.parser.add_argument('--lean_backward', action='store_true', help='prompt training: no autograd in front of the first prompted block, --lean_checkpoint behind it. reports peak_mem_mb')
+        self.parser.add_argument('--lean_checkpoint', type=str, default='attn', choices=['none', 'attn', 'all'], help='with --lean_backward: recompute the prompted attention blocks (attn) or also the resblocks (all) in backward')
+        self.parser.add_argument('--sim_workers', type=int, default=0, help='simulation worker processes, fed decoded sdfs through a shared-memory ring (simulation/sdf_ring.py). 0: simulate in-process')
+        self.parser.add_argument('--sim_slots', type=int, default=0, help='sdf slots of the shared-memory ring. 0: 2 per simulation worker')
         self.parser.add_argument('--online_sofa', action='store_true',
                     help='Ignore dataset and use SOFA-based reward in optimize_parameters()')
 
@@ -0,0 +1,58 @@
+""" Pre-encode all Text2Shape captions with the BERT encoder of a txt2shape checkpoint, into a text embedding cache.
+
+    cd preprocess
+    python encode_text2shape_captions.py --dataroot ../data --ckpt ../saved_ckpt/sdfusion-txt2shape.pth --cache_dir ../cache/text_emb
+
+    evaluation / demo runs with --text_cache_dir (or opt.text_cache_dir) pointing at the same directory then read
+    the embeddings from disk instead of running BERT. the cache is keyed by the encoder weights, so captions have
+    to be encoded again for another checkpoint.
+"""
+
+import csv
+
+import sys
+sys.path.append('..')
+
+import argparse
+
+import torch
+from omegaconf import OmegaConf
+from tqdm import tqdm
+
+from models.networks.bert_networks.network import BERTTextEncoder
+from models.networks.bert_networks.embedding_cache import TextEmbeddingCache, state_dict_hash
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dataroot', type=str, default='data', help='path to dataset')
+parser.add_argument('--ckpt', type=str, required=True, help='txt2shape checkpoint with the cond_model weights')
+parser.add_argument('--df_cfg', type=str, default='../configs/sdfusion-txt2shape.yaml')
+parser.add_argument('--cache_dir', type=str, required=True)
+parser.add_argument('--phases', type=str, nargs='+', default=['train', 'test'])
+parser.add_argument('--batch_size', type=int, default=64)
+parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+opt = parser.parse_args()
+
+texts = []
+for phase in opt.phases:
+    with open(f'{opt.dataroot}/ShapeNet/text2shape/captions.tablechair_{phase}.csv') as f:
+        reader = csv.reader(f, delimiter=',')
+        header = next(reader, None)
+        # same columns as datasets/text2shape_dataset.py
+        texts += [row[2] for row in reader]
+# the uc text is precomputed on every load, but costs nothing to store
+texts = list(dict.fromkeys([''] + texts))
+
+bert_params = OmegaConf.load(opt.df_cfg).bert.params
+cond_model = BERTTextEncoder(**bert_params)
+state_dict = torch.load(opt.ckpt, map_location=lambda storage, loc: storage)
+cond_model.load_state_dict(state_dict['cond_model'])
+cond_model.to(opt.device).eval()
+cond_model.tknz_fn.device = opt.device
+
+# memory cache off: every embedding goes straight to disk
+cache = TextEmbeddingCache(max_entries=0, cache_dir=opt.cache_dir, weights_hash=state_dict_hash(cond_model))
+for i in tqdm(range(0, len(texts), opt.batch_size), desc=f'encoding {len(texts)} captions'):
+    cache.encode(cond_model, texts[i:i + opt.batch_size])
+
+print(f'[*] {cache.misses} captions encoded, {cache.disk_hits} already cached, in {opt.cache_dir}')
@@ -0,0 +1,136 @@
+""" Prune the hidden channels and attention heads of the SDFusion UNet and fine-tune it (models/pruning.py).
+
+    python prune.py --ckpt saved_ckpt/sdfusion-snet-all.pth --out saved_ckpt/sdfusion-snet-pruned.pth
+    python prune.py --ckpt saved_ckpt/sdfusion-snet-all.pth --ratio 0.5 --head_ratio 0.34 --iters 2000
+
+    data-free, as distill.py: --pool latents are sampled once from the unpruned UNet (--steps DDIM steps). the
+    first --calib of them, noised to random timesteps, rank the units; the pool is then the fine-tuning set of
+    the diffusion loss. --ratio of each ResBlock's hidden groups and --head_ratio of each attention block's
+    heads go. the checkpoint is loaded with --pruned_ckpt, or models.pruning.load_pruned.
+
+    afterwards it prints, over --seeds, the unpruned against the pruned UNet:
+        params M    UNet parameters
+        unet ms     one UNet forward on a guided batch (2 latents)
+        sample sec  --steps DDIM steps of one latent
+        latent      mean squared error of the pruned samples to the unpruned ones (same x_T)
+        iou         utils.util.iou of the decoded pruned sdf vs. the unpruned one
+"""
+
+import copy
+import time
+import argparse
+from types import SimpleNamespace
+
+from omegaconf import OmegaConf
+from termcolor import cprint
+
+import torch
+
+from models.model_utils import load_vqvae
+from models.networks.diffusion_networks.network import DiffusionUNet
+from models.networks.diffusion_networks.ldm_diffusion_util import sdfusion_alphas_cumprod
+from models.distillation import ProgressiveDistiller
+from models.pruning import finetune, importance, make_plan, n_params, prune, save_pruned
+from utils.util import iou
+
+
+def ms_per_call(fn, repeats, device):
+    fn()
+    sync(device)
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    sync(device)
+    return (time.perf_counter() - t0) / repeats * 1e3
+
+
+def sync(device):
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--df_cfg', type=str, default='configs/sdfusion_snet.yaml')
+    parser.add_argument('--vq_cfg', type=str, default='configs/vqvae_snet.yaml')
+    parser.add_argument('--ckpt', type=str, required=True, help='SDFusionModel checkpoint (df, and vqvae unless --vq_ckpt)')
+    parser.add_argument('--vq_ckpt', type=str, default=None)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--ratio', type=float, default=0.5, help='share of the hidden GroupNorm groups pruned per ResBlock')
+    parser.add_argument('--head_ratio', type=float, default=0.5, help='share of the heads pruned per attention block')
+    parser.add_argument('--pool', type=int, default=256, help='# of unpruned samples to calibrate and fine-tune on')
+    parser.add_argument('--calib', type=int, default=16, help='# of them used to rank channels and heads')
+    parser.add_argument('--steps', type=int, default=50, help='ddim steps for the pool / report samples')
+    parser.add_argument('--iters', type=int, default=1000, help='fine-tuning steps')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--lr', type=float, default=1e-5)
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0, 1, 2, 3])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--out', type=str, default='saved_ckpt/sdfusion-pruned.pth')
+    args = parser.parse_args()
+
+    df_conf = OmegaConf.load(args.df_cfg)
+    vq_conf = OmegaConf.load(args.vq_cfg)
+    ddconfig = vq_conf.model.params.ddconfig
+    z_res = ddconfig.resolution // (2 ** (len(ddconfig.ch_mult) - 1))
+    z_shape = (ddconfig.z_channels, z_res, z_res, z_res)
+
+    df = DiffusionUNet(df_conf.unet.params, vq_conf=vq_conf)
+    state_dict = torch.load(args.ckpt, map_location=lambda storage, loc: storage)
+    df.load_state_dict(state_dict['df'], strict=False)
+    df.to(args.device).eval().requires_grad_(False)
+    vqvae = load_vqvae(vq_conf, vq_ckpt=args.vq_ckpt or args.ckpt, opt=SimpleNamespace(device=args.device))
+
+    # the schedule SDFusionModel samples on, not the df yaml's
+    alphas_cumprod = sdfusion_alphas_cumprod()
+    sampler = ProgressiveDistiller(df, alphas_cumprod)
+
+    # data-free: calibrate and fine-tune on the unpruned UNet's own samples
+    g = torch.Generator().manual_seed(1234)
+    pool = []
+    for i in range(0, args.pool, args.batch_size):
+        x_T = torch.randn(min(args.batch_size, args.pool - i), *z_shape, generator=g).to(args.device)
+        pool.append(sampler.sample(df, args.steps, x_T))
+    pool = torch.cat(pool)
+    z0 = pool[:args.calib]
+    t = torch.randint(0, alphas_cumprod.shape[0], (z0.shape[0],), generator=g).to(args.device)
+    a = alphas_cumprod.to(args.device)[t].view(-1, 1, 1, 1, 1)
+    z_t = a.sqrt() * z0 + (1. - a).sqrt() * torch.randn(z0.shape, generator=g).to(args.device)
+    cprint(f'[*] {pool.shape[0]} samples with {args.steps} steps, {z0.shape[0]} to calibrate', 'blue')
+
+    scores = importance(df, lambda m: [m(z_t[i:i + 2], t[i:i + 2]) for i in range(0, z0.shape[0], 2)])
+    plan = make_plan(df, scores, ratio=args.ratio, head_ratio=args.head_ratio)
+    pruned = prune(copy.deepcopy(df), plan)
+    cprint(f'[*] pruned {len(plan)} blocks: {n_params(df) / 1e6:.1f} M -> {n_params(pruned) / 1e6:.1f} M params', 'blue')
+
+    def data_fn():
+        idx = torch.randint(0, pool.shape[0], (args.batch_size,), device=pool.device)
+        return pool[idx], None
+
+    finetune(pruned, alphas_cumprod, data_fn, args.iters, lr=args.lr)
+    save_pruned(args.out, pruned, plan, vqvae_state_dict=vqvae.state_dict())
+    cprint(f'[*] pruned checkpoint -> {args.out}', 'blue')
+
+    x = torch.randn(2, *z_shape, generator=g).to(args.device)
+    t2 = torch.full((2,), 500, dtype=torch.long, device=args.device)
+    print(f'{"model":8s} {"params M":>9s} {"unet ms":>9s} {"sample sec":>10s} {"latent":>10s} {"iou":>7s}')
+    with torch.no_grad():
+        refs = {}
+        for name, net in [('full', df), ('pruned', pruned)]:
+            unet_ms = ms_per_call(lambda: net(x, t2), args.repeats, args.device)
+            secs, mse, ious = [], [], []
+            for seed in args.seeds:
+                x_T = torch.randn(1, *z_shape, generator=torch.Generator().manual_seed(seed)).to(args.device)
+                sync(args.device)
+                t0 = time.perf_counter()
+                z = sampler.sample(net, args.steps, x_T)
+                sync(args.device)
+                secs.append(time.perf_counter() - t0)
+                sdf = vqvae.decode_no_quant(z)
+                if name == 'full':
+                    refs[seed] = (z, sdf)
+                mse.append((z - refs[seed][0]).pow(2).mean().item())
+                ious.append(iou(refs[seed][1], sdf, 0.).mean().item())
+            n = len(args.seeds)
+            print(f'{name:8s} {n_params(net) / 1e6:9.1f} {unet_ms:9.1f} {sum(secs) / n:10.2f} '
+                  f'{sum(mse) / n:10.2e} {sum(ious) / n:7.4f}')
@@ -0,0 +1,117 @@
+""" Calibrate and save an int8 CPU build of the SDFusion UNet and VQ-VAE decoder (models/quantization.py).
+
+    python quantize.py --ckpt saved_ckpt/sdfusion-snet-all.pth --out saved_ckpt/sdfusion-snet-all-int8.pth
+    python quantize.py --ckpt saved_ckpt/sdfusion-snet-all.pth --vq_ckpt saved_ckpt/vqvae-snet-all.pth --tol 0.02
+
+    the calibration latents are samples of the fp32 UNet itself (--calib latents, --steps DDIM steps), noised
+    to random timesteps for the UNet and decoded as they are for the VQ-VAE. layers whose int8 output is off by
+    more than --tol (relative) stay fp32. the checkpoint is loaded with --int8_ckpt, or models.quantization.load_int8.
+
+    afterwards it prints, over --seeds, fp32 against int8:
+        unet ms     one UNet forward on a guided batch (2 latents)
+        decode ms   one VQVAE.decode_no_quant
+        latent      mean squared error of the int8 samples to the fp32 ones (same x_T)
+        iou         utils.util.iou of the decoded int8 sdf vs. the fp32 one
+"""
+
+import argparse
+import time
+from types import SimpleNamespace
+
+from omegaconf import OmegaConf
+from termcolor import cprint
+
+import torch
+
+from models.model_utils import load_vqvae
+from models.networks.diffusion_networks.network import DiffusionUNet
+from models.networks.diffusion_networks.ldm_diffusion_util import sdfusion_alphas_cumprod
+from models.distillation import ProgressiveDistiller
+from models.quantization import calibrate, candidate_layers, decoder_layers, quantize, save_int8
+from utils.util import iou
+
+
+def ms_per_call(fn, repeats):
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - t0) / repeats * 1e3
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--df_cfg', type=str, default='configs/sdfusion_snet.yaml')
+    parser.add_argument('--vq_cfg', type=str, default='configs/vqvae_snet.yaml')
+    parser.add_argument('--ckpt', type=str, required=True, help='SDFusionModel checkpoint (df, and vqvae unless --vq_ckpt)')
+    parser.add_argument('--vq_ckpt', type=str, default=None)
+    parser.add_argument('--calib', type=int, default=8, help='# of calibration latents')
+    parser.add_argument('--steps', type=int, default=20, help='ddim steps for the calibration / report samples')
+    parser.add_argument('--tol', type=float, default=0.05, help='max relative output error of an int8 layer')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0, 1, 2, 3])
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--out', type=str, default='saved_ckpt/sdfusion-int8.pth')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    df_conf = OmegaConf.load(args.df_cfg)
+    vq_conf = OmegaConf.load(args.vq_cfg)
+    ddconfig = vq_conf.model.params.ddconfig
+    z_res = ddconfig.resolution // (2 ** (len(ddconfig.ch_mult) - 1))
+    z_shape = (ddconfig.z_channels, z_res, z_res, z_res)
+
+    df = DiffusionUNet(df_conf.unet.params, vq_conf=vq_conf)
+    state_dict = torch.load(args.ckpt, map_location=lambda storage, loc: storage)
+    df.load_state_dict(state_dict['df'], strict=False)
+    df.eval()
+    vqvae = load_vqvae(vq_conf, vq_ckpt=args.vq_ckpt or args.ckpt, opt=SimpleNamespace(device='cpu'))
+
+    # the schedule SDFusionModel samples on, not the df yaml's
+    alphas_cumprod = sdfusion_alphas_cumprod()
+    sampler = ProgressiveDistiller(df, alphas_cumprod)
+
+    with torch.no_grad():
+        # data-free calibration set: fp32 samples, noised to random timesteps for the unet
+        g = torch.Generator().manual_seed(1234)
+        z0 = sampler.sample(df, args.steps, torch.randn(args.calib, *z_shape, generator=g))
+        t = torch.randint(0, alphas_cumprod.shape[0], (args.calib,), generator=g)
+        a = alphas_cumprod[t].view(-1, 1, 1, 1, 1)
+        z_t = a.sqrt() * z0 + (1. - a).sqrt() * torch.randn(z0.shape, generator=g)
+
+    df_plan, df_err = calibrate(df, lambda m: [m(z_t[i:i + 2], t[i:i + 2]) for i in range(0, args.calib, 2)],
+                                tol=args.tol)
+    vq_plan, vq_err = calibrate(vqvae, lambda m: [m.decode_no_quant(z0[i:i + 1]) for i in range(args.calib)],
+                                tol=args.tol, candidates=decoder_layers(vqvae))
+    for name, plan, err, n in [('unet', df_plan, df_err, len(candidate_layers(df))),
+                               ('decoder', vq_plan, vq_err, len(decoder_layers(vqvae)))]:
+        worst = sorted(err.items(), key=lambda kv: -kv[1])[:3]
+        cprint(f'[*] {name}: {len(plan)} / {n} layers int8, worst: ' +
+               ', '.join(f'{k} {v:.3f}' for k, v in worst), 'blue')
+
+    save_int8(args.out, df, vqvae, df_plan, vq_plan)
+    cprint(f'[*] int8 checkpoint -> {args.out}', 'blue')
+
+    df_q = quantize(df, df_plan)
+    vq_q = quantize(vqvae, vq_plan)
+    x = torch.randn(2, *z_shape, generator=g)
+    t2 = torch.full((2,), 500, dtype=torch.long)
+    print(f'{"model":6s} {"unet ms":>9s} {"decode ms":>10s} {"latent":>10s} {"iou":>7s}')
+    with torch.no_grad():
+        refs = {}
+        for name, (net, vq) in [('fp32', (df, vqvae)), ('int8', (df_q, vq_q))]:
+            unet_ms = ms_per_call(lambda: net(x, t2), args.repeats)
+            dec_ms = ms_per_call(lambda: vq.decode_no_quant(x[:1]), args.repeats)
+            mse, ious = [], []
+            for seed in args.seeds:
+                x_T = torch.randn(1, *z_shape, generator=torch.Generator().manual_seed(seed))
+                z = sampler.sample(net, args.steps, x_T)
+                sdf = vq.decode_no_quant(z)
+                if name == 'fp32':
+                    refs[seed] = (z, sdf)
+                mse.append((z - refs[seed][0]).pow(2).mean().item())
+                ious.append(iou(refs[seed][1], sdf, 0.).mean().item())
+            n = len(args.seeds)
+            print(f'{name:6s} {unet_ms:9.1f} {dec_ms:10.1f} {sum(mse) / n:10.2e} {sum(ious) / n:7.4f}')
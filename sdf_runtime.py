@@ -0,0 +1,96 @@
+""" Minimal SDF generation runtime for graphs exported with export.py (models/export.py).
+
+    python sdf_runtime.py saved_ckpt/export --ngen 4 --seed 0 --out samples.npy
+
+    depends on torch (TorchScript graphs) or onnxruntime (ONNX graphs) and numpy only: no SOFA, pytorch3d, omegaconf
+    or the options classes, so a worker can import it and start sampling right away:
+
+        gen = SDFGenerator('saved_ckpt/export')
+        sdf = gen.generate(ngen=4, seed=0)      # (4, 1, res, res, res) float32 numpy array
+"""
+
+import os
+import json
+import argparse
+
+import numpy as np
+
+
+class SDFGenerator(object):
+    """ unconditional DDIM sampling + decoding with the exported ddim_step / decode graphs in export_dir """
+    def __init__(self, export_dir, device=None, threads=None):
+        with open(os.path.join(export_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.z_shape = tuple(self.meta['z_shape'])
+        self.timesteps = np.asarray(self.meta['timesteps'], dtype=np.int64)
+        self.timesteps_prev = np.asarray(self.meta['timesteps_prev'], dtype=np.int64)
+        self.format = self.meta['format']
+
+        if self.format == 'torchscript':
+            import torch
+            if threads is not None:
+                torch.set_num_threads(threads)
+            # traced graphs keep the device they were traced on
+            self.device = device or self.meta['device']
+            self.step = torch.jit.load(os.path.join(export_dir, 'ddim_step.pt'), map_location=self.device)
+            self.decoder = torch.jit.load(os.path.join(export_dir, 'decode.pt'), map_location=self.device)
+        elif self.format == 'onnx':
+            try:
+                import onnxruntime as ort
+            except ImportError:
+                raise ImportError('ONNX exports need onnxruntime (pip install onnxruntime)')
+            options = ort.SessionOptions()
+            if threads is not None:
+                options.intra_op_num_threads = threads
+            providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if device == 'cuda' else ['CPUExecutionProvider']
+            self.device = device or 'cpu'
+            self.step = ort.InferenceSession(os.path.join(export_dir, 'ddim_step.onnx'), options, providers=providers)
+            self.decoder = ort.InferenceSession(os.path.join(export_dir, 'decode.onnx'), options, providers=providers)
+        else:
+            raise ValueError(f'unknown export format {self.format}')
+
+    def _run(self, graph, *inputs):
+        """ numpy in, numpy out """
+        if self.format == 'onnx':
+            names = [i.name for i in graph.get_inputs()]
+            return graph.run(None, dict(zip(names, inputs)))[0]
+        import torch
+        with torch.no_grad():
+            out = graph(*[torch.from_numpy(np.ascontiguousarray(x)).to(self.device) for x in inputs])
+        return out.cpu().numpy()
+
+    def noise(self, ngen, seed=None):
+        return np.random.default_rng(seed).standard_normal((ngen, *self.z_shape)).astype(np.float32)
+
+    def sample(self, ngen=1, seed=None, x_T=None):
+        """ latents (ngen, *z_shape) from x_T (default: standard normal noise from `seed`) """
+        x = self.noise(ngen, seed) if x_T is None else np.asarray(x_T, dtype=np.float32)
+        ngen = x.shape[0]
+        for k in reversed(range(len(self.timesteps))):
+            t = np.full((ngen,), self.timesteps[k], dtype=np.int64)
+            t_prev = np.full((ngen,), self.timesteps_prev[k], dtype=np.int64)
+            x = self._run(self.step, x, t, t_prev)
+        return x
+
+    def decode(self, z):
+        return self._run(self.decoder, np.asarray(z, dtype=np.float32))
+
+    def generate(self, ngen=1, seed=None, x_T=None):
+        """ sdfs (ngen, 1, res, res, res), float32 """
+        return self.decode(self.sample(ngen, seed, x_T))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('export_dir', type=str)
+    parser.add_argument('--ngen', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--out', type=str, default='samples.npy')
+    args = parser.parse_args()
+
+    gen = SDFGenerator(args.export_dir, device=args.device, threads=args.threads)
+    sdf = gen.generate(args.ngen, seed=args.seed)
+    np.save(args.out, sdf)
+    print(f'[*] {args.ngen} sdfs {sdf.shape[1:]} ({gen.meta["ddim_steps"]} ddim steps) saved to: {args.out}')
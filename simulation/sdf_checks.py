@@ -0,0 +1,47 @@
+"""
+Cheap, print-free pre-checks on a dense SDF, for rejecting candidates before meshing / SOFA.
+
+Same conventions as process_sofa_input.verify_sdf_cavities: negative = solid, positive = air,
+and a cavity is air that the 6-connected flood fill from the grid boundary does not reach.
+The flood fill here is a single scipy label pass instead of the python BFS, so it is safe to
+call on every candidate of a sampling batch.
+"""
+
+from typing import Optional, Tuple
+
+import numpy as np
+from scipy import ndimage as ndi
+
+
+def interior_air_voxels(sdf: np.ndarray) -> int:
+    """ number of air voxels not connected (6-connectivity) to the grid boundary """
+    air = sdf >= 0.0
+    labels, n = ndi.label(air)
+    if n == 0:
+        return 0
+    boundary = np.concatenate([
+        labels[0].ravel(), labels[-1].ravel(),
+        labels[:, 0].ravel(), labels[:, -1].ravel(),
+        labels[:, :, 0].ravel(), labels[:, :, -1].ravel(),
+    ])
+    exterior = np.zeros(n + 1, dtype=bool)
+    exterior[boundary] = True
+    exterior[0] = True  # background (solid)
+    return int((~exterior[labels]).sum())
+
+
+def quick_cavity_check(sdf: np.ndarray,
+                       min_cavity_voxels: int = 1,
+                       solid_fraction: Tuple[float, float] = (0.0, 1.0)) -> Optional[str]:
+    """
+    Returns None if `sdf` [D,H,W] can pass verify_sdf_cavities, otherwise the reason it cannot:
+        'solid_fraction'  fraction of solid voxels outside `solid_fraction`
+        'no_cavity'       fewer than `min_cavity_voxels` enclosed air voxels
+    `min_cavity_voxels` counts voxels at the resolution of `sdf`.
+    """
+    frac = float((sdf < 0.0).mean())
+    if not (solid_fraction[0] <= frac <= solid_fraction[1]):
+        return 'solid_fraction'
+    if interior_air_voxels(sdf) < min_cavity_voxels:
+        return 'no_cavity'
+    return None
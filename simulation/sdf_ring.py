@@ -0,0 +1,242 @@
+"""
+Zero-copy handoff of decoded SDFs to simulation worker processes.
+
+SDFRing is a preallocated ring of float32 [D,H,W] slots in one multiprocessing.shared_memory block. The
+decoding process copies the decoder output straight into a slot (on GPU hosts the block is page-locked with
+cudaHostRegister, so that copy is one DMA per batch), and the workers map the same block and read their slot
+as a numpy view. No SDF is pickled or copied between processes: only (slot, tag) pairs travel the queues.
+
+Slot lifecycle, one owner at a time (SDFRing.state tracks it in the shared block):
+    FREE     -> acquire()         producer owns the slot, writes it (write / put_batch)
+    WRITING  -> publish(slot)     handed to the workers
+    READY    -> claim()           one worker owns it, reads view(slot)
+    CLAIMED  -> release(slot)     back to the producer
+A view must not be used after release: the next acquire overwrites the slot. When every slot is in use,
+acquire blocks until a worker releases one, which bounds the memory and throttles the producer.
+
+SimulationPool runs run_fn(sdf view) in n worker processes over an SDFRing and returns the results in
+submission order; run_fn has to be picklable (a top-level function or a functools.partial of one).
+"""
+
+import atexit
+import queue
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# optional torch import (decoded SDFs arrive as torch tensors, the workers only need numpy)
+try:
+    import torch
+except ImportError:
+    torch = None
+
+FREE, WRITING, READY, CLAIMED = 0, 1, 2, 3
+_STATES = ['FREE', 'WRITING', 'READY', 'CLAIMED']
+# slot states ahead of the data, padded so every slot stays 64-byte aligned
+_HEADER = 64
+
+
+def _pin(array):
+    """ page-lock `array`'s memory for the cuda copy engines. returns False if there is no cuda to pin for """
+    if torch is None or not torch.cuda.is_available():
+        return False
+    try:
+        torch.cuda.check_error(torch.cuda.cudart().cudaHostRegister(array.ctypes.data, array.nbytes, 0))
+    except RuntimeError:
+        return False
+    return True
+
+
+def _unpin(array):
+    torch.cuda.check_error(torch.cuda.cudart().cudaHostUnregister(array.ctypes.data))
+
+
+class SDFRing(object):
+    """ n_slots float32 SDFs of `shape` in shared memory. the creating process owns (and unlinks) the block """
+    def __init__(self, n_slots, shape, pin=None, ctx=None, _attach=None):
+        self.n_slots, self.shape = n_slots, tuple(shape)
+        slot_bytes = int(np.prod(self.shape)) * 4
+        size = _HEADER * ((n_slots + _HEADER - 1) // _HEADER) + n_slots * slot_bytes
+        if _attach is None:
+            ctx = ctx or mp.get_context()
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.free, self.ready = ctx.Queue(), ctx.Queue()
+            self.owner = True
+        else:
+            name, self.free, self.ready = _attach
+            try:
+                # python >= 3.13: the creating process alone tracks (and unlinks) the block
+                self.shm = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+
+        offset = size - n_slots * slot_bytes
+        self.state = np.ndarray((n_slots,), dtype=np.uint8, buffer=self.shm.buf)
+        self.data = np.ndarray((n_slots,) + self.shape, dtype=np.float32, buffer=self.shm.buf, offset=offset)
+        self.pinned = False
+        if self.owner:
+            self.state[:] = FREE
+            for slot in range(n_slots):
+                self.free.put(slot)
+            self.pinned = _pin(self.data) if pin is not False else False
+            if pin and not self.pinned:
+                raise RuntimeError('pin=True but the sdf ring could not be page-locked (no cuda?)')
+
+    def handle(self):
+        """ what a worker process needs to attach: pass it as a Process argument, see attach """
+        return (self.n_slots, self.shape, (self.shm.name, self.free, self.ready))
+
+    @classmethod
+    def attach(cls, handle):
+        n_slots, shape, attach = handle
+        return cls(n_slots, shape, _attach=attach)
+
+    def _move(self, slot, src, dst):
+        if self.state[slot] != src:
+            raise RuntimeError(f'sdf ring slot {slot} is {_STATES[self.state[slot]]}, expected {_STATES[src]}')
+        self.state[slot] = dst
+
+    def view(self, slot):
+        """ the [D,H,W] float32 numpy view of a slot, no copy """
+        return self.data[slot]
+
+    # -- producer --------------------------------------------------
+    def acquire(self, timeout=None):
+        """ a FREE slot to write, blocks while all slots are in use """
+        slot = self.free.get(timeout=timeout)
+        self._move(slot, FREE, WRITING)
+        return slot
+
+    def write(self, slot, sdf):
+        """
+            copy one sdf (torch tensor on any device, or numpy) of shape [D,H,W] or [1,D,H,W] into a slot.
+            the copy from a cuda tensor into a pinned ring is asynchronous: put_batch synchronizes before it
+            publishes, callers of write alone have to as well
+        """
+        dst = self.data[slot]
+        if torch is not None and isinstance(sdf, torch.Tensor):
+            torch.from_numpy(dst).copy_(sdf.detach().reshape(dst.shape), non_blocking=self.pinned)
+        else:
+            np.copyto(dst, np.asarray(sdf).reshape(dst.shape), casting='same_kind')
+
+    def publish(self, slot, tag=None):
+        """ hand a written slot to the workers, `tag` comes back with it from claim """
+        self._move(slot, WRITING, READY)
+        self.ready.put((slot, tag))
+
+    def put_batch(self, batch, tags=None):
+        """
+            write and publish every sdf of `batch` ([B,D,H,W] or [B,1,D,H,W]), tagged with tags (default: the
+            batch index). batches larger than the ring go in rounds of n_slots
+        """
+        tags = list(range(len(batch))) if tags is None else list(tags)
+        cuda = torch is not None and isinstance(batch, torch.Tensor) and batch.is_cuda
+        for start in range(0, len(batch), self.n_slots):
+            rnd = range(start, min(start + self.n_slots, len(batch)))
+            slots = [self.acquire() for _ in rnd]
+            for slot, i in zip(slots, rnd):
+                self.write(slot, batch[i])
+            if cuda and self.pinned:
+                torch.cuda.current_stream(batch.device).synchronize()
+            for slot, i in zip(slots, rnd):
+                self.publish(slot, tags[i])
+
+    def stop(self, n_workers):
+        """ make the claim of `n_workers` workers return None """
+        for _ in range(n_workers):
+            self.ready.put(None)
+
+    # -- worker ----------------------------------------------------
+    def claim(self, timeout=None):
+        """ (slot, tag) of a READY slot, or None once the producer stops. blocks until one is published """
+        item = self.ready.get(timeout=timeout)
+        if item is not None:
+            self._move(item[0], READY, CLAIMED)
+        return item
+
+    def release(self, slot):
+        """ done with view(slot): the producer may overwrite it """
+        self._move(slot, CLAIMED, FREE)
+        self.free.put(slot)
+
+    def close(self):
+        # the numpy views hold exports of shm.buf, which has to be unreferenced before it closes
+        if self.pinned:
+            _unpin(self.data)
+            self.pinned = False
+        del self.state, self.data
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _worker(handle, run_fn, results):
+    """ claim -> run_fn(view) -> release until the ring stops. results get (tag, value, error or None) """
+    ring = SDFRing.attach(handle)
+    try:
+        while True:
+            item = ring.claim()
+            if item is None:
+                break
+            slot, tag = item
+            try:
+                out, err = run_fn(ring.view(slot)), None
+            except Exception as e:
+                out, err = None, f'{type(e).__name__}: {e}'
+            finally:
+                ring.release(slot)
+            results.put((tag, out, err))
+    finally:
+        ring.close()
+
+
+class SimulationPool(object):
+    """
+        n_workers processes running run_fn(sdf) on the SDFs of an SDFRing of n_slots (default: 2 per worker,
+        one simulated while the next is decoded). the processes are spawned: no cuda context or model weights
+        are inherited
+    """
+    def __init__(self, run_fn, n_workers, shape, n_slots=None, pin=None, start_method='spawn'):
+        ctx = mp.get_context(start_method)
+        self.ring = SDFRing(n_slots or 2 * n_workers, shape, pin=pin, ctx=ctx)
+        self.results = ctx.Queue()
+        self.workers = [ctx.Process(target=_worker, args=(self.ring.handle(), run_fn, self.results), daemon=True)
+                        for _ in range(n_workers)]
+        for w in self.workers:
+            w.start()
+        self.closed = False
+        atexit.register(self.close)
+
+    def map(self, batch, poll=1.):
+        """ [run_fn(sdf) for sdf in batch], see SDFRing.put_batch for the batch layouts """
+        n = len(batch)
+        self.ring.put_batch(batch)
+        out, errors = [None] * n, []
+        for _ in range(n):
+            while True:
+                try:
+                    tag, value, err = self.results.get(timeout=poll)
+                    break
+                except queue.Empty:
+                    if not all(w.is_alive() for w in self.workers):
+                        raise RuntimeError('a simulation worker died, its sdf will never come back')
+            out[tag] = value
+            if err is not None:
+                errors.append(f'sdf {tag}: {err}')
+        if errors:
+            raise RuntimeError('simulation workers failed on ' + '; '.join(errors))
+        return out
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        self.ring.stop(len(self.workers))
+        for w in self.workers:
+            w.join(timeout=10)
+            if w.is_alive():
+                w.terminate()
+        self.ring.close()
@@ -293,6 +293,24 @@ def run_simulation_keepalive(runner: SofaLiveRunner, sdf: np.ndarray, n_steps=10
     )
 
 
+# one runner per simulation worker process (simulation.sdf_ring.SimulationPool)
+_worker_runner = None
+
+def run_simulation_worker(sdf: np.ndarray, n_steps=1000):
+    """
+    run_simulation_keepalive on this process' own SofaLiveRunner, created on the first call.
+    The worker works in its own directory, so the meshes and the Monitor files of
+    parallel workers do not overwrite each other.
+    """
+    global _worker_runner
+    if _worker_runner is None:
+        out_dir = os.path.abspath(os.path.join("simulation/out_dir", f"worker_{os.getpid()}"))
+        _ensure_dir(out_dir)
+        os.chdir(out_dir)  # Monitor writes fingerMonitorA_x.txt to the cwd
+        _worker_runner = SofaLiveRunner(out_dir=out_dir)
+    return run_simulation_keepalive(_worker_runner, sdf, n_steps=n_steps)
+
+
 # def simulation_settup(dt=1e-3):
 #     root = Sofa.Core.Node("root")
 #     root.dt = dt
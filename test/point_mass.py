@@ -0,0 +1,46 @@
+"""
+Stand-ins shared by the sampler, distillation and export tests: the noise schedule SDFusionModel exposes to its
+samplers, and the exact denoiser of a data distribution concentrated on a single latent x0.
+"""
+import numpy as np
+import torch
+from torch import nn
+
+from models.networks.diffusion_networks.ldm_diffusion_util import make_beta_schedule
+
+
+class ScheduleOnlyModel(object):
+    """ the attributes a sampler reads from SDFusionModel for make_schedule, nothing else """
+    def __init__(self, device, timesteps=1000, linear_start=1e-4, linear_end=2e-2):
+        betas = make_beta_schedule('linear', timesteps, linear_start=linear_start, linear_end=linear_end)
+        alphas_cumprod = np.cumprod(1. - betas, axis=0)
+
+        self.device = device
+        self.num_timesteps = timesteps
+        self.betas = torch.tensor(betas, dtype=torch.float32, device=device)
+        self.alphas_cumprod = torch.tensor(alphas_cumprod, dtype=torch.float32, device=device)
+        self.alphas_cumprod_prev = torch.tensor(np.append(1., alphas_cumprod[:-1]), dtype=torch.float32, device=device)
+
+
+class PointDataNet(nn.Module):
+    """Exact eps-network of a data distribution concentrated on the single latent `x0`, as a DiffusionUNet stand-in."""
+    def __init__(self, x0, alphas_cumprod):
+        super().__init__()
+        self.conditioning_key = None
+        self.register_buffer('x0', x0)
+        self.register_buffer('alphas_cumprod', alphas_cumprod)
+
+    def forward(self, x, t):
+        a = self.alphas_cumprod[t].view(-1, *([1] * (x.dim() - 1)))
+        return (x - a.sqrt() * self.x0) / (1. - a).sqrt()
+
+
+class PointDataModel(ScheduleOnlyModel):
+    """Exact eps-model of a data distribution concentrated on the single latent `x0`, as SDFusionModel stand-in."""
+    def __init__(self, x0):
+        super().__init__("cpu")
+        self.net = PointDataNet(x0, self.alphas_cumprod)
+        self.parameterization = "eps"
+
+    def apply_model(self, x, t, cond):
+        return self.net(x, t)
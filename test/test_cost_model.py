@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+
+import torch
+
+from models.cost_model import decoder_costs
+from models.networks.diffusion_networks.openai_model_3d import ResBlock, resblock_cost
+from models.networks.vqvae_networks.vqvae_modules import Decoder3D
+from models.profiler import ModuleProfiler, profile_targets
+
+
+def n_params(module):
+    return sum(p.numel() for p in module.parameters())
+
+
+def test_resblock_cost_counts_the_parameters():
+    for c_in, c_out, scale_shift in [(32, 64, False), (64, 64, True)]:
+        block = ResBlock(c_in, 128, 0., out_channels=c_out, dims=3, use_scale_shift_norm=scale_shift)
+        cost = resblock_cost(2, c_in, c_out, 128, 4 ** 3, scale_shift)
+        assert cost['params'] == n_params(block)
+        assert cost['out'] == 2 * c_out * 4 ** 3 * 4
+
+
+def test_decoder_costs_match_the_profiled_decoder(tmp_path):
+    """Per Decoder3D block, the predicted parameters and output bytes are the module's / the profiler's."""
+    ddconfig = SimpleNamespace(ch=32, out_ch=1, ch_mult=(1, 2), num_res_blocks=1, attn_resolutions=[4],
+                               in_channels=1, resolution=8, z_channels=3, dropout=0.)
+    decoder = Decoder3D(ch=32, out_ch=1, ch_mult=(1, 2), num_res_blocks=1, attn_resolutions=[4], in_channels=1,
+                        resolution=8, z_channels=3)
+    rows = decoder_costs(SimpleNamespace(ddconfig=ddconfig, n_embed=16, embed_dim=3), batch=2)
+    rows = {r['name']: r for r in rows if r['name'].startswith('decoder.')}
+
+    profiler = ModuleProfiler(str(tmp_path), device='cpu').attach(decoder, 'decoder')
+    with torch.no_grad(), profiler.run('decode'):
+        decoder(torch.randn(2, 3, 4, 4, 4))
+    measured = {r['name']: r for r in profiler.summary()}
+    modules = dict(profile_targets(decoder, 'decoder'))
+
+    assert set(rows) == set(measured) - {'decoder'}
+    for name, row in rows.items():
+        assert row['params'] == n_params(modules[name]), name
+        assert row['out'] == measured[name]['act_bytes_max'], name
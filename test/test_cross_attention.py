@@ -0,0 +1,71 @@
+import pytest
+import torch
+
+from models.networks.diffusion_networks.attention import CrossAttention, SpatialTransformer3D, set_attn_mem_budget
+
+
+@pytest.mark.parametrize("use_sdpa", [False, True])
+@pytest.mark.parametrize("masked", [False, True])
+def test_chunked_attention_matches_full(use_sdpa, masked):
+    """Query chunks under a memory budget give the outputs and gradients of the full similarity matrix."""
+    attn = CrossAttention(query_dim=16, heads=2, dim_head=8)
+    if use_sdpa and not attn.use_sdpa:
+        pytest.skip('torch.nn.functional.scaled_dot_product_attention needs torch>=2.0')
+
+    g = torch.Generator().manual_seed(0)
+    bh, n, m = 4, 4 ** 3, 7
+    inputs = [torch.randn(bh, n, 8, generator=g), torch.randn(bh, m, 8, generator=g), torch.randn(bh, m, 8, generator=g)]
+    mask = torch.rand(bh, 1, m, generator=g) > 0.3 if masked else None
+    if masked:
+        mask[..., 0] = True
+
+    results = []
+    # the budget fits 5 query rows, so the last chunk is a partial one
+    for mem_budget, sdpa in [(None, False), (2 * 4 * bh * m * 5, use_sdpa)]:
+        attn.mem_budget, attn.use_sdpa = mem_budget, sdpa
+        q, k, v = [t.clone().requires_grad_(True) for t in inputs]
+        out = attn.attend(q, k, v, mask)
+        out.pow(2).sum().backward()
+        results.append([out.detach(), q.grad, k.grad, v.grad])
+
+    for ref, chunked in zip(*results):
+        assert torch.allclose(ref, chunked, atol=1e-5)
+
+
+def test_spatial_transformer_under_a_budget_matches_full():
+    """SpatialTransformer3D with its soft prompts: a budget of a few query rows changes neither outputs nor gradients."""
+    torch.manual_seed(0)
+    block = SpatialTransformer3D(16, n_heads=2, d_head=8, context_dim=12)
+    # proj_out starts at zero and the prompt gates closed, which would hide what is compared
+    torch.nn.init.normal_(block.proj_out.weight, std=0.1)
+    attns = [m for m in block.modules() if isinstance(m, CrossAttention)]
+    for attn in attns:
+        attn.prompt_gate_logit.data.fill_(0.)
+    x, context = torch.randn(2, 16, 4, 4, 4), torch.randn(2, 5, 12)
+
+    results = []
+    for mem_budget_mb in [None, 2 * 4 * 2 * 2 * (64 + 8) * 5 / 2 ** 20]:
+        set_attn_mem_budget(block, mem_budget_mb)
+        block.zero_grad()
+        out = block(x, context=context)
+        out.pow(2).sum().backward()
+        grads = [p.grad.clone() for attn in attns for p in [attn.soft_prompt.bank, attn.prompt_gate_logit]]
+        results.append([out.detach()] + grads)
+
+    # attn1 and attn2 both carry a prompt bank, the gradients reach it
+    assert len(results[0]) == 5 and all(g.abs().sum() > 0 for g in results[0][1:])
+    for ref, chunked in zip(*results):
+        assert torch.allclose(ref, chunked, atol=1e-5)
+
+
+def test_closed_prompt_gate_keeps_the_pretrained_attention():
+    """At its initial gate, the soft prompt leaves CrossAttention as it was without one."""
+    torch.manual_seed(0)
+    attn = CrossAttention(query_dim=16, context_dim=12, heads=2, dim_head=8)
+    x, context = torch.randn(2, 64, 16), torch.randn(2, 5, 12)
+    mask = torch.ones(2, 5, dtype=torch.bool)
+    mask[1, 3:] = False
+    with torch.no_grad():
+        out = attn(x, context=context, mask=mask)
+        attn.prompt_gate_logit.fill_(-float('inf'))
+        assert torch.allclose(out, attn(x, context=context, mask=mask), atol=1e-6)
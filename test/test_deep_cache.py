@@ -0,0 +1,20 @@
+import torch
+
+from models.networks.diffusion_networks.openai_model_3d import DeepCache
+
+
+def test_deep_cache_full_every_interval_calls():
+    """One full call per `interval` calls once a feature is cached; a batch-size change forces a full call."""
+    cache = DeepCache(branch=1, interval=3)
+    x = torch.zeros(2, 3, 4, 4, 4)
+
+    pattern = []
+    for _ in range(7):
+        full = cache.use_full(x)
+        if full:
+            cache.feature = torch.zeros(2, 8, 4, 4, 4)
+        pattern.append(full)
+    assert pattern == [True, False, False, True, False, False, True]
+
+    assert cache.use_full(torch.zeros(4, 3, 4, 4, 4))
+    assert (cache.n_full, cache.n_shallow) == (4, 4)
@@ -0,0 +1,32 @@
+import torch
+
+from models.distillation import ProgressiveDistiller
+from models.networks.diffusion_networks.samplers.ddim import DDIMSampler
+
+from point_mass import PointDataModel, PointDataNet, ScheduleOnlyModel
+
+
+def test_two_exact_teacher_steps_give_the_teacher_eps():
+    """DDIM is exact for a point mass, so one student step has to reproduce the teacher's own prediction."""
+    model = ScheduleOnlyModel("cpu")
+    x0 = torch.linspace(-1., 1., 3 * 4 * 4 * 4).view(1, 3, 4, 4, 4)
+    teacher = PointDataNet(x0, model.alphas_cumprod)
+    distiller = ProgressiveDistiller(teacher, model.alphas_cumprod)
+
+    k = torch.tensor([0, 3, 7])
+    z_t = distiller.q_sample(x0.expand(3, -1, -1, -1, -1), k, 8)
+    t, eps_target = distiller.target(teacher, z_t, k, 8)
+    assert torch.equal(t, distiller.grid(8)[0][k])
+    assert torch.allclose(eps_target, teacher(z_t, t), atol=1e-4)
+
+
+def test_student_sampling_matches_ddim_sampler():
+    """ProgressiveDistiller.sample is DDIMSampler on the trailing grid, which is what students are sampled with."""
+    model = PointDataModel(torch.linspace(-1., 1., 3 * 4 * 4 * 4).view(1, 3, 4, 4, 4))
+    net = model.net
+    x_T = torch.randn(2, 3, 4, 4, 4, generator=torch.Generator().manual_seed(0))
+
+    sampler = DDIMSampler(model, ddim_discretize='trailing')
+    samples, _ = sampler.sample(S=4, batch_size=2, shape=(3, 4, 4, 4), verbose=False, x_T=x_T, log_every_t=None)
+    expected = ProgressiveDistiller(net, model.alphas_cumprod).sample(net, 4, x_T)
+    assert torch.allclose(samples, expected, atol=1e-5)
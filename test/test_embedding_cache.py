@@ -0,0 +1,41 @@
+import torch
+from torch import nn
+
+from models.networks.bert_networks.embedding_cache import TextEmbeddingCache, state_dict_hash
+
+
+class CountingEncoder(nn.Module):
+    """Deterministic [B, 77, 8] stand-in for BERTTextEncoder that records the texts it encodes."""
+    def __init__(self):
+        super().__init__()
+        self.w = nn.Parameter(torch.ones(8))
+        self.calls = []
+
+    def forward(self, texts):
+        self.calls.append(list(texts))
+        lengths = torch.tensor([float(len(t)) for t in texts])
+        return lengths.view(-1, 1, 1) * self.w.view(1, 1, -1).expand(len(texts), 77, -1)
+
+
+def test_cache_encodes_each_text_once_and_survives_on_disk(tmp_path):
+    encoder = CountingEncoder()
+    cache = TextEmbeddingCache(max_entries=2, cache_dir=str(tmp_path), weights_hash=state_dict_hash(encoder))
+
+    z = cache.encode(encoder, ['a chair', '', 'a chair', 'a table'])
+    assert torch.equal(z, encoder(['a chair', '', 'a chair', 'a table']))
+    assert encoder.calls[0] == ['a chair', '', 'a table']
+    assert len(cache.entries) == 2  # LRU bound
+
+    # a fresh cache with the same weights reads everything back from disk
+    encoder.calls.clear()
+    fresh = TextEmbeddingCache(max_entries=2, cache_dir=str(tmp_path), weights_hash=state_dict_hash(encoder))
+    assert torch.equal(fresh.encode(encoder, ['a table', 'a chair']), z[[3, 0]])
+    assert encoder.calls == [] and fresh.disk_hits == 2
+
+
+def test_weights_hash_changes_with_the_weights():
+    encoder = CountingEncoder()
+    h = state_dict_hash(encoder)
+    with torch.no_grad():
+        encoder.w.mul_(2.)
+    assert state_dict_hash(encoder) != h
@@ -0,0 +1,51 @@
+import json
+
+import torch
+
+from models.networks.vqvae_networks.vqvae_modules import Decoder3D
+from models.profiler import ModuleProfiler
+
+
+def test_profiler_records_blocks_and_dumps_a_trace(tmp_path):
+    """Every Decoder3D block is counted once per call, with its output bytes, and the run dumps json + a Chrome trace."""
+    decoder = Decoder3D(ch=32, out_ch=1, ch_mult=(1, 2), num_res_blocks=1, attn_resolutions=[4], in_channels=1,
+                        resolution=8, z_channels=3)
+    profiler = ModuleProfiler(str(tmp_path), device='cpu').attach(decoder, 'vqvae.decoder')
+    assert profiler.names[:3] == ['vqvae.decoder', 'vqvae.decoder.conv_in', 'vqvae.decoder.mid.block_1']
+
+    with torch.no_grad(), profiler.run('decode'):
+        for _ in range(2):
+            out = decoder(torch.randn(2, 3, 4, 4, 4))
+
+    with open(tmp_path / '0001_decode.json') as f:
+        rows = {row['name']: row for row in json.load(f)['modules']}
+    assert set(rows) == set(profiler.names)
+    assert all(row['calls'] == 2 for row in rows.values())
+    assert rows['vqvae.decoder']['act_bytes_max'] == out.numel() * 4
+    assert rows['vqvae.decoder']['wall_ms'] >= rows['vqvae.decoder.conv_in']['wall_ms']
+
+    with open(tmp_path / '0001_decode.trace.json') as f:
+        events = [e for e in json.load(f)['traceEvents'] if e['ph'] == 'X']
+    assert len(events) == 2 * len(profiler.names)
+
+    n_events = len(profiler.events)
+    profiler.detach()
+    with torch.no_grad():
+        decoder(torch.randn(1, 3, 4, 4, 4))
+    assert len(profiler.events) == n_events
+
+
+def test_profiler_records_only_inside_runs_and_times_backward(tmp_path):
+    """Attached hooks stay silent outside run(); a run that backpropagates fills the backward columns."""
+    decoder = Decoder3D(ch=32, out_ch=1, ch_mult=(1, 2), num_res_blocks=1, attn_resolutions=[4], in_channels=1,
+                        resolution=8, z_channels=3)
+    profiler = ModuleProfiler(str(tmp_path), device='cpu', backward=True).attach(decoder, 'decoder')
+    decoder(torch.randn(1, 3, 4, 4, 4)).sum().backward()
+    assert profiler.events == [] and all(s['calls'] == 0 for s in profiler.stats.values())
+
+    if not profiler.backward:
+        return      # torch < 2.0: forward only
+    with profiler.run('update'):
+        decoder(torch.randn(1, 3, 4, 4, 4).requires_grad_(True)).sum().backward()
+    rows = {row['name']: row for row in profiler.summary()}
+    assert rows['decoder.conv_in']['calls'] == 1 and rows['decoder.conv_in']['bwd_calls'] == 1
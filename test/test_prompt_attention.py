@@ -0,0 +1,116 @@
+import pytest
+import torch
+
+from models.networks.diffusion_networks.openai_model_3d import QKVPromptAttention
+
+
+def attention_pair(gate_logit, heads=2, prompt_len=3):
+    ref = QKVPromptAttention(heads, prompt_len, init_gate_logit=gate_logit, use_sdpa=False)
+    fused = QKVPromptAttention(heads, prompt_len, init_gate_logit=gate_logit, use_sdpa=True)
+    if not fused.use_sdpa:
+        pytest.skip('torch.nn.functional.scaled_dot_product_attention needs torch>=2.0')
+    return ref, fused
+
+
+@pytest.mark.parametrize("gate_logit", [-20., 0., 2., -200.])
+def test_sdpa_path_matches_einsum_path(gate_logit):
+    """Outputs and gradients (inputs and gate) of the fused path match the einsum path, hard mask included."""
+    ref, fused = attention_pair(gate_logit)
+    T, L = 4 ** 3, 3
+    g = torch.Generator().manual_seed(0)
+    inputs = [torch.randn(2, 2 * 8, T + L, generator=g) for _ in range(3)]
+
+    results = []
+    for attn in [ref, fused]:
+        q, k, v = [t.clone().requires_grad_(True) for t in inputs]
+        attn.T_main = T
+        out = attn(q, k, v)
+        out.pow(2).sum().backward()
+        # the hard mask of the einsum path does not depend on the gate at all
+        gate_grad = attn.gate_logit.grad if attn.gate_logit.grad is not None else torch.zeros(())
+        results.append((out, q.grad, k.grad, v.grad, gate_grad))
+
+    for a, b in zip(*results):
+        assert torch.allclose(a, b, atol=1e-5, rtol=1e-4)
+
+
+def test_prompt_kv_cache_follows_prompt_updates():
+    """Cached prompt K/V give the uncached result, and an optimizer step on the prompt invalidates them."""
+    from models.networks.diffusion_networks.openai_model_3d import (
+        AttentionBlock, PromptedAttentionBlock, set_prompt_mode,
+    )
+
+    torch.manual_seed(0)
+    block = PromptedAttentionBlock(AttentionBlock(32, num_heads=2), prompt_len=4, prompt_norm='separate')
+    torch.nn.init.normal_(block.proj_out.weight)
+    torch.nn.init.normal_(block.soft_prompt.bank)
+    block.prompt_attention.gate_logit.data.fill_(0.)
+    x = torch.randn(2, 32, 4, 4, 4)
+
+    def run(cache):
+        set_prompt_mode(block, kv_cache=cache)
+        with torch.no_grad():
+            return block(x), block(x)
+
+    ref, _ = run(False)
+    out, again = run(True)
+    key = block.prompt_kv[0]
+    assert torch.allclose(out, ref, atol=1e-6) and torch.equal(out, again)
+
+    optimizer = torch.optim.SGD(block.soft_prompt.parameters(), lr=1.)
+    block.soft_prompt.bank.grad = torch.ones_like(block.soft_prompt.bank)
+    optimizer.step()
+
+    with torch.no_grad():
+        out = block(x)
+    assert block.prompt_kv[0] != key
+    ref, _ = run(False)
+    assert torch.allclose(out, ref, atol=1e-6)
+
+
+def test_checkpointed_prompt_block_gives_same_prompt_grads():
+    """Recomputing a frozen PromptedAttentionBlock in backward (set_lean_backward) leaves the prompt gradients as they are."""
+    from models.networks.diffusion_networks.openai_model_3d import (
+        AttentionBlock, PromptedAttentionBlock, set_lean_backward,
+    )
+
+    torch.manual_seed(0)
+    block = PromptedAttentionBlock(AttentionBlock(32, num_heads=2), prompt_len=4)
+    torch.nn.init.normal_(block.proj_out.weight)
+    block.prompt_attention.gate_logit.data.fill_(0.)
+    block.requires_grad_(False)
+    block.soft_prompt.requires_grad_(True)
+    x = torch.randn(2, 32, 4, 4, 4)
+
+    grads = []
+    for checkpoint in ['none', 'attn']:
+        set_lean_backward(block, checkpoint=checkpoint)
+        block.soft_prompt.bank.grad = None
+        block(x).pow(2).sum().backward()
+        grads.append(block.soft_prompt.bank.grad.clone())
+    assert block.use_checkpoint
+    assert torch.allclose(grads[0], grads[1], atol=1e-6)
+
+
+def test_token_merging_roundtrip_and_prompts():
+    """Merging tokens that come in identical pairs and unmerging is lossless; prompted blocks keep all prompts."""
+    from models.networks.diffusion_networks.openai_model_3d import (
+        AttentionBlock, PromptedAttentionBlock, bipartite_soft_matching, set_token_merging,
+    )
+
+    torch.manual_seed(0)
+    pairs = torch.randn(2, 8, 32)
+    x = pairs.repeat_interleave(2, dim=2)        # token 2i == token 2i + 1
+    merge, unmerge = bipartite_soft_matching(x, 32)
+    merged = merge(x)
+    assert merged.shape == (2, 8, 32)
+    assert torch.allclose(unmerge(merged), x, atol=1e-6)
+
+    block = PromptedAttentionBlock(AttentionBlock(32, num_heads=2), prompt_len=4)
+    torch.nn.init.normal_(block.proj_out.weight)
+    x = torch.randn(2, 32, 4, 4, 4)
+    set_token_merging(block, 0.25)
+    with torch.no_grad():
+        out = block(x)
+    assert out.shape == x.shape
+    assert block.prompt_attention.T_main == 4 ** 3 - 16
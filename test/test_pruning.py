@@ -0,0 +1,82 @@
+import copy
+
+import pytest
+import torch
+import torch.nn as nn
+
+from models.networks.diffusion_networks.openai_model_3d import AttentionBlock, PromptedAttentionBlock, ResBlock
+from models.pruning import importance, load_pruned_unet, make_plan, prune, save_pruned, units
+
+
+class Blocks(nn.Module):
+    """ a ResBlock and a PromptedAttentionBlock, as they sit in a UNet3DModel input block """
+    def __init__(self, channels=64, scale_shift=False):
+        super().__init__()
+        self.res = ResBlock(channels, 128, 0., dims=3, use_scale_shift_norm=scale_shift)
+        self.attn = PromptedAttentionBlock(AttentionBlock(channels, num_heads=4), prompt_len=8)
+        # the zero-initialized output convs would hide every pruned unit, and the gate the prompts
+        for conv in [self.res.out_layers[-1], self.attn.proj_out]:
+            nn.init.normal_(conv.weight, std=0.05)
+        nn.init.normal_(self.attn.soft_prompt.bank)
+        self.attn.prompt_attention.gate_logit.data.fill_(0.)
+
+    def forward(self, x, emb):
+        return self.attn(self.res(x, emb))
+
+
+def mask(model, plan):
+    """ the unpruned model with the weights out of the pruned units zeroed: same function as the pruned one """
+    model = copy.deepcopy(model)
+    for name, keep in plan.items():
+        module = model.get_submodule(name)
+        n, size = units(module)
+        drop = [u for u in range(n) if u not in keep]
+        conv = module.out_layers[-1] if isinstance(module, ResBlock) else module.proj_out
+        for u in drop:
+            conv.weight.data[:, u * size:(u + 1) * size] = 0.
+    return model
+
+
+def test_pruned_blocks_compute_the_masked_function():
+    """Dropping groups / heads structurally equals zeroing their outputs, for both norms and scale-shift."""
+    torch.manual_seed(0)
+    x, emb = torch.randn(2, 64, 4, 4, 4), torch.randn(2, 128)
+    for scale_shift, prompt_norm in [(False, 'joint'), (True, 'separate')]:
+        model = Blocks(scale_shift=scale_shift).eval()
+        model.attn.prompt_norm = prompt_norm
+        plan = {'res': [0, 3, 5, 6, 10, 17, 30, 31], 'attn': [1, 3]}
+        pruned = prune(copy.deepcopy(model), plan)
+
+        assert pruned.res.out_layers[0].num_groups == 8 and pruned.res.in_layers[-1].out_channels == 16
+        assert pruned.attn.qkv.weight.shape == (3 * 32, 64, 1) and pruned.attn.num_heads == 2
+        # residual width and the prompt bank are untouched
+        assert pruned.attn.soft_prompt.bank.shape == (8, 64)
+        with torch.no_grad():
+            assert torch.allclose(pruned(x, emb), mask(model, plan)(x, emb), atol=1e-5)
+
+
+def test_plan_keeps_the_most_important_units_and_reloads(tmp_path):
+    torch.manual_seed(0)
+    model = Blocks().eval()
+    # one head without any output weight is the least important
+    model.attn.proj_out.weight.data[:, 16:32] = 0.
+    x, emb = torch.randn(2, 64, 4, 4, 4), torch.randn(2, 128)
+    scores = importance(model, lambda m: m(x, emb))
+    assert scores['res'].shape == (32,) and scores['attn'].shape == (4,)
+
+    plan = make_plan(model, scores, ratio=0.5, head_ratio=0.25)
+    assert len(plan['res']) == 16 and plan['attn'] == [0, 2, 3]
+
+    pruned = prune(copy.deepcopy(model), plan)
+    save_pruned(tmp_path / 'pruned.pth', pruned, plan)
+    fresh = Blocks()
+    load_pruned_unet(fresh, str(tmp_path / 'pruned.pth'))
+    fresh.eval()
+    with torch.no_grad():
+        assert torch.allclose(fresh(x, emb), pruned(x, emb))
+
+    # a checkpoint missing any weight of the pruned df does not load
+    state_dict = torch.load(str(tmp_path / 'pruned.pth'))
+    state_dict['df'].pop(next(iter(state_dict['df'])))
+    with pytest.raises(RuntimeError):
+        load_pruned_unet(Blocks(), state_dict)
@@ -0,0 +1,41 @@
+import torch
+import torch.nn as nn
+
+from models.quantization import DynamicQuantLinear, Int8WeightConv3d, calibrate, quantize, quant_kind
+
+
+def rel_err(a, b):
+    return ((a - b).norm() / b.norm()).item()
+
+
+def test_int8_layers_match_fp32():
+    """1x1 convs / linears (dynamic int8) and 3x3x3 convs (int8 weights) stay close to their fp32 layers."""
+    torch.manual_seed(0)
+    conv1 = nn.Conv1d(32, 96, 1)
+    conv3 = nn.Conv3d(16, 32, 3, padding=1)
+    linear = nn.Linear(32, 64)
+    assert [quant_kind(m) for m in [conv1, conv3, linear]] == ['dynamic', 'weight_only', 'dynamic']
+
+    x1, x3 = torch.randn(2, 32, 50), torch.randn(2, 16, 6, 6, 6)
+    with torch.no_grad():
+        assert rel_err(DynamicQuantLinear(conv1)(x1), conv1(x1)) < 0.05
+        assert rel_err(DynamicQuantLinear(linear)(x1.transpose(1, 2)), linear(x1.transpose(1, 2))) < 0.05
+        assert rel_err(Int8WeightConv3d(conv3)(x3), conv3(x3)) < 0.02
+        # dequantized weights in the layout of the original layer
+        assert DynamicQuantLinear(conv1).weight.shape == conv1.weight.shape
+
+
+def test_calibration_keeps_sensitive_layers_fp32():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Conv3d(4, 8, 3, padding=1), nn.Conv3d(8, 8, 1))
+    x = torch.randn(2, 4, 5, 5, 5)
+
+    plan, errors = calibrate(model, lambda m: m(x), tol=0.)
+    assert plan == {} and set(errors) == {'0', '1'}
+
+    plan, _ = calibrate(model, lambda m: m(x), tol=1.)
+    assert plan == {'0': 'weight_only', '1': 'dynamic'}
+    model_q = quantize(model, plan)
+    assert isinstance(model_q[0], Int8WeightConv3d) and isinstance(model[0], nn.Conv3d)
+    with torch.no_grad():
+        assert rel_err(model_q(x), model(x)) < 0.05
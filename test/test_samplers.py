@@ -0,0 +1,162 @@
+import gc
+import weakref
+
+import numpy as np
+import pytest
+import torch
+
+from models.networks.diffusion_networks.ldm_diffusion_util import make_ddim_sampling_parameters, make_ddim_timesteps
+from models.networks.diffusion_networks.samplers.ddim import DDIMSampler, GuidanceSchedule, get_compiled_fns
+from models.networks.diffusion_networks.samplers.dpm_solver import DPMSolverSampler
+from models.networks.diffusion_networks.samplers.plms import PLMSSampler
+
+from point_mass import PointDataModel, ScheduleOnlyModel
+
+
+@pytest.mark.parametrize("sampler_cls", [DDIMSampler, PLMSSampler])
+def test_schedule_is_cached_on_model_device(sampler_cls):
+    """Schedules are built once per (steps, eta, discretize, device) and never leave the model's device."""
+    model = ScheduleOnlyModel("cpu")
+    s1, s2 = sampler_cls(model), sampler_cls(model)
+    s1.make_schedule(ddim_num_steps=25, verbose=False)
+    s2.make_schedule(ddim_num_steps=25, verbose=False)
+
+    assert s1.ddim_alphas is s2.ddim_alphas, "second sampler should reuse the cached schedule"
+    assert s1.ddim_alphas.device == model.betas.device
+
+    s2.make_schedule(ddim_num_steps=50, verbose=False)
+    assert s2.ddim_alphas.shape[0] == 50
+
+
+def test_schedule_matches_reference():
+    """Cached schedule reproduces the values of the original per-call computation."""
+    model = ScheduleOnlyModel("cpu")
+    sampler = DDIMSampler(model)
+    sampler.make_schedule(ddim_num_steps=25, verbose=False)
+
+    ddim_timesteps = make_ddim_timesteps('uniform', 25, model.num_timesteps, verbose=False)
+    sigmas, alphas, alphas_prev = make_ddim_sampling_parameters(model.alphas_cumprod.cpu(), ddim_timesteps, eta=0., verbose=False)
+
+    assert np.array_equal(sampler.ddim_timesteps, ddim_timesteps)
+    assert torch.allclose(sampler.ddim_alphas, torch.as_tensor(alphas, dtype=torch.float32))
+    assert torch.allclose(sampler.ddim_alphas_prev, torch.as_tensor(alphas_prev, dtype=torch.float32))
+    assert torch.allclose(sampler.ddim_sqrt_one_minus_alphas, torch.sqrt(1. - torch.as_tensor(alphas, dtype=torch.float32)))
+
+
+def test_step_params_broadcast_like_full():
+    """Indexed step coefficients broadcast to the same values the per-step torch.full tensors held."""
+    model = ScheduleOnlyModel("cpu")
+    sampler = DDIMSampler(model)
+    sampler.make_schedule(ddim_num_steps=25, verbose=False)
+
+    x = torch.zeros(2, 3, 4, 4, 4)
+    a_t, a_prev, sigma_t, sqrt_one_minus_at = sampler.get_step_params(7, x.dim())
+    assert a_t.shape == (1, 1, 1, 1, 1)
+    assert torch.equal((a_t + x), torch.full(x.shape, sampler.ddim_alphas[7].item()))
+    assert torch.equal((sqrt_one_minus_at + x), torch.full(x.shape, sampler.ddim_sqrt_one_minus_alphas[7].item()))
+
+
+@pytest.mark.parametrize("order", [1, 2, 3])
+def test_dpm_solver_follows_exact_ode(order):
+    """With an exact denoiser the probability-flow ODE keeps the noise direction, every order must land on it."""
+    x0 = torch.linspace(-1., 1., 3 * 4 * 4 * 4).view(1, 3, 4, 4, 4)
+    model = PointDataModel(x0)
+    x_T = torch.randn(2, 3, 4, 4, 4, generator=torch.Generator().manual_seed(0))
+
+    sampler = DPMSolverSampler(model, order=order)
+    samples, _ = sampler.sample(S=10, batch_size=2, shape=(3, 4, 4, 4), verbose=False, x_T=x_T)
+
+    a_T, a_0 = model.alphas_cumprod[-1], model.alphas_cumprod[0]
+    n = (x_T - a_T.sqrt() * x0) / (1. - a_T).sqrt()
+    expected = a_0.sqrt() * x0 + (1. - a_0).sqrt() * n
+    assert samples.shape == x_T.shape
+    assert torch.allclose(samples, expected, atol=1e-4)
+
+    # no intermediates kept, same sample
+    quiet, inter = sampler.sample(S=10, batch_size=2, shape=(3, 4, 4, 4), verbose=False, x_T=x_T, log_every_t=None)
+    assert inter == {} and torch.equal(quiet, samples)
+
+
+def test_ddim_prunes_candidates_mid_sampling():
+    """Rejected candidates leave the batch at `prune_at`, the rest finish and are reported by original index."""
+    x0 = torch.zeros(1, 3, 4, 4, 4)
+    model = PointDataModel(x0)
+    x_T = torch.randn(3, 3, 4, 4, 4, generator=torch.Generator().manual_seed(0))
+    seen = []
+
+    def prune_fn(pred_x0):
+        seen.append(pred_x0.shape[0])
+        return [None, 'no_cavity', None]
+
+    samples, inter = DDIMSampler(model).sample(S=10, batch_size=3, shape=(3, 4, 4, 4), verbose=False, x_T=x_T,
+                                               prune_at=4, prune_fn=prune_fn)
+    full, _ = DDIMSampler(model).sample(S=10, batch_size=3, shape=(3, 4, 4, 4), verbose=False, x_T=x_T)
+
+    assert seen == [3]
+    assert inter['kept'].tolist() == [0, 2]
+    assert inter['pruned'] == [dict(index=1, step=4, reason='no_cavity')]
+    assert torch.allclose(samples, full[[0, 2]], atol=1e-5)
+
+
+def test_ddim_sample_iter_matches_sample():
+    """Streaming yields only the subscribed steps plus the last one, whose x_t is the regular sample."""
+    model = PointDataModel(torch.zeros(1, 3, 4, 4, 4))
+    x_T = torch.randn(2, 3, 4, 4, 4, generator=torch.Generator().manual_seed(0))
+
+    samples, inter = DDIMSampler(model).sample(S=10, batch_size=2, shape=(3, 4, 4, 4), verbose=False, x_T=x_T,
+                                               log_every_t=None)
+    assert inter == {}
+
+    yielded = list(DDIMSampler(model).sample_iter(S=10, batch_size=2, shape=(3, 4, 4, 4), verbose=False, x_T=x_T,
+                                                  steps=[3, 5]))
+    assert [step for step, _, _ in yielded] == [3, 5, 9]
+    assert torch.equal(yielded[-1][1], samples)
+
+
+def test_guidance_window_and_uncond_reuse():
+    """Outside the window only conditional rows run; with uncond_every=2 every other step skips the uncond rows."""
+    apply_model = lambda x, t, c: x + c.view(-1, 1, 1, 1, 1)
+    x, t = torch.ones(2, 3, 4, 4, 4), torch.zeros(2, dtype=torch.long)
+    c, uc = torch.full((2,), 2.), torch.zeros(2)
+
+    full = GuidanceSchedule()
+    e_t = full(apply_model, x, c, t, timestep=500, unconditional_guidance_scale=3., unconditional_conditioning=uc)
+    assert torch.allclose(e_t, x + 3. * 2.)
+    assert full.unet_rows == 4
+
+    windowed = GuidanceSchedule(window=(0, 400))
+    e_t = windowed(apply_model, x, c, t, timestep=500, unconditional_guidance_scale=3., unconditional_conditioning=uc)
+    assert torch.allclose(e_t, x + 2.)
+    assert windowed.unet_rows == 2
+
+    reuse = GuidanceSchedule(uncond_every=2)
+    for _ in range(4):
+        e_t = reuse(apply_model, x, c, t, timestep=500, unconditional_guidance_scale=3., unconditional_conditioning=uc)
+        assert torch.allclose(e_t, x + 3. * 2.)
+    assert reuse.unet_rows == 4 + 2 + 4 + 2
+
+
+def test_trailing_grid_halves():
+    """Every trailing grid starts from the last ddpm step and is every other step of the grid with twice the steps."""
+    for n in [2, 4, 8, 16, 32]:
+        grid = make_ddim_timesteps('trailing', n, 1000, verbose=False)
+        assert grid.shape[0] == n and grid[-1] == 999
+        assert np.array_equal(make_ddim_timesteps('trailing', 2 * n, 1000, verbose=False)[1::2], grid)
+
+
+def test_compiled_fns_are_freed_with_the_model():
+    """The compiled apply_model references its model: the memo must not outlive it."""
+    if not hasattr(torch, 'compile'):
+        pytest.skip('torch.compile needs torch>=2.0')
+
+    class Model(object):
+        def apply_model(self, x, t, c):
+            return x
+
+    model = Model()
+    ref = weakref.ref(model)
+    fns = get_compiled_fns(model)
+    assert get_compiled_fns(model) is fns
+    del model, fns
+    gc.collect()
+    assert ref() is None
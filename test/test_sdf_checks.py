@@ -0,0 +1,24 @@
+import numpy as np
+
+from simulation.sdf_checks import interior_air_voxels, quick_cavity_check
+
+
+def hollow_cube(n=16, wall=3, hollow=True):
+    """Air everywhere except a solid cube, optionally with an enclosed air pocket in the middle."""
+    sdf = np.ones((n, n, n), dtype=np.float32)
+    sdf[wall:n - wall, wall:n - wall, wall:n - wall] = -1.
+    if hollow:
+        sdf[2 * wall:n - 2 * wall, 2 * wall:n - 2 * wall, 2 * wall:n - 2 * wall] = 1.
+    return sdf
+
+
+def test_interior_air_counts_enclosed_pocket_only():
+    assert interior_air_voxels(hollow_cube(hollow=True)) == (16 - 12) ** 3
+    assert interior_air_voxels(hollow_cube(hollow=False)) == 0
+
+
+def test_quick_cavity_check_reasons():
+    assert quick_cavity_check(hollow_cube(hollow=True)) is None
+    assert quick_cavity_check(hollow_cube(hollow=False)) == 'no_cavity'
+    assert quick_cavity_check(hollow_cube(hollow=True), min_cavity_voxels=1000) == 'no_cavity'
+    assert quick_cavity_check(hollow_cube(hollow=True), solid_fraction=(0.9, 1.0)) == 'solid_fraction'
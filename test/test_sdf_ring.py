@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from simulation.sdf_ring import CLAIMED, FREE, READY, WRITING, SDFRing, SimulationPool
+
+
+def solid_fraction(sdf):
+    # a view into the ring, not a pickled copy
+    assert sdf.base is not None and sdf.dtype == np.float32
+    return float((sdf < 0).mean())
+
+
+def test_slot_lifecycle_and_views():
+    ring = SDFRing(2, (4, 4, 4), pin=False)
+    worker = SDFRing.attach(ring.handle())
+    try:
+        sdf = np.random.RandomState(0).randn(1, 4, 4, 4)
+        slot = ring.acquire()
+        assert ring.state[slot] == WRITING
+        ring.write(slot, sdf)
+        ring.publish(slot, tag='a')
+
+        got, tag = worker.claim(timeout=5)
+        assert (got, tag) == (slot, 'a') and ring.state[slot] == CLAIMED
+        # same memory in both mappings
+        assert np.array_equal(worker.view(got), sdf[0].astype(np.float32))
+        worker.view(got)[0, 0, 0] = 7.
+        assert ring.view(slot)[0, 0, 0] == 7.
+
+        with pytest.raises(RuntimeError):
+            ring.publish(slot)
+        worker.release(got)
+        assert ring.state[slot] == FREE and READY not in ring.state
+    finally:
+        worker.close()
+        ring.close()
+
+
+def test_pool_maps_a_batch_larger_than_the_ring():
+    batch = np.random.RandomState(0).randn(5, 1, 6, 6, 6).astype(np.float32)
+    pool = SimulationPool(solid_fraction, n_workers=2, shape=(6, 6, 6), n_slots=2, pin=False)
+    try:
+        assert pool.map(batch) == pytest.approx([float((b < 0).mean()) for b in batch])
+        assert all(s == FREE for s in pool.ring.state)
+    finally:
+        pool.close()
@@ -0,0 +1,94 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from models.networks.diffusion_networks.ldm_diffusion_util import sdfusion_alphas_cumprod
+from models.networks.diffusion_networks.openai_model_3d import UNet3DModel
+from utils.demo_util import SDFusionOpt
+
+# SOFA and pytorch3d come in with the model module
+sdfusion_model = pytest.importorskip('models.sdfusion_model')
+
+
+def small_unet():
+    return UNet3DModel(prompt_len=4, image_size=4, in_channels=3, model_channels=32, out_channels=3,
+                       num_res_blocks=1, attention_resolutions=[1], channel_mult=[1, 2], num_heads=2, dims=3,
+                       use_spatial_transformer=True, context_dim=16)
+
+
+def train_opt(tmp_path, monkeypatch, **kwargs):
+    """ the options train.py builds: SDFusionOpt (isTrain=False) + init_model_args """
+    monkeypatch.chdir(tmp_path)     # init_model_args makes logs/
+    opt = SDFusionOpt()
+    opt.init_model_args(**kwargs)
+    assert not opt.isTrain
+    return opt
+
+
+def test_online_loop_options_of_sdfusion_opt_apply(tmp_path, monkeypatch):
+    opt = train_opt(tmp_path, monkeypatch, lean_backward=True, lean_checkpoint='all')
+    model = sdfusion_model.SDFusionModel()
+    model.df = small_unet()
+    model.init_prompt_training(opt)
+    assert model.df.lean_backward
+
+
+def test_sim_workers_of_sdfusion_opt_start_and_close(tmp_path, monkeypatch):
+    opt = train_opt(tmp_path, monkeypatch, sim_workers=1, sim_slots=3)
+    model = sdfusion_model.SDFusionModel()
+    model.init_sim_workers(opt, (8, 8, 8))
+    pool = model.sim_pool
+    try:
+        assert pool is not None and pool.ring.n_slots == 3 and all(w.is_alive() for w in pool.workers)
+    finally:
+        model.close()
+    assert model.sim_pool is None and pool.closed and not any(w.is_alive() for w in pool.workers)
+
+
+def test_offline_tools_use_the_schedule_the_model_samples_on():
+    """distill / prune / quantize / export build alphas_cumprod with sdfusion_alphas_cumprod, not from the df yaml."""
+    model = sdfusion_model.SDFusionModel()
+    model.device = 'cpu'
+    model.init_diffusion_params()
+    assert torch.equal(sdfusion_alphas_cumprod(), model.alphas_cumprod)
+
+
+class ReplayStub(object):
+    """ TopKBuffer.sample layout: (angle, counter, z0) tuples """
+    def __init__(self, z0):
+        self.z0 = z0
+
+    def sample(self, n):
+        return [(0., i, self.z0[i]) for i in range(n)]
+
+
+def diffusion_model(**opt):
+    model = sdfusion_model.SDFusionModel()
+    model.device = 'cpu'
+    model.opt = SimpleNamespace(**opt)
+    model.init_diffusion_params()
+    return model
+
+
+@pytest.mark.parametrize("k", [3, 4, 7])
+def test_stratified_timesteps_cover_every_bin(k):
+    """One timestep per bin of arange(k+1)*T//k, also when k does not divide T (t = T-1 stays reachable)."""
+    model = diffusion_model()
+    torch.manual_seed(0)
+    t = model.sample_timesteps(20000, k).view(20000, k)
+    bins = torch.arange(k + 1) * model.num_timesteps // k
+    assert ((t >= bins[:-1]) & (t < bins[1:])).all()
+    assert t[:, -1].max() == model.num_timesteps - 1 and t[:, 0].min() == 0
+
+
+def test_replay_batch_pairs_each_latent_with_its_k_timesteps():
+    """Rows i*K .. i*K+K-1 repeat latent i, and its K timesteps fall in the K different bins."""
+    K, B = 3, 4
+    model = diffusion_model(batch_size=B)
+    model.replay = ReplayStub(torch.arange(B, dtype=torch.float32).view(B, 1, 1, 1, 1).expand(B, 3, 2, 2, 2))
+    z0, t = model.replay_batch(K)
+    assert z0.shape == (B * K, 3, 2, 2, 2) and t.shape == (B * K,)
+    assert torch.equal(z0[:, 0, 0, 0, 0], torch.arange(B, dtype=torch.float32).repeat_interleave(K))
+    bins = torch.arange(K + 1) * model.num_timesteps // K
+    assert ((t.view(B, K) >= bins[:-1]) & (t.view(B, K) < bins[1:])).all()
@@ -0,0 +1,51 @@
+import torch
+
+from models.networks.vqvae_networks.quantizer import VectorQuantizer
+from models.networks.vqvae_networks.tiled_decode import (attn_chunked, decode_tiled, quantize_slabs,
+                                                         receptive_margin, tile_for_budget)
+from models.networks.vqvae_networks.vqvae_modules import AttnBlock, Decoder3D
+
+
+def make_decoder():
+    # attention on the 8^3 up level, so the tiles attend across each other
+    return Decoder3D(ch=32, out_ch=1, ch_mult=(1, 2), num_res_blocks=1, attn_resolutions=[8], in_channels=1,
+                     resolution=16, z_channels=3).eval()
+
+
+def test_tiled_decode_matches_the_full_decode():
+    """From the receptive margin on, overlapping tiles give the one-pass decode; smaller overlaps stay close."""
+    torch.manual_seed(0)
+    decoder = make_decoder()
+    z = torch.randn(2, 3, 12, 12, 12)
+    assert receptive_margin(decoder) == 4.
+    with torch.no_grad():
+        full = decoder(z)
+        tiled = decode_tiled(decoder, z, tile=4)
+        one = decode_tiled(decoder, z, tile=12, overlap=0)
+        cheap = decode_tiled(decoder, z, tile=4, overlap=2, store='cpu')
+
+    assert tiled.shape == full.shape == (2, 1, 24, 24, 24)
+    assert torch.allclose(tiled, full, atol=1e-4)
+    assert torch.allclose(one, full, atol=1e-5)
+    # blended seams, tiles kept on the cpu
+    assert cheap.shape == full.shape and torch.isfinite(cheap).all()
+
+
+def test_budget_chunks_are_exact():
+    torch.manual_seed(0)
+    decoder = make_decoder()
+    z = torch.randn(1, 3, 8, 8, 8)
+    # half the working set of the whole 8^3 latent: 6^3 tiles (4 + 2 * 1 overlap) fit, 7^3 do not
+    tile = tile_for_budget(decoder, z.shape, 1, 4 * 32 * 16 ** 3 * 4, overlap=1)
+    assert tile == 4
+
+    block = AttnBlock(32).eval()
+    x = torch.randn(2, 32, 4, 4, 4)
+    quantize = VectorQuantizer(64, 3, beta=0.25)
+    h = torch.randn(2, 3, 8, 8, 8)
+    with torch.no_grad():
+        # query chunks of 10
+        assert torch.allclose(attn_chunked(block, x, mem_budget=2 * 2 * 64 * 4 * 10), block(x), atol=1e-5)
+        # slabs of 3
+        assert torch.allclose(quantize_slabs(quantize, h, mem_budget=3 * 4 * 2 * 64 * 64 * 3),
+                              quantize(h, is_voxel=True)[0])
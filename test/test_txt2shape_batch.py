@@ -0,0 +1,52 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+from torch import nn
+
+# BERT, mcubes and cv2 come in with the model module
+txt2shape_model = pytest.importorskip('models.sdfusion_txt2shape_model')
+
+
+class LengthEncoder(nn.Module):
+    """[B, 77, 8] stand-in for BERTTextEncoder: every entry is len(text). records the texts it encodes."""
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def forward(self, texts):
+        self.calls.append(list(texts))
+        return torch.tensor([float(len(t)) for t in texts]).view(-1, 1, 1).expand(-1, 77, 8)
+
+
+class EchoSampler(object):
+    """DDIMSampler stand-in: the latent of a row is its conditioning value. records the batch sizes."""
+    def __init__(self):
+        self.batches = []
+
+    def sample(self, S, batch_size, shape, conditioning, **kwargs):
+        self.batches.append(batch_size)
+        return conditioning[:, 0, 0].view(-1, 1, 1, 1, 1).expand(batch_size, *shape), None
+
+
+def test_batch_encodes_each_prompt_once_and_regroups_in_input_order():
+    model = txt2shape_model.SDFusionText2ShapeModel()
+    model.opt = SimpleNamespace(device='cpu', precision='fp32', max_sample_batch=5, sample_mem_budget=None)
+    model.device = 'cpu'
+    model.df, model.vqvae, model.cond_model = nn.Identity(), nn.Identity(), LengthEncoder()
+    model.text_cache, model.uc_embedding = None, None
+    model.ddim_sampler = EchoSampler()
+    model.z_shape = (3, 2, 2, 2)
+    model.decode = lambda z: z[:, :1]
+
+    prompts = ['a chair', 'a table', 'a chair', 'lamp']
+    out = model.txt2shape_batch(prompts, ngen=3, ddim_steps=2, uc_scale=3.)
+
+    # one BERT call for the distinct strings, one for the uc text
+    assert model.cond_model.calls == [['a chair', 'a table', 'lamp'], ['']]
+    # 12 rows under max_batch=5: three equal batches of 4, not 5 + 5 + 2
+    assert model.ddim_sampler.batches == [4, 4, 4]
+    assert len(out) == 4
+    for prompt, sdf in zip(prompts, out):
+        assert sdf.shape == (3, 1, 2, 2, 2)
+        assert (sdf == len(prompt)).all()
@@ -174,4 +174,7 @@ if __name__ == "__main__":
     #         cfg_out = os.path.join(expr_dir, os.path.basename(df_cfg))
     #         os.system(f'cp {df_cfg} {cfg_out}')
 
-    train_main_worker(opt, model, train_dl, test_dl, test_dl_for_eval, visualizer, device)
+    try:
+        train_main_worker(opt, model, train_dl, test_dl, test_dl_for_eval, visualizer, device)
+    finally:
+        model.close()
@@ -42,6 +42,35 @@ class BaseOpt(object):
         # hyperparams
         self.batch_size = 1
 
+        # sampling
+        self.compile_sampler = False
+        self.cfg_window = None
+        self.uncond_every = 1
+        self.deep_cache_interval = 1
+        self.deep_cache_branch = 1
+        self.ddim_discretize = 'uniform'
+        self.sampler = 'ddim'
+        self.dpm_order = 2
+        self.student_ckpt = None
+        self.int8_ckpt = None
+        self.pruned_ckpt = None
+        self.max_sample_batch = 32
+        self.sample_mem_budget = None
+        self.text_cache_size = 256
+        self.text_cache_dir = None
+        self.prompt_norm = 'joint'
+        self.prompt_kv_cache = False
+        self.precision = 'fp32'
+        self.memory_format = 'contiguous'
+        self.decode_tile = 0
+        self.decode_mem_budget = 0
+        self.decode_overlap = None
+        self.decode_store = None
+        self.attn_mem_budget = 256
+        self.tome_ratio = [0.]
+        self.profile_dir = None
+        self.profile_backward = False
+
         # dataset args
         self.max_dataset_size = 10000000
         self.trunc_thres = 0.2
@@ -95,6 +124,16 @@ class SDFusionOpt(BaseOpt):
             top_k=50,
             lr=0.02,
             batch_size=1,
+            buffer_size=50,
+            utd_ratio=1,
+            timesteps_per_latent=1,
+            prune_step=-1,
+            prune_preview_scale=1.0,
+            prune_min_cavity=1,
+            lean_backward=False,
+            lean_checkpoint='attn',
+            sim_workers=0,
+            sim_slots=0,
         ):
         self.model = 'sdfusion'
         self.name = 'sdfusion-snet-all'
@@ -109,6 +148,20 @@ class SDFusionOpt(BaseOpt):
         self.logs_dir = 'logs'
         self.lr = lr
         self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        # online loop: optimizer steps per simulation round, noise levels per replayed latent
+        self.utd_ratio = utd_ratio
+        self.timesteps_per_latent = timesteps_per_latent
+        # online loop: drop candidates without a cavity at this ddim step (-1: never)
+        self.prune_step = prune_step
+        self.prune_preview_scale = prune_preview_scale
+        self.prune_min_cavity = prune_min_cavity
+        # prompt training: autograd only behind the first prompted block, see set_lean_backward
+        self.lean_backward = lean_backward
+        self.lean_checkpoint = lean_checkpoint
+        # online loop: simulation worker processes and the slots of their shared-memory sdf ring
+        self.sim_workers = sim_workers
+        self.sim_slots = sim_slots
         self.results_dir = 'saved_results'
         import os 
         import utils